@@ -0,0 +1,127 @@
+'''Predicts how large a conversion's outputs will be and holds jobs back
+   while their destination doesn't have the room for them'''
+from os import statvfs, stat
+from os.path import dirname, exists, splitext
+from threading import Lock
+
+from config import DEFAULT_PROFILE
+from constants import SPACE_MARGIN, SPACE_RESERVE, TARGET_VIDEO_BITRATE, MODEL_SMOOTHING
+from constants import PROBE_BACKEND
+from converter import conversion_paths
+from decisions import plan, ConversionPlan
+from mediainfo import MediaInfo, MediaInfoError
+
+def target_rate(profile=DEFAULT_PROFILE):
+    '''Returns the bytes per second of media that a profile's target bitrates add up to'''
+    return (TARGET_VIDEO_BITRATE + profile.max_audio_bitrate) * 1000 / 8.0
+
+def existing_directory(file_path):
+    '''Returns the closest directory above a path that exists'''
+    directory = dirname(file_path)
+    while directory and not exists(directory):
+        directory = dirname(directory)
+    return directory or '.'
+
+def free_bytes(file_path):
+    '''Returns the bytes available to us on the filesystem a path would be created on'''
+    fs_stat = statvfs(existing_directory(file_path))
+    return fs_stat.f_bavail * fs_stat.f_frsize
+
+class OutputModel(object):
+    '''Predicts output sizes as bytes per second of media. Each library
+       starts out from the target video bitrate plus its audio bitrate and
+       then follows an exponentially weighted average of what its
+       conversions actually produced.'''
+    def __init__(self, smoothing=MODEL_SMOOTHING):
+        self.smoothing = smoothing
+        self.rates = {}
+        self._lock = Lock()
+
+    def record(self, library_name, duration, output_size):
+        '''Feeds the size of a finished conversion back into the model'''
+        if not duration or output_size <= 0:
+            return
+        rate = output_size / duration
+        with self._lock:
+            previous = self.rates.get(library_name)
+            self.rates[library_name] = rate if previous is None else \
+                                       previous + self.smoothing * (rate - previous)
+
+    def rate(self, library_name, profile=DEFAULT_PROFILE):
+        '''Returns the expected output bytes per second of media for a library'''
+        with self._lock:
+            rate = self.rates.get(library_name)
+        return target_rate(profile) if rate is None else rate
+
+    def predict(self, info, library=None):
+        '''Returns the predicted size in bytes of all of a source's outputs,
+           given its MediaInfo. Remuxes are about as large as the source.'''
+        profile = library.profile if library else DEFAULT_PROFILE
+        source_size = stat(info.file_path).st_size
+        conversion_plan = plan(info, splitext(info.file_path)[1], profile)
+        duration = info.duration()
+        if conversion_plan in (ConversionPlan.SKIP, ConversionPlan.REMUX,
+                               ConversionPlan.AUDIO) or not duration:
+            size = source_size
+        else:
+            size = min(source_size, duration * self.rate(library.name if library else '',
+                                                         profile))
+        renditions = library.renditions if library else []
+        for rendition in renditions:
+            scale = float(rendition.profile.max_width * rendition.profile.max_height) / \
+                    (profile.max_width * profile.max_height)
+            size += min(source_size, (duration or 0) * target_rate(rendition.profile) * scale)
+        return size
+
+class AdmissionControl(object):
+    '''Decides whether a job may start based on the free space on its
+       destination (and on the scratch directory, if sources are staged),
+       less what the jobs already admitted are expected to write. The
+       prediction is padded by margin and reserve bytes are always kept free.'''
+    def __init__(self, model=None, cache=None, backend=PROBE_BACKEND, scratch_dir=None,
+                 margin=SPACE_MARGIN, reserve=SPACE_RESERVE):
+        self.model = model or OutputModel()
+        self.cache = cache
+        self.backend = backend
+        self.scratch_dir = scratch_dir
+        self.margin = margin
+        self.reserve = reserve
+        self.admitted = {}
+        self._lock = Lock()
+
+    def _paths(self, file_path, library):
+        '''Returns the paths on whose filesystems a job will write its outputs'''
+        paths = [conversion_paths(file_path, library)[1]]
+        if self.scratch_dir:
+            paths.append(self.scratch_dir + '/')
+        return paths
+
+    def admit(self, job, library=None):
+        '''Admits a job, returning None, or returns why it has to wait'''
+        try:
+            needed = self.model.predict(MediaInfo(job.path, self.cache, self.backend), library)
+        except (MediaInfoError, OSError):
+            # the conversion itself will report on sources that can't be read
+            return None
+        needed = needed * self.margin
+        with self._lock:
+            for path in self._paths(job.path, library):
+                device = stat(existing_directory(path)).st_dev
+                pending = sum(size for admitted_device, size in self.admitted.values()
+                              if admitted_device == device)
+                available = free_bytes(path) - pending - self.reserve
+                if needed > available:
+                    return "needs {:0.0f} MiB but {:0.0f} MiB are available for {}".format(
+                        needed / 1024 ** 2, max(0, available) / 1024 ** 2, dirname(path))
+            for index, path in enumerate(self._paths(job.path, library)):
+                self.admitted[(job.id, index)] = (stat(existing_directory(path)).st_dev, needed)
+        return None
+
+    def release(self, job, library=None, duration=None, output_size=None):
+        '''Forgets the space admitted for a job and, when the size it actually
+           produced is given, feeds it back into the model'''
+        with self._lock:
+            for key in [key for key in self.admitted if key[0] == job.id]:
+                del self.admitted[key]
+        if duration and output_size:
+            self.model.record(library.name if library else '', duration, output_size)
@@ -0,0 +1,108 @@
+'''Compares the per-job startup overhead and helper memory of the old
+   Manager + Process conversion agent against launching ffmpeg directly.
+   A stub command stands in for ffmpeg so only the orchestration is measured,
+   and the old blind 2 second sleep is left out of the legacy numbers.'''
+import sys
+from argparse import ArgumentParser
+from datetime import timedelta
+from json import dumps
+from multiprocessing import Process, Manager
+from os import getpid
+from os.path import dirname, abspath, join
+from subprocess import check_call, SubprocessError
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from config import DEFAULT_PROFILE # pylint: disable=wrong-import-position
+from converter import Conversion, ConversionStatus # pylint: disable=wrong-import-position
+from decisions import ConversionPlan # pylint: disable=wrong-import-position
+
+STUB_CMD = ['sleep', '1']
+
+def rss_kib(pid):
+    '''Returns the resident set size of a process in KiB'''
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def children(pid):
+    '''Returns the pids of a process' direct children'''
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid)) as child_file:
+            return [int(child) for child in child_file.read().split()]
+    except OSError:
+        return []
+
+def _legacy_execute(return_dict):
+    try:
+        check_call(STUB_CMD)
+    except SubprocessError as error:
+        return_dict['error'] = error
+
+def legacy_start():
+    '''Starts a job the way Conversion.start() used to, returning the
+       startup time and the RSS of the helper processes it needed'''
+    started = perf_counter()
+    manager = Manager()
+    result = manager.dict()
+    agent = Process(target=_legacy_execute, args=(result,))
+    agent.start()
+    while not children(agent.pid):
+        sleep(0.001)
+    elapsed = perf_counter() - started
+    helpers = [pid for pid in children(getpid()) if pid != children(agent.pid)[0]]
+    rss = sum(rss_kib(pid) for pid in helpers)
+    agent.join()
+    manager.shutdown()
+    return elapsed, rss
+
+class StubConversion(Conversion):
+    '''A Conversion that runs the stub command instead of ffmpeg'''
+    def __init__(self, log_dir): # pylint: disable=super-init-not-called
+        self.src = self.dst = 'stub'
+        self.log = join(log_dir, 'stub.log')
+        self.width = self.height = self.audio_bitrate = None
+        self.threads = None
+        self.profile = DEFAULT_PROFILE
+        self.duration = None
+        self.plan = ConversionPlan.REMUX
+        self.ffmpeg = self.ffmpeg_proc_info = self.progress_reader = self.log_tail = None
+        self.start_time = None
+        self.status = ConversionStatus.NONE
+        self.paused_at = None
+        self.paused_total = timedelta()
+    def _cmd(self, progress_fd):
+        return STUB_CMD
+
+def direct_start(log_dir):
+    '''Starts a job with the current Conversion.start(), returning the
+       startup time and the RSS of its helper processes (there are none)'''
+    conversion = StubConversion(log_dir)
+    started = perf_counter()
+    conversion.start()
+    elapsed = perf_counter() - started
+    helpers = [pid for pid in children(getpid()) if pid != conversion.ffmpeg.pid]
+    rss = sum(rss_kib(pid) for pid in helpers)
+    conversion.result()
+    return elapsed, rss
+
+def summarize(samples):
+    '''Returns the mean startup time in milliseconds and mean helper RSS in KiB'''
+    return {'startup_ms': 1000.0 * sum(s[0] for s in samples) / len(samples),
+            'helper_rss_kib': sum(s[1] for s in samples) / len(samples)}
+
+def main():
+    '''Runs both variants and prints the results as JSON'''
+    parser = ArgumentParser(description='Benchmarks per-job conversion startup overhead')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Jobs to start per variant')
+    args = parser.parse_args()
+    with TemporaryDirectory() as log_dir:
+        print(dumps({'legacy': summarize([legacy_start() for _ in range(args.runs)]),
+                     'direct': summarize([direct_start(log_dir) for _ in range(args.runs)])},
+                    indent=2))
+
+if __name__ == '__main__':
+    main()
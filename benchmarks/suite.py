@@ -0,0 +1,222 @@
+'''Measures the throughput of the scanner, the probe backends, conversion
+   startup and the whole worker pool on synthetic media trees and prints
+   the results as JSON so they can be compared across commits:
+
+       python benchmarks/suite.py --files 2000 --output results.json
+
+   By default stub mediainfo/ffprobe/ffmpeg executables stand in for the
+   real ones so only the orchestration is measured, --real renders lavfi
+   clips and uses the installed tools instead. --profile captures a
+   cProfile (or pyinstrument) profile of every benchmark next to --output,
+   or in the current directory without it.'''
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout, contextmanager
+from json import dumps
+from os import devnull, environ, remove, getcwd
+from os.path import dirname, abspath, join
+from platform import python_version
+from subprocess import check_output, SubprocessError, DEVNULL
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+# pylint: disable=wrong-import-position
+from converter import Conversion, Converter, conversion_paths
+from jobqueue import JobQueue
+from mediainfo import MediaInfo
+from probecache import ProbeCache
+from scanner import IncrementalScanner
+from utils import is_media_file
+from workerpool import WorkerPool
+from synthetic import install_stubs, make_tree, render_clip, STUB_ENCODE_SECONDS
+
+class Profiler(object):
+    '''Wraps each benchmark in an optional cProfile or pyinstrument capture,
+       writing one profile per benchmark into directory'''
+    def __init__(self, kind=None, directory=None):
+        self.kind = kind
+        self.directory = directory
+
+    @contextmanager
+    def capture(self, name):
+        '''Profiles the body of the with statement if profiling is enabled'''
+        if self.kind == 'cprofile':
+            from cProfile import Profile
+            profile = Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(join(self.directory, name + '.prof'))
+        elif self.kind == 'pyinstrument':
+            from pyinstrument import Profiler as Instrument
+            profile = Instrument()
+            profile.start()
+            try:
+                yield
+            finally:
+                profile.stop()
+                with open(join(self.directory, name + '.html'), 'w') as report:
+                    report.write(profile.output_html())
+        else:
+            yield
+
+def rate(count, seconds):
+    '''Returns count per second, guarding against a zero duration'''
+    return count / seconds if seconds > 0 else float('inf')
+
+def bench_scan(root, files):
+    '''Files per second for a cold scan and for a rescan of the unchanged tree'''
+    scanner = IncrementalScanner(root, is_media_file)
+    started = perf_counter()
+    scanner.scan()
+    cold = perf_counter() - started
+    started = perf_counter()
+    scanner.scan()
+    warm = perf_counter() - started
+    started = perf_counter()
+    scanner.scan(full=True)
+    full = perf_counter() - started
+    return {'cold_files_per_sec': rate(files, cold),
+            'rescan_files_per_sec': rate(files, warm),
+            'full_rescan_files_per_sec': rate(files, full)}
+
+def bench_probe(file_paths, backend, state_dir, samples):
+    '''Probes per second one file at a time, in batches, and from a warm ProbeCache'''
+    sample = file_paths[:samples]
+    started = perf_counter()
+    for file_path in sample:
+        MediaInfo(file_path, backend=backend)
+    single = perf_counter() - started
+    cache = ProbeCache(join(state_dir, 'probes.sqlite'))
+    started = perf_counter()
+    MediaInfo.batch(sample, cache, backend)
+    batched = perf_counter() - started
+    started = perf_counter()
+    MediaInfo.batch(sample, cache, backend)
+    cached = perf_counter() - started
+    cache.close()
+    return {'single_probes_per_sec': rate(len(sample), single),
+            'batch_probes_per_sec': rate(len(sample), batched),
+            'cached_probes_per_sec': rate(len(sample), cached)}
+
+def bench_start(file_paths, samples):
+    '''Milliseconds spent constructing a Conversion (which probes the
+       source) and in Conversion.start() until ffmpeg is running'''
+    init_total = start_total = 0.0
+    sample = file_paths[:samples]
+    for file_path in sample:
+        dst_file_path, _, log_file_path = conversion_paths(file_path)
+        started = perf_counter()
+        conversion = Conversion(file_path, dst_file_path, log_file_path)
+        init_total += perf_counter() - started
+        started = perf_counter()
+        conversion.start()
+        start_total += perf_counter() - started
+        conversion.result()
+        remove(dst_file_path)
+    return {'init_ms': 1000.0 * init_total / len(sample),
+            'start_ms': 1000.0 * start_total / len(sample)}
+
+def bench_pool(file_paths, workers, state_dir):
+    '''Files per hour converted by a WorkerPool of the given size, counting
+       every finished job as well as only the successful ones'''
+    queue = JobQueue(join(state_dir, 'jobs-{}.sqlite'.format(workers)))
+    pool = WorkerPool(workers, lambda: Converter(verbose=False), queue)
+    started = perf_counter()
+    queue.push(file_paths)
+    finished = succeeded = 0
+    while finished < len(file_paths):
+        for _, result in pool.completed():
+            finished += 1
+            succeeded += 1 if result else 0
+        sleep(0.05)
+    elapsed = perf_counter() - started
+    pool.stop()
+    queue.close()
+    return {'workers': workers,
+            'files_per_hour': 3600 * rate(finished, elapsed),
+            'successful_files_per_hour': 3600 * rate(succeeded, elapsed)}
+
+def commit():
+    '''Returns the current git commit of the repository, if there is one'''
+    try:
+        return check_output(['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)),
+                            stderr=DEVNULL).decode().strip()
+    except (OSError, SubprocessError):
+        return None
+
+def run(args, workdir):
+    '''Runs the selected benchmarks with their files in workdir and returns the results'''
+    clip = None
+    if args.real:
+        clip = join(workdir, 'clip.mkv')
+        render_clip(clip)
+    else:
+        install_stubs(join(workdir, 'bin'))
+        environ[STUB_ENCODE_SECONDS] = str(args.encode_seconds)
+    profiler = Profiler(args.profile, dirname(abspath(args.output)) if args.output else getcwd())
+
+    results = {}
+    with open(devnull, 'w') as quiet, redirect_stdout(quiet):
+        if 'scan' in args.only:
+            make_tree(join(workdir, 'scan'), args.files, args.depth, args.fanout, clip)
+            with profiler.capture('scan'):
+                results['scan'] = bench_scan(join(workdir, 'scan'), args.files)
+        if 'probe' in args.only:
+            probe_files = make_tree(join(workdir, 'probe'), args.probes, 1, args.fanout, clip)
+            with profiler.capture('probe'):
+                results['probe'] = bench_probe(probe_files, args.backend, workdir, args.probes)
+        if 'start' in args.only:
+            start_files = make_tree(join(workdir, 'start'), args.starts, 0, 1, clip)
+            with profiler.capture('start'):
+                results['start'] = bench_start(start_files, args.starts)
+        if 'pool' in args.only:
+            results['pool'] = []
+            for workers in args.workers:
+                pool_files = make_tree(join(workdir, 'pool-{}'.format(workers)), args.jobs,
+                                       1, args.fanout, clip)
+                with profiler.capture('pool-{}'.format(workers)):
+                    results['pool'].append(bench_pool(pool_files, workers, workdir))
+    return results
+
+def main():
+    '''Builds the synthetic trees, runs the selected benchmarks and prints JSON'''
+    parser = ArgumentParser(description='Benchmarks scan, probe and conversion throughput')
+    parser.add_argument('--files', type=int, default=1000, help='Media files in the scan tree')
+    parser.add_argument('--depth', type=int, default=2, help='Depth of the directory tree')
+    parser.add_argument('--fanout', type=int, default=4, help='Subdirectories per directory')
+    parser.add_argument('--probes', type=int, default=100, help='Files to probe')
+    parser.add_argument('--starts', type=int, default=10, help='Conversions to start')
+    parser.add_argument('--jobs', type=int, default=20,
+                        help='Files to convert per end-to-end run')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='Worker pool sizes for the end-to-end runs')
+    parser.add_argument('--encode-seconds', type=float, default=0.5,
+                        help='How long the stub ffmpeg takes per file')
+    parser.add_argument('--backend', choices=['mediainfo', 'ffprobe'], default='mediainfo')
+    parser.add_argument('--real', action='store_true',
+                        help='Use lavfi clips and the installed ffmpeg/mediainfo')
+    parser.add_argument('--only', nargs='+', choices=['scan', 'probe', 'start', 'pool'],
+                        default=['scan', 'probe', 'start', 'pool'])
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'],
+                        help='Capture a profile of every benchmark')
+    parser.add_argument('-o', '--output', type=str, help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    with TemporaryDirectory(prefix='auto-converter-bench-') as workdir:
+        results = run(args, workdir)
+
+    report = dumps({'commit': commit(), 'python': python_version(), 'real': args.real,
+                    'params': {key: value for key, value in vars(args).items()
+                               if key not in ('output', 'only')},
+                    'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + '\n')
+    print(report)
+
+if __name__ == '__main__':
+    main()
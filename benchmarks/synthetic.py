@@ -0,0 +1,124 @@
+'''Generates synthetic media trees for the benchmarks, either of placeholder
+   files that are described by stub mediainfo/ffprobe/ffmpeg executables or
+   of real clips rendered from ffmpeg's lavfi test sources'''
+import os
+import sys
+from os import makedirs, chmod
+from os.path import join
+from shutil import copyfile
+from subprocess import check_call, DEVNULL
+
+EXTENSIONS = ['.mkv', '.avi', '.mov', '.wmv']
+
+# the stubs read these so the benchmarks can shape their behaviour
+STUB_ENCODE_SECONDS = 'AUTO_CONVERTER_STUB_ENCODE_SECONDS'
+STUB_OUTPUT_SIZE = 20000
+
+STUB_MEDIAINFO = '''#!{python}
+import json, os, sys
+def describe(path):
+    sd = path.endswith('.converting.mp4')
+    return {{'media': {{'@ref': path, 'track': [
+        {{'@type': 'General', 'Format': 'Matroska', 'Duration': '60.000',
+          'FileSize': str(os.path.getsize(path)), 'OverallBitRate': '4000000'}},
+        {{'@type': 'Video', 'Format': 'AVC', 'Width': '720' if sd else '1920',
+          'Height': '480' if sd else '1080', 'Duration': '60.000', 'FrameCount': '1500'}},
+        {{'@type': 'Audio', 'Format': 'AAC', 'BitRate': '160000' if sd else '320000',
+          'Channels': '2'}}]}}}}
+paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+documents = [describe(path) for path in paths if os.path.isfile(path)]
+if not documents:
+    sys.exit(1)
+print(json.dumps(documents[0] if len(documents) == 1 else documents))
+'''
+
+STUB_FFPROBE = '''#!{python}
+import json, os, sys
+path = sys.argv[-1]
+if not os.path.isfile(path):
+    sys.exit(1)
+sd = path.endswith('.converting.mp4')
+print(json.dumps({{
+    'format': {{'format_name': 'matroska,webm', 'duration': '60.000',
+                'size': str(os.path.getsize(path)), 'bit_rate': '4000000'}},
+    'streams': [{{'codec_type': 'video', 'codec_name': 'h264',
+                  'width': 720 if sd else 1920, 'height': 480 if sd else 1080,
+                  'nb_frames': '1500'}},
+                {{'codec_type': 'audio', 'codec_name': 'aac',
+                  'bit_rate': '160000' if sd else '320000', 'channels': 2}}]}}))
+'''
+
+STUB_FFMPEG = '''#!{python}
+import os, sys, time
+args = sys.argv[1:]
+seconds = float(os.environ.get('{encode_env}', '0'))
+progress = None
+if '-progress' in args:
+    target = args[args.index('-progress') + 1]
+    if target.startswith('pipe:'):
+        progress = os.fdopen(int(target[5:]), 'w')
+steps = 4
+for step in range(1, steps + 1):
+    time.sleep(seconds / steps)
+    if progress:
+        progress.write('frame={{}}\\nout_time_us={{}}\\ntotal_size={{}}\\nprogress={{}}\\n'.format(
+            step * 375, step * 15000000, step * {size} // steps,
+            'end' if step == steps else 'continue'))
+        progress.flush()
+# just enough of an mp4 for the verification to accept it
+def box(kind, payload):
+    return (8 + len(payload)).to_bytes(4, 'big') + kind + payload
+def hdlr(handler):
+    return box(b'hdlr', bytes(8) + handler + bytes(12))
+head = box(b'ftyp', b'isom' + bytes(4)) + box(b'moov', hdlr(b'vide') + hdlr(b'soun'))
+with open(args[-1], 'wb') as output:
+    output.write(head + box(b'mdat', bytes({size} - len(head) - 8)))
+'''
+
+def install_stubs(bin_dir):
+    '''Writes stub mediainfo, ffprobe and ffmpeg executables into bin_dir and
+       puts it at the front of the PATH so that they shadow the real ones'''
+    makedirs(bin_dir, exist_ok=True)
+    for name, template in (('mediainfo', STUB_MEDIAINFO), ('ffprobe', STUB_FFPROBE),
+                           ('ffmpeg', STUB_FFMPEG)):
+        stub_path = join(bin_dir, name)
+        with open(stub_path, 'w') as stub_file:
+            stub_file.write(template.format(python=sys.executable, encode_env=STUB_ENCODE_SECONDS,
+                                            size=STUB_OUTPUT_SIZE))
+        chmod(stub_path, 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+def render_clip(file_path, duration=2, size='1280x720'):
+    '''Renders a short clip with a test pattern and a sine tone using the
+       real ffmpeg, larger than SD so that it needs converting'''
+    check_call(['ffmpeg', '-nostats', '-y',
+                '-f', 'lavfi', '-i', 'testsrc=size={}:rate=25:duration={}'.format(size, duration),
+                '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration),
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-b:a', '320k',
+                '-shortest', file_path], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+def directories(root, depth, fanout):
+    '''Returns the leaf directories of a tree of the given depth where each
+       directory has fanout subdirectories'''
+    level = [root]
+    for _ in range(depth):
+        level = [join(parent, 'dir{:03d}'.format(i)) for parent in level for i in range(fanout)]
+    return level
+
+def make_tree(root, files, depth=2, fanout=4, clip=None):
+    '''Spreads the given number of media files over the leaves of a
+       directory tree and returns their paths. Files are copies of clip if
+       one is given, otherwise placeholders of varying size for the stubs.'''
+    leaves = directories(root, depth, fanout)
+    file_paths = []
+    for index in range(files):
+        leaf = leaves[index % len(leaves)]
+        makedirs(leaf, exist_ok=True)
+        file_path = join(leaf, 'media{:06d}{}'.format(index, EXTENSIONS[index % len(EXTENSIONS)]))
+        if clip:
+            copyfile(clip, file_path)
+        else:
+            with open(file_path, 'wb') as media_file:
+                media_file.write(bytes(1024 + index % 97 * 64))
+        file_paths.append(file_path)
+    return file_paths
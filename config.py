@@ -0,0 +1,209 @@
+'''Loads the libraries and their encoding profiles from a config.ini file'''
+from configparser import ConfigParser
+from os.path import join, relpath, splitext, dirname, isfile
+
+from constants import HEIGHT, WIDTH, BITRATES
+
+class ConfigError(Exception):
+    '''Exception that indicates an invalid configuration file'''
+    pass
+
+class EncodingProfile(object):
+    '''The SD format a library is converted to. max_audio_bitrate is in kb/s,
+       crf and preset are passed to libx264 when set. When min_ssim is set
+       the crf and preset are instead picked per source by trial encodes
+       that have to keep at least that SSIM.'''
+    __slots__ = ('max_width', 'max_height', 'max_audio_bitrate', 'audio_codec', 'crf', 'preset',
+                 'min_ssim')
+    def __init__(self, max_width=WIDTH, max_height=HEIGHT, max_audio_bitrate=max(BITRATES),
+                 audio_codec='mp3', crf=None, preset=None, min_ssim=None):
+        self.max_width = max_width
+        self.max_height = max_height
+        self.max_audio_bitrate = max_audio_bitrate
+        self.audio_codec = audio_codec
+        self.crf = crf
+        self.preset = preset
+        self.min_ssim = min_ssim
+
+DEFAULT_PROFILE = EncodingProfile()
+
+class ResourcePolicy(object):
+    '''How much of the host a library's conversions may use. nice and the
+       ionice class ('idle', 'best-effort' or 'realtime') and level apply to
+       every ffmpeg process and threads is its -threads. cpu_max in CPUs,
+       io_max in bytes per second of reads and of writes and memory_max in
+       bytes are enforced by a cgroup per conversion where cgroup v2 can be
+       written to. Limits that are None aren't applied.'''
+    __slots__ = ('nice', 'ionice', 'ionice_level', 'threads', 'cpu_max', 'io_max', 'memory_max')
+    def __init__(self, nice=None, ionice=None, ionice_level=None, threads=None, cpu_max=None,
+                 io_max=None, memory_max=None):
+        self.nice = nice
+        self.ionice = ionice
+        self.ionice_level = ionice_level
+        self.threads = threads
+        self.cpu_max = cpu_max
+        self.io_max = io_max
+        self.memory_max = memory_max
+
+    def to_dict(self):
+        '''Returns the policy as a dict that can be serialized to JSON'''
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+DEFAULT_RESOURCES = ResourcePolicy()
+IONICE_CLASSES = ('realtime', 'best-effort', 'idle')
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size(size):
+    '''Parses a number of bytes with an optional K, M, G or T suffix'''
+    size = size.strip().lower()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+def parse_resources(options, base=DEFAULT_RESOURCES):
+    '''Returns a copy of the base ResourcePolicy with the limits that a
+       mapping of option names to strings sets, such as a config section.
+       An empty value or "max" removes a limit.'''
+    parsers = {'nice': int, 'threads': int, 'cpu_max': float, 'io_max': parse_size,
+               'memory_max': parse_size}
+    limits = base.to_dict()
+    try:
+        for name, parse in parsers.items():
+            if name in options:
+                value = options[name].strip()
+                limits[name] = parse(value) if value and value != 'max' else None
+        if 'ionice' in options:
+            ionice, _, level = options['ionice'].strip().lower().partition(':')
+            if ionice and ionice not in IONICE_CLASSES:
+                raise ValueError('unknown ionice class {}'.format(ionice))
+            limits['ionice'] = ionice or None
+            limits['ionice_level'] = int(level) if level else None
+    except ValueError as error:
+        raise ConfigError('Invalid resource limit: {}'.format(error))
+    return ResourcePolicy(**limits)
+
+class Rendition(object):
+    '''An extra, smaller output of a library that is encoded from the same
+       decode of the source as the main output, with the given profile'''
+    __slots__ = ('name', 'profile')
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+
+class Library(object):
+    '''A watched input directory along with the directories that converted
+       files, completed sources and failed sources are moved to. When an
+       output directory isn't set files are converted in place, and when
+       the completed directory isn't set sources are deleted once converted.
+       Its conversions run under the limits of its ResourcePolicy.'''
+    def __init__(self, name, input_directory, output_directory=None, completed_directory=None,
+                 error_directory=None, weight=1.0, profile=DEFAULT_PROFILE, renditions=(),
+                 resources=DEFAULT_RESOURCES):
+        self.name = name
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.completed_directory = completed_directory
+        self.error_directory = error_directory
+        self.weight = weight
+        self.profile = profile
+        self.renditions = list(renditions)
+        self.resources = resources
+
+    def _relocate(self, file_path, directory):
+        '''Returns where a file from the input directory goes in another directory'''
+        return join(directory, relpath(file_path, self.input_directory))
+
+    def output_path(self, src_file_path):
+        '''Returns the path of the converted file for a source'''
+        base = splitext(src_file_path)[0] + '.mp4'
+        return self._relocate(base, self.output_directory) if self.output_directory else base
+
+    def completed_path(self, src_file_path):
+        '''Returns where a converted source is moved to, or None to delete it'''
+        if self.completed_directory:
+            return self._relocate(src_file_path, self.completed_directory)
+        return None
+
+    def error_path(self, src_file_path):
+        '''Returns where a source that can't be converted is moved to, or None to leave it'''
+        if self.error_directory:
+            return self._relocate(src_file_path, self.error_directory)
+        return None
+
+    def contains(self, file_path):
+        '''Returns True if a file is inside this library's input directory'''
+        return not relpath(file_path, self.input_directory).startswith('..')
+
+def _profile(section):
+    '''Reads the encoding profile options of a config section'''
+    try:
+        return EncodingProfile(section.getint('max_width', WIDTH),
+                               section.getint('max_height', HEIGHT),
+                               section.getint('max_audio_bitrate', max(BITRATES)),
+                               section.get('audio_codec', 'mp3'),
+                               section.getint('crf'),
+                               section.get('preset'),
+                               section.getfloat('min_ssim'))
+    except ValueError as error:
+        raise ConfigError('Invalid encoding profile in [{}]: {}'.format(section.name, error))
+
+def _renditions(section, profile):
+    '''Reads a comma separated list of name:WIDTHxHEIGHT:AUDIO_KBPS renditions,
+       which share the audio codec, crf and preset of the library's profile
+       and can't be any larger than its main output'''
+    renditions = []
+    for spec in section.get('renditions', '').split(','):
+        if not spec.strip():
+            continue
+        try:
+            name, size, audio_bitrate = [part.strip() for part in spec.split(':')]
+            width, height = [int(dimension) for dimension in size.lower().split('x')]
+            rendition_profile = EncodingProfile(width, height, int(audio_bitrate),
+                                                profile.audio_codec, profile.crf, profile.preset)
+        except ValueError:
+            raise ConfigError('Invalid rendition in [{}]: {}'.format(section.name, spec))
+        if width > profile.max_width or height > profile.max_height:
+            raise ConfigError('Rendition {} in [{}] is larger than the {}x{} output'
+                              .format(name, section.name, profile.max_width, profile.max_height))
+        renditions.append(Rendition(name, rendition_profile))
+    return renditions
+
+def load_config(config_path):
+    '''Returns the list of Libraries defined by the sections of a config file'''
+    parser = ConfigParser()
+    if not parser.read(config_path):
+        raise ConfigError('Unable to read {}'.format(config_path))
+    libraries = []
+    for name in parser.sections():
+        section = parser[name]
+        if 'input_directory' not in section:
+            raise ConfigError('[{}] has no input_directory'.format(name))
+        try:
+            weight = section.getfloat('weight', 1.0)
+        except ValueError:
+            raise ConfigError('Invalid weight in [{}]'.format(name))
+        profile = _profile(section)
+        try:
+            resources = parse_resources(section)
+        except ConfigError as error:
+            raise ConfigError('{} in [{}]'.format(error, name))
+        libraries.append(Library(name, section['input_directory'],
+                                 section.get('output_directory'),
+                                 section.get('completed_directory'),
+                                 section.get('error_directory'),
+                                 weight, profile, _renditions(section, profile), resources))
+    if not libraries:
+        raise ConfigError('{} does not define any libraries'.format(config_path))
+    return libraries
+
+def state_directory(config_path):
+    '''Returns the directory that the service keeps its state files in'''
+    return dirname(config_path) or '.'
+
+def load_libraries(to_scan):
+    '''Returns the libraries to convert and the directory to keep the state
+       in, either from a config file or for a single directory whose files
+       are converted in place'''
+    if isfile(to_scan):
+        return load_config(to_scan), state_directory(to_scan)
+    return [Library('', to_scan)], to_scan
@@ -4,7 +4,46 @@ RETRY_LIMIT = 5
 HEIGHT = 640
 WIDTH = 1136
 BITRATES = [56, 64, 80, 96, 112, 128, 160, 192]
-BITRATE_KEYS = ["Bit rate", "Maximum bit rate"]
-AUDIO_KEYS = ["Audio", "Audio #1"]
 VIDEO_FILE_EXTENSIONS = ['.mp4', '.mkv', '.avi', '.wmv', '.flv', '.mpg',
                          '.mpeg', '.ts', '.m4v']
+PROBE_CACHE_FILE = '.auto-converter-probes.sqlite'
+PROBE_CACHE_SIZE = 100000
+WATCH_DEBOUNCE = 0.5
+RECONCILE_INTERVAL = 600
+JOB_QUEUE_FILE = '.auto-converter-jobs.sqlite'
+GOVERNOR_INTERVAL = 5
+GOVERNOR_RESUME_RATIO = 0.8
+PROBE_BACKEND = 'mediainfo'
+PROBE_BATCH_SIZE = 64
+METRICS_INTERVAL = 15
+LEASE_DURATION = 60
+CLAIM_WAIT = 10
+REFUSED_RECHECK = 300
+STAGE_CHUNK_SIZE = 16 * 1024 * 1024
+SPACE_MARGIN = 1.2
+SPACE_RESERVE = 1024 ** 3
+SPACE_RECHECK = 60
+TARGET_VIDEO_BITRATE = 1500
+MODEL_SMOOTHING = 0.2
+CONTROL_SOCKET = '.auto-converter.sock'
+COST_MODEL_FILE = '.auto-converter-costs.sqlite'
+DEADLINE_STRETCH = 4
+FINGERPRINT_FILE = '.auto-converter-fingerprints.sqlite'
+FINGERPRINT_BLOCK = 64 * 1024
+FINGERPRINT_BLOCKS = 5
+TRIAL_CACHE_FILE = '.auto-converter-trials.sqlite'
+TRIAL_CRFS = [20, 23, 26, 28]
+TRIAL_PRESETS = ['veryfast', 'medium']
+TRIAL_SAMPLES = 3
+TRIAL_SECONDS = 4
+TRIAL_SIZE_TOLERANCE = 0.05
+MIN_OUTPUT_SIZE = 10000
+VERIFY_TOLERANCE = 0.02
+VERIFY_MIN_SLACK = 2.0
+MOOV_READ_LIMIT = 64 * 1024 ** 2
+VERIFY_WORKERS = 2
+REPORT_WORKERS = 16
+CGROUP_MOUNT = '/sys/fs/cgroup'
+CGROUP_SERVICE = 'service'
+CGROUP_CONTROLLERS = ['cpu', 'io', 'memory']
+CPU_PERIOD = 100000
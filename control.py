@@ -0,0 +1,166 @@
+'''A Unix domain socket API for submitting files to, and controlling, a
+   running conversion service, along with the client for it. The client
+   half only uses the standard library so that it starts quickly.'''
+import json
+import socket
+from os import environ, remove
+from os.path import abspath, dirname, exists, join, isfile, relpath
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from threading import Thread
+
+from constants import CONTROL_SOCKET
+from utils import is_media_file
+
+SOCKET_ENV = 'AUTO_CONVERTER_SOCKET'
+
+class ControlError(Exception):
+    '''Exception that indicates the service couldn't be reached or refused a request'''
+    pass
+
+def find_socket(file_paths=()):
+    '''Returns the control socket to use: the one named by the environment,
+       or the first one found in the directories above the given files'''
+    if environ.get(SOCKET_ENV):
+        return environ[SOCKET_ENV]
+    for file_path in file_paths:
+        directory = dirname(abspath(file_path))
+        while True:
+            socket_path = join(directory, CONTROL_SOCKET)
+            if exists(socket_path):
+                return socket_path
+            if dirname(directory) == directory:
+                break
+            directory = dirname(directory)
+    return None
+
+def request(socket_path, command, **arguments):
+    '''Sends a single command to the service and returns its response'''
+    arguments['command'] = command
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(arguments).encode('UTF-8') + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        response = b''.join(iter(lambda: client.recv(65536), b''))
+    except OSError as error:
+        raise ControlError('Unable to reach the service at {}: {}'.format(socket_path, error))
+    finally:
+        client.close()
+    try:
+        response = json.loads(response)
+    except ValueError:
+        raise ControlError('Invalid response from the service at {}'.format(socket_path))
+    if 'error' in response:
+        raise ControlError(response['error'])
+    return response
+
+class _ControlHandler(StreamRequestHandler):
+    '''Reads a request, runs its command on the ControlServer and writes the response'''
+    def handle(self):
+        try:
+            arguments = json.loads(self.rfile.readline())
+            command = self.server.control.commands[arguments.pop('command')]
+            response = command(**arguments)
+        except (ValueError, KeyError, TypeError) as error:
+            response = {'error': 'Invalid request: {}'.format(error)}
+        self.wfile.write(json.dumps(response).encode('UTF-8') + b'\n')
+
+class ControlServer(object):
+    '''Serves the control API on a Unix domain socket. Each connection
+       sends one JSON request terminated by a newline and receives one JSON
+       response. pool is the WorkerPool (or Coordinator) whose queue jobs
+       are submitted to and libraries maps library names to Libraries.
+       resources are the ResourceLimits of the pool's conversions, if any.'''
+    def __init__(self, socket_path, pool, libraries, resources=None):
+        self.socket_path = socket_path
+        self.pool = pool
+        self.libraries = libraries
+        self.resources = resources
+        self.commands = {'submit': self.submit, 'status': self.status, 'cancel': self.cancel,
+                         'pause': self.pause, 'resume': self.resume,
+                         'reprioritize': self.reprioritize, 'limits': self.limits}
+        if exists(socket_path):
+            remove(socket_path)
+        self.server = ThreadingUnixStreamServer(socket_path, _ControlHandler)
+        self.server.daemon_threads = True
+        self.server.control = self
+
+    def start(self):
+        '''Serves requests in a daemon thread'''
+        Thread(target=self.server.serve_forever, daemon=True, name='control-server').start()
+
+    def stop(self):
+        '''Stops serving and removes the socket'''
+        self.server.shutdown()
+        self.server.server_close()
+        if exists(self.socket_path):
+            remove(self.socket_path)
+
+    def _locate(self, file_path):
+        '''Returns the name of the library a file belongs to along with the
+           path the file has in the queue, or (None, file_path) if it isn't
+           in any library'''
+        file_path = abspath(file_path)
+        for name, library in self.libraries.items():
+            if library.contains(file_path):
+                return name, join(library.input_directory,
+                                  relpath(file_path, abspath(library.input_directory)))
+        return None, file_path
+
+    def submit(self, paths, priority=None):
+        '''Queues files for conversion, each under the library it's in'''
+        by_library, rejected = {}, []
+        for file_path in paths:
+            name, file_path = self._locate(file_path)
+            if name is None or not isfile(file_path) or not is_media_file(file_path):
+                rejected.append(file_path)
+            else:
+                by_library.setdefault(name, []).append(file_path)
+        queued = 0
+        for name, file_paths in by_library.items():
+            queued += self.pool.queue.push(file_paths, name)
+            if priority is not None:
+                self.pool.queue.reprioritize(file_paths, float(priority))
+        return {'queued': queued, 'rejected': rejected}
+
+    def status(self):
+        '''Returns the number of jobs per status and what the workers are doing'''
+        counts = self.pool.queue.counts()
+        return {'jobs': {status.name.lower(): count for status, count in counts.items()},
+                'workers': self.pool.status()}
+
+    def cancel(self, paths):
+        '''Drops waiting jobs for the given files and stops running ones'''
+        file_paths = [self._locate(file_path)[1] for file_path in paths]
+        self.pool.queue.discard(file_paths)
+        stopped = [file_path for file_path in file_paths if self.pool.cancel(file_path)]
+        return {'stopped': stopped}
+
+    def pause(self):
+        '''Pauses all conversions'''
+        self.pool.pause()
+        return {}
+
+    def resume(self):
+        '''Resumes all conversions'''
+        self.pool.resume()
+        return {}
+
+    def reprioritize(self, paths, priority):
+        '''Changes the priority of waiting jobs, lower values go first'''
+        file_paths = [self._locate(file_path)[1] for file_path in paths]
+        return {'updated': self.pool.queue.reprioritize(file_paths, float(priority))}
+
+    def limits(self, library, changes):
+        '''Changes the resource limits of a library's conversions, including
+           the running ones, given as option names and values like in the
+           config file'''
+        from config import ConfigError
+        if self.resources is None:
+            return {'error': 'Only the limits of local conversions can be changed'}
+        if library not in self.libraries:
+            return {'error': 'Unknown library {}'.format(library)}
+        try:
+            return {'policy': self.resources.update(library, changes).to_dict()}
+        except ConfigError as error:
+            return {'error': str(error)}
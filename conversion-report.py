@@ -0,0 +1,51 @@
+'''Lists the files of a directory, or of the libraries defined in a config
+   file, by what became of them and acts on the ones that failed'''
+import sys
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from os.path import join, isfile
+from config import load_libraries, ConfigError
+from constants import JOB_QUEUE_FILE, CONTROL_SOCKET
+from control import find_socket
+from jobqueue import JobQueue
+from report import SUCCESSFUL, FAILED, PENDING, IN_PROGRESS
+from report import from_queue, from_walk, write_csv, write_json, summary, reset_errors, move_failed
+from utils import process_utils_args
+
+def main():
+    '''Processes commandline arguments and writes the report to stdout, and
+       the totals and what the actions did to stderr'''
+    args = process_utils_args()
+    try:
+        libraries, state_dir = load_libraries(args.directory)
+    except ConfigError as error:
+        print(error)
+        return
+    libraries = OrderedDict((library.name, library) for library in libraries)
+    queue_path = join(state_dir, JOB_QUEUE_FILE)
+    queue = JobQueue(queue_path) if isfile(queue_path) else None
+    if queue is not None and not args.scan:
+        entries = from_queue(queue, libraries, args.workers)
+    else:
+        entries = from_walk(libraries, args.workers)
+    states = [state for state, listed in ((SUCCESSFUL, args.list_successful),
+                                          (FAILED, args.list_failed),
+                                          (PENDING, args.list_pending),
+                                          (IN_PROGRESS, args.list_running)) if listed]
+    listed = [entry for entry in entries if not states or entry.state in states]
+    (write_json if args.format == 'json' else write_csv)(listed, sys.stdout)
+    with redirect_stdout(sys.stderr):
+        print(summary(entries))
+        if args.reset_errors:
+            if queue is None:
+                print("There is no job queue in {} to reset errors in".format(state_dir))
+            else:
+                socket_path = find_socket([join(state_dir, CONTROL_SOCKET)])
+                print("Queued {} failed files again".format(reset_errors(queue, entries,
+                                                                          socket_path)))
+        if args.move_failed is not None:
+            print("Moved {} failed files".format(move_failed(entries, libraries,
+                                                             args.move_failed or None)))
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,47 @@
-'''A conversion service that runs every X seconds to convert any
-   non-converted files in a given directory'''
-from os.path import splitext, join, isfile
-from os import walk
-from time import sleep
-from converter import Converter
-from constants import RETRY_LIMIT
-from mediainfo import MediaInfo
+'''A conversion service that watches a directory, or the libraries defined
+   in a config file, and converts any non-converted files in them'''
+from collections import OrderedDict
+from functools import partial
+from os.path import splitext, join, isfile, dirname
+from os import remove
+from time import sleep, monotonic
+from config import load_libraries, ConfigError, DEFAULT_PROFILE
+from converter import Converter, ConversionStatus, conversion_paths, rendition_path
+from admission import AdmissionControl
+from decisions import plan, ConversionPlan
+from distributed import Coordinator, find_token, TOKEN_ENV
+from governor import LoadGovernor
+from constants import RETRY_LIMIT, PROBE_CACHE_FILE, JOB_QUEUE_FILE, PROBE_BACKEND
+from constants import CONTROL_SOCKET, COST_MODEL_FILE, FINGERPRINT_FILE, TRIAL_CACHE_FILE
+from control import ControlServer
+from costmodel import CostModel
+from dedup import Deduplicator
+from jobqueue import JobQueue
+from mediainfo import MediaInfo, MediaInfoError
+from metrics import METRICS, serve_metrics, SnapshotWriter
+from probecache import ProbeCache
+from resources import ResourceLimits, Cgroups
+from scanner import IncrementalScanner
+from segments import SegmentedConversion
+from staging import ScratchStage
+from trials import TrialSearch
+from verify import Verifier
+from watcher import DirectoryWatcher, poll_watchers
+from workerpool import WorkerPool, pool_size
 from utils import is_media_file, process_converter_service_args
 
-def num_errors(error_file_path):
-    '''Returns the number of errors for a particular file based
-       on their error file'''
-    if isfile(error_file_path):
-        with open(error_file_path, 'r') as error_file:
-            contents = error_file.read()
-            try:
-                counter = int(contents) + 1
-            except: # pylint: disable=bare-except
-                counter = 1
-            return counter
-    else:
-        return 0
-
-def should_convert(to_convert_path):
+def should_convert(to_convert_path, cache=None, queue=None, backend=PROBE_BACKEND,
+                   profile=DEFAULT_PROFILE, search=None):
     '''Given a path this function indicates whether the file should be
        converted. Includes a check of whether its a video file, a check
        to make sure that its not currently being converted, and a check
        of the metadata to make sure it hasn't already been converted to
-       an SD format'''
+       the profile's SD format. Media info is looked up in the given
+       ProbeCache and failed attempts in the given JobQueue, if any, and
+       files that a TrialSearch found not worth converting are left alone'''
     def is_not_buggy(file_path):
         '''Checks that the number of errors for the file is under the limit'''
-        name, _ = splitext(file_path)
-        error_file = name + '.conversion.error'
-        if num_errors(error_file) > RETRY_LIMIT:
+        if queue is not None and queue.attempts(file_path) > RETRY_LIMIT:
             print("Too many errors with {}".format(file_path))
             return False
         return True
@@ -41,39 +50,193 @@ def should_convert(to_convert_path):
         # if file ends with '.converting.mp4' don't convert
         if to_convert_path.endswith('.converting.mp4'):
             return False
-        # if not an MP4 file, always convert
-        if splitext(to_convert_path)[1] != '.mp4':
-            return is_not_buggy(to_convert_path)
-        # otherwise, compare the metadata, convert if above SD
-        return is_not_buggy(to_convert_path) and MediaInfo(to_convert_path).more_than_sd()
+        # neither are the chunks of a segmented conversion
+        if dirname(to_convert_path).endswith('.segments'):
+            return False
+        if not is_not_buggy(to_convert_path):
+            return False
+        # otherwise, compare the metadata, convert unless it's already an SD mp4
+        try:
+            info = MediaInfo(to_convert_path, cache, backend)
+        except MediaInfoError:
+            print("Unable to read media info for {}".format(to_convert_path))
+            return False
+        if plan(info, splitext(to_convert_path)[1], profile) == ConversionPlan.SKIP or \
+           (search is not None and search.skipped(to_convert_path, profile)):
+            METRICS.inc('skipped')
+            return False
+        return True
     else:
         return False
 
-def scan_directory(dir_path):
-    '''Returns a list of files that should be converted'''
-    to_convert = []
-    do_not_convert = []
-    for root, _, files in walk(dir_path):
-        print("Scanning {}".format(root))
-        for file_name in files:
-            file_path = join(root, file_name)
-            if should_convert(file_path):
-                to_convert.append(file_path)
-            else:
-                do_not_convert.append(file_path)
-    print("{} files converted (or don't need to be), {} files left."\
-           .format(len(do_not_convert), len(to_convert)))
-    return to_convert
+def prefetch(file_paths, cache, backend):
+    '''Probes every media file among the given files in one batch, warming
+       the cache for the decisions that follow'''
+    MediaInfo.batch([file_path for file_path in file_paths
+                     if is_media_file(file_path) and not file_path.endswith('.converting.mp4')],
+                    cache, backend)
+
+def scan_directory(scanner, name='', full=False):
+    '''Incrementally rescans the scanner's directory and returns the
+       ScanDelta. A full scan lists every directory, which catches files
+       modified in place by comparing their sizes and mtimes.'''
+    with METRICS.timed('scan'):
+        delta = scanner.scan(full)
+    prefix = '[{}] '.format(name) if name else ''
+    if delta.new or delta.changed or delta.removed:
+        print("{}Scan found {} new, {} changed and {} removed candidates"\
+              .format(prefix, len(delta.new), len(delta.changed), len(delta.removed)))
+    print("{}{} files converted (or don't need to be), {} files left."\
+           .format(prefix, *scanner.summary()))
+    return delta
+
+def enqueue(queue, delta, library=''):
+    '''Pushes new and changed candidates of a ScanDelta into the job queue
+       and drops the ones that went away'''
+    if delta.new or delta.changed:
+        queue.push(delta.new + delta.changed, library)
+    if delta.removed:
+        queue.discard(delta.removed)
+
+def dispatch(scanners, pool):
+    '''Collects finished jobs from the pool and re-decides their sources'''
+    for job, _ in pool.completed():
+        scanner = scanners.get(job.library)
+        if scanner:
+            scanner.invalidate(job.path)
+            enqueue(pool.queue, scanner.refresh([job.path]), job.library)
+    METRICS.set('queue_depth', pool.queue.counts()[ConversionStatus.NONE])
+    METRICS.set('active_workers', pool.active())
+    METRICS.set('encode_speed', pool.encode_speed())
+    for line in pool.status():
+        print(line)
+
+def poll(scanners, pool, cache, reconcile_interval, interval=30):
+    '''Rescans the libraries every interval seconds, queueing any candidates,
+       and fully every reconcile_interval seconds'''
+    next_reconcile = 0
+    while True:
+        full = monotonic() >= next_reconcile
+        if full:
+            next_reconcile = monotonic() + reconcile_interval
+        for name, scanner in scanners.items():
+            enqueue(pool.queue, scan_directory(scanner, name, full), name)
+        cache.flush()
+        print("Probe cache: {hits} hits, {misses} misses, {entries} entries".format(**cache.stats()))
+        dispatch(scanners, pool)
+        sleep(interval)
+
+def watch(scanners, watchers, pool, cache, reconcile_interval, status_interval=30):
+    '''Queues files as soon as the watchers report them, only rescanning the
+       libraries fully every reconcile_interval seconds to catch any missed
+       events'''
+    next_reconcile = 0
+    while True:
+        reconcile = monotonic() >= next_reconcile
+        for name, scanner in scanners.items():
+            if reconcile or watchers[name].needs_rescan:
+                watchers[name].needs_rescan = False
+                enqueue(pool.queue, scan_directory(scanner, name, reconcile), name)
+        if reconcile:
+            cache.flush()
+            next_reconcile = monotonic() + reconcile_interval
+        dispatch(scanners, pool)
+        timeout = max(0, next_reconcile - monotonic())
+        if pool.active():
+            timeout = min(timeout, status_interval)
+        for name, settled in poll_watchers(watchers, timeout).items():
+            if settled:
+                delta = scanners[name].refresh(settled)
+                cache.flush()
+                enqueue(pool.queue, delta, name)
+                for file_path in delta.new + delta.changed:
+                    print("Picked up {}".format(file_path))
+
+def recover(queue, libraries):
+    '''Requeues jobs that were running when the service last stopped and
+       removes their half-written outputs'''
+    for file_path, library in queue.recover():
+        print("Recovering interrupted conversion of {}".format(file_path))
+        library = libraries.get(library)
+        converting_path = conversion_paths(file_path, library)[0]
+        renditions = library.renditions if library else []
+        for partial_path in [converting_path] + [rendition_path(converting_path, rendition)
+                                                 for rendition in renditions]:
+            if isfile(partial_path):
+                remove(partial_path)
 
 def main():
     '''Processes commandline arguments and starts the converter service'''
     args = process_converter_service_args()
-    converter = Converter()
-    while True:
-        to_convert = scan_directory(args.to_scan)
-        if to_convert:
-            converter.run_conversion(to_convert[0])
-        sleep(30)
+    token = find_token(args.token)
+    if args.serve and token is None:
+        print("Serving remote workers needs a shared --token or {}".format(TOKEN_ENV))
+        return
+    try:
+        libraries, state_dir = load_libraries(args.to_scan)
+    except ConfigError as error:
+        print(error)
+        return
+    libraries = OrderedDict((library.name, library) for library in libraries)
+    cache = ProbeCache(join(state_dir, PROBE_CACHE_FILE))
+    costs = CostModel(join(state_dir, COST_MODEL_FILE), cache, args.probe_backend)
+    queue = JobQueue(join(state_dir, JOB_QUEUE_FILE), args.priority,
+                     {name: library.weight for name, library in libraries.items()},
+                     lambda file_path, name: costs.estimate(file_path, libraries.get(name)))
+    recover(queue, libraries)
+    admission = None
+    if not args.no_space_check:
+        admission = AdmissionControl(cache=cache, backend=args.probe_backend,
+                                     scratch_dir=args.scratch_dir)
+    search = TrialSearch(ProbeCache(join(state_dir, TRIAL_CACHE_FILE)), args.threads,
+                         args.probe_backend)
+    verifier = Verifier(args.deep_verify, args.threads)
+    dedup = None
+    if not args.no_dedup:
+        dedup = Deduplicator(join(state_dir, FINGERPRINT_FILE), args.full_hash)
+    stage = None
+    if args.scratch_dir:
+        stage = ScratchStage(args.scratch_dir, int(args.scratch_budget * 1024 ** 3))
+    make_conversion = None
+    if args.segment_duration:
+        make_conversion = partial(SegmentedConversion, segment_duration=args.segment_duration,
+                                  parallel=args.segment_workers)
+    resources = None
+    if args.serve:
+        print("Serving jobs to remote workers on {}:{}".format(args.bind, args.serve))
+        pool = Coordinator(queue, args.serve, token, libraries, args.bind,
+                           lease_duration=args.lease_duration, costs=costs, dedup=dedup)
+    else:
+        resources = ResourceLimits(libraries, None if args.no_cgroups else Cgroups(args.cgroup))
+        pool = WorkerPool(pool_size(args.workers, args.threads),
+                          lambda: Converter(threads=args.threads, verbose=False,
+                                            make_conversion=make_conversion, stage=stage,
+                                            search=search, verifier=verifier,
+                                            resources=resources),
+                          queue, libraries, stage, admission, costs, dedup, args.verifiers)
+    ControlServer(join(state_dir, CONTROL_SOCKET), pool, libraries, resources).start()
+    if args.max_load or args.max_pressure or args.window:
+        LoadGovernor(pool, args.max_load, args.max_pressure, args.window).start()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    if args.metrics_file:
+        SnapshotWriter(args.metrics_file, args.metrics_interval).start()
+    scanners = OrderedDict()
+    for name, library in libraries.items():
+        scanners[name] = IncrementalScanner(
+            library.input_directory,
+            partial(should_convert, cache=cache, queue=queue, backend=args.probe_backend,
+                    profile=library.profile, search=search),
+            partial(prefetch, cache=cache, backend=args.probe_backend))
+    if not args.poll:
+        try:
+            watchers = {name: DirectoryWatcher(library.input_directory, accept=is_media_file)
+                        for name, library in libraries.items()}
+        except OSError as error:
+            print("Unable to watch the libraries, falling back to polling: {}".format(error))
+        else:
+            watch(scanners, watchers, pool, cache, args.reconcile_interval)
+    poll(scanners, pool, cache, args.reconcile_interval)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,45 @@
+'''A remote conversion worker that claims jobs from a conversion service
+   started with --serve and converts them'''
+from functools import partial
+
+from config import load_config, ConfigError
+from converter import Converter
+from distributed import RemoteWorker, find_token, TOKEN_ENV
+from probecache import ProbeCache
+from resources import ResourceLimits, Cgroups
+from segments import SegmentedConversion
+from trials import TrialSearch
+from verify import Verifier
+from utils import process_converter_worker_args
+
+def main():
+    '''Processes commandline arguments and starts claiming jobs'''
+    args = process_converter_worker_args()
+    token = find_token(args.token)
+    if token is None:
+        print("The coordinator's token has to be given with --token or {}".format(TOKEN_ENV))
+        return
+    libraries = {}
+    if args.config:
+        try:
+            libraries = {library.name: library for library in load_config(args.config)}
+        except ConfigError as error:
+            print(error)
+            return
+    make_conversion = None
+    if args.segment_duration:
+        make_conversion = partial(SegmentedConversion, segment_duration=args.segment_duration,
+                                  parallel=args.segment_workers)
+    # workers may share a directory, so each keeps its trial outcomes to itself
+    search = TrialSearch(ProbeCache(':memory:'), args.threads)
+    resources = ResourceLimits(libraries, None if args.no_cgroups else Cgroups(args.cgroup))
+    worker = RemoteWorker(args.coordinator,
+                          lambda: Converter(threads=args.threads, verbose=False,
+                                            make_conversion=make_conversion, search=search,
+                                            verifier=Verifier(args.deep_verify, args.threads),
+                                            resources=resources),
+                          token, libraries, args.name)
+    worker.run()
+
+if __name__ == '__main__':
+    main()
@@ -1,189 +1,549 @@
 '''A script and set of functions for converting video files to a standard format'''
-from os.path import splitext, getsize, isfile
-from os import rename, remove
+from os.path import splitext, getsize, dirname, join, basename
+from errno import ENOSPC
+from os import rename, remove, pipe, close, makedirs
+from shutil import move, rmtree
 import sys
-from time import sleep
-from multiprocessing import Process, Manager
-from subprocess import check_call, SubprocessError
-from aenum import IntEnum
-from arrow import utcnow as now
-import psutil
+from datetime import timedelta
+from functools import partial
+from signal import SIGSTOP, SIGCONT
+from time import sleep, perf_counter
+from subprocess import Popen, CalledProcessError, DEVNULL, PIPE
+from threading import Event
+from enum import IntEnum
+from config import DEFAULT_PROFILE
+from decisions import plan, ConversionPlan
 from mediainfo import MediaInfo, MediaInfoError
+from metrics import METRICS
+from progress import ProgressReader, FFmpegProgress, LogTail
 from utils import process_converter_args, human_readable_size, percentage
 from utils import log_successful_conversion, log_failed_conversion
+from trials import TrialCancelled
+from verify import Verifier
 
 ConversionStatus = IntEnum('ConversionStatus', 'NONE RUNNING PAUSED STOPPED ERROR DONE')
 
+def now():
+    '''Returns the current UTC time. arrow is only imported once it's first
+       needed, so that submitting files to the service stays fast.'''
+    from arrow import utcnow
+    return utcnow()
+
+class OutOfSpaceError(OSError):
+    '''Exception that indicates a conversion failed because a disk filled up,
+       which says nothing about the source and so shouldn't count against it'''
+    def __init__(self, path):
+        OSError.__init__(self, ENOSPC, 'No space left on device', path)
+
+class ConversionSkipped(Exception):
+    '''Exception that indicates a source was left as it is because trial
+       encodes showed that converting it wouldn't make it any smaller'''
+    pass
+
+class ConversionCancelled(Exception):
+    '''Exception that indicates an encode was cancelled before its
+       conversion started, while the source was staged or searched'''
+    pass
+
+def is_out_of_space(error_output):
+    '''Returns True if ffmpeg's output, the tail of its log as a single
+       string, shows that it ran out of disk space'''
+    return 'No space left on device' in (error_output or '')
+
+def conversion_paths(src_file_path, library=None):
+    '''Returns the in-progress output, final output and log paths for a source,
+       which are next to the source unless its Library has an output directory'''
+    final_dst_file_path = library.output_path(src_file_path) if library else \
+                          splitext(src_file_path)[0] + '.mp4'
+    base = splitext(final_dst_file_path)[0]
+    return base + '.converting.mp4', final_dst_file_path, base + '.conversion.log'
+
+def retire_source(src_file_path, library=None):
+    '''Moves a converted source into its library's completed directory, or
+       deletes it if there is none'''
+    completed_path = library.completed_path(src_file_path) if library else None
+    if completed_path:
+        makedirs(dirname(completed_path), exist_ok=True)
+        move(src_file_path, completed_path)
+    else:
+        remove(src_file_path)
+
+def rendition_path(dst_file_path, rendition):
+    '''Returns the path of a rendition that accompanies an output path, which
+       may be either the in-progress or the final output'''
+    base, extension = splitext(dst_file_path)
+    if base.endswith('.converting'):
+        return base[:-len('.converting')] + '.' + rendition.name + '.converting' + extension
+    return base + '.' + rendition.name + extension
+
+def scale_filter(width, height):
+    '''Returns the filter that scales video to fit a width by height box,
+       keeping its aspect ratio and with even dimensions, since libx264
+       rejects odd ones'''
+    return 'scale={}:{}:force_original_aspect_ratio=decrease:force_divisible_by=2'.format(
+        width, height)
+
 class Conversion(object):
-    def __init__(self, src_file_path, dst_file_path, log_file_path):
+    # whether ffmpeg's progress counts every frame of the output
+    counts_frames = True
+    # the ResourceGroup ffmpeg runs in, if any
+    resources = None
+    def __init__(self, src_file_path, dst_file_path, log_file_path, threads=None,
+                 profile=DEFAULT_PROFILE, renditions=()):
         self.src = src_file_path
         self.dst = dst_file_path
         self.log = log_file_path
+        self.threads = threads
+        self.profile = profile
+        self.renditions = list(renditions)
+        self._probe()
+        self.ffmpeg = None
+        self.ffmpeg_proc_info = None
+        self.progress_reader = None
+        self.log_tail = None
+        self.start_time = None
+        self.status = ConversionStatus.NONE
+        self.paused_at = None
+        self.paused_total = timedelta()
+    def _probe(self):
+        '''Decides the plan, output size and audio bitrate from the source'''
         try:
             self.info = MediaInfo(self.src)
-            self.audio_bitrate = self.info.abr()
-            self.height = self.info.video_height()
-            self.width = self.info.video_width()
+            self.audio_bitrate = self.info.abr(self.profile.max_audio_bitrate)
+            self.height = self.info.video_height(self.profile.max_height)
+            self.width = self.info.video_width(self.profile.max_width)
+            self.ladder = [(rendition_path(self.dst, rendition),
+                            self.info.video_width(rendition.profile.max_width),
+                            self.info.video_height(rendition.profile.max_height),
+                            self.info.abr(rendition.profile.max_audio_bitrate),
+                            rendition.profile)
+                           for rendition in self.renditions]
         except MediaInfoError:
             self.agent_result = {'error', 'Unable to load media info for: {}'.format(self.src)}
             raise MediaInfoError
-        self.agent = None
-        self.agent_result = None
-        self.agent_info = None
-        self.ffmpeg_proc = None
-        self.ffmpeg_proc_info = None
-        self.start_time = None
-    def _execute(self, return_dict):
-        with open(self.log, 'w+') as log_file:
-            try:
-                check_call(self._cmd(), stderr=log_file, stdout=log_file)
-            except SubprocessError as conversion_error:
-                return_dict['error'] = conversion_error
+        self.duration = self.info.duration()
+        self.plan = plan(self.info, splitext(self.src)[1], self.profile)
     def start(self):
-        '''Starts the conversion subprocess'''
+        '''Starts the ffmpeg conversion process'''
         self.start_time = now()
-        print("Converting {} to: {}x{} Bit-Rate: {}"\
-              .format(self.src, self.width, self.height, self.audio_bitrate))
-        manager = Manager()
-        self.agent_result = manager.dict()
-        self.agent = Process(target=self._execute, args=(self.agent_result,))
-        self.agent.start()
-        self.agent_info = psutil.Process(self.agent.pid)
-        sleep(2.0)
-        self.ffmpeg_proc = next(c for c in self.agent_info.children() if c.name() == 'ffmpeg')
-        self.ffmpeg_proc_info = psutil.Process(self.ffmpeg_proc.pid)
+        print("Converting {} ({}) to: {}x{} Bit-Rate: {}"\
+              .format(self.src, self.plan.name, self.width, self.height, self.audio_bitrate))
+        progress_fd, write_fd = pipe()
+        cmd = self._cmd(write_fd)
+        if self.resources:
+            cmd = self.resources.wrap(cmd)
+        try:
+            self.ffmpeg = Popen(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE,
+                                pass_fds=(write_fd,))
+        except OSError:
+            close(progress_fd)
+            raise
+        finally:
+            close(write_fd)
+        if self.resources:
+            self.resources.attach(self.ffmpeg.pid)
+        self.progress_reader = ProgressReader(progress_fd)
+        self.progress_reader.start()
+        self.log_tail = LogTail(self.ffmpeg.stderr, open(self.log, 'w+'))
+        self.log_tail.start()
+        self.status = ConversionStatus.RUNNING
+    def running(self):
+        '''Returns True while the conversion has not finished'''
+        return self.ffmpeg is not None and self.ffmpeg.poll() is None
+    def kill(self):
+        '''Terminates the ffmpeg process'''
+        if self.running():
+            self.ffmpeg.terminate()
+            # a stopped process only acts on the SIGTERM once it's continued
+            self.resume()
     def pause(self):
         '''Attempts to pause the conversion subprocess if its ongoing'''
-        # TODO: Implement conversion pause
-        pass
+        if self.status == ConversionStatus.RUNNING and self.running():
+            self.ffmpeg.send_signal(SIGSTOP)
+            self.paused_at = now()
+            self.status = ConversionStatus.PAUSED
     def resume(self):
         '''Attempts to resume the conversion subprocess if its paused'''
-        # TODO: Implement conversion resume
-        pass
+        if self.status == ConversionStatus.PAUSED:
+            if self.running():
+                self.ffmpeg.send_signal(SIGCONT)
+            self.paused_total += now() - self.paused_at
+            self.paused_at = None
+            self.status = ConversionStatus.RUNNING
     def elapsed(self):
-        '''Outputs a timedelta indicating the time that's elapsed since conversion started'''
-        return now() - self.start_time
+        '''Outputs a timedelta indicating the time that the conversion has
+           spent running, not counting any time it was paused'''
+        paused = self.paused_total
+        if self.paused_at is not None:
+            paused += now() - self.paused_at
+        return now() - self.start_time - paused
     def eta(self):
-        '''Outputs a timedelta indicating the estimated time to completion'''
-        try:
-            return (self.elapsed() / self.progress()) - self.elapsed()
-        except ZeroDivisionError:
+        '''Outputs a timedelta indicating the estimated time to completion based
+           on the remaining media duration and the encoding speed while running'''
+        out_time = self.stats().out_time
+        elapsed = self.elapsed().total_seconds()
+        if not self.duration or not out_time or elapsed <= 0:
             return float('inf')
+        return timedelta(seconds=max(0, self.duration - out_time) * elapsed / out_time)
     def progress(self):
         '''Returns a float representing the conversion progress as a percentage'''
-        try:
-            return self.position() / self.input_size()
-        except ZeroDivisionError:
+        if not self.duration:
             return 0
-    def position(self):
-        '''Returns the position in the input file which is a measure of progress'''
-        try:
-            input_file = self.ffmpeg_proc_info.open_files()[-2]
-        except psutil.AccessDenied:
-            return 0
-        return input_file.position
+        return min(1.0, self.stats().out_time / self.duration)
+    def stats(self):
+        '''Returns the latest FFmpegProgress reported by ffmpeg'''
+        return self.progress_reader.progress if self.progress_reader else FFmpegProgress()
     def input_size(self):
         '''Returns the size of the input file'''
         return getsize(self.src)
     def output_size(self):
         '''Returns the size of the output file'''
-        try:
-            output_file = self.ffmpeg_proc_info.open_files()[-1]
-        except psutil.AccessDenied:
-            return 0
-        return output_file.position
+        return self.stats().total_size
     def state(self):
         '''Returns the status of the FFMPEG conversion process'''
+        if self.ffmpeg_proc_info is None:
+            import psutil
+            self.ffmpeg_proc_info = psutil.Process(self.ffmpeg.pid)
         return self.ffmpeg_proc_info.status()
     def result(self):
-        '''Returns the result_dict of the conversion agent process'''
-        return self.agent_result
-    def _cmd(self):
-        '''Generates a conversion command'''
-        cmd = ['ffmpeg', '-stats', '-y', '-i', self.src, '-s:v',
-               str(self.width) + 'x' + str(self.height)]
-        cmd.extend(['-acodec', 'mp3', '-ab', self.audio_bitrate] \
-                    if self.audio_bitrate else ['-acodec', 'copy'])
-        cmd.extend(['-c:v', 'libx264', self.dst])
+        '''Waits for ffmpeg to exit and returns a dict with its return code,
+           plus an error and the tail of its output if it failed'''
+        if self.ffmpeg is None:
+            self.status = ConversionStatus.ERROR
+            return {'error': 'ffmpeg was never started for {}'.format(self.src)}
+        returncode = self.ffmpeg.wait()
+        self.log_tail.join()
+        self.progress_reader.join()
+        self.resume()
+        result = {'returncode': returncode}
+        self.status = ConversionStatus.ERROR if returncode else ConversionStatus.DONE
+        if returncode:
+            result['error'] = CalledProcessError(returncode, self.ffmpeg.args)
+            result['stderr'] = self.log_tail.tail()
+        return result
+    def _encoder_args(self, audio_bitrate, profile):
+        '''Returns the audio and video encoding options for one output'''
+        args = ['-acodec', profile.audio_codec, '-ab', audio_bitrate] \
+               if audio_bitrate else ['-acodec', 'copy']
+        if self.threads:
+            args.extend(['-threads', str(self.threads)])
+        args.extend(['-c:v', 'libx264'])
+        if profile.crf is not None:
+            args.extend(['-crf', str(profile.crf)])
+        if profile.preset:
+            args.extend(['-preset', profile.preset])
+        return args
+
+    def _ladder_cmd(self, cmd):
+        '''Extends cmd to write the main output and every rendition from a
+           single decode, splitting the decoded video with a filter graph'''
+        outputs = [(self.dst, self.width, self.height, self.audio_bitrate, self.profile)] \
+                  if self.plan == ConversionPlan.FULL else []
+        outputs.extend(self.ladder)
+        labels = ['[v{}]'.format(index) for index in range(len(outputs))]
+        if len(outputs) > 1:
+            graph = ['[0:v:0]split={}{}'.format(len(outputs),
+                                               ''.join('[s{}]'.format(index)
+                                                       for index in range(len(outputs))))]
+            sources = ['[s{}]'.format(index) for index in range(len(outputs))]
+        else:
+            graph, sources = [], ['[0:v:0]']
+        for source, label, output in zip(sources, labels, outputs):
+            graph.append(source + scale_filter(output[1], output[2]) + label)
+        cmd.extend(['-filter_complex', ';'.join(graph)])
+        if self.plan != ConversionPlan.FULL:
+            # the main output keeps its video stream, only the renditions are encoded
+            cmd.extend(['-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy'])
+            if self.plan == ConversionPlan.AUDIO:
+                cmd.extend(['-acodec', self.profile.audio_codec, '-ab',
+                            self.audio_bitrate or '{}k'.format(self.profile.max_audio_bitrate)])
+            else:
+                cmd.extend(['-c:a', 'copy'])
+            cmd.append(self.dst)
+        for label, (dst, width, height, audio_bitrate, profile) in zip(labels, outputs):
+            cmd.extend(['-map', label, '-map', '0:a:0?'])
+            cmd.extend(self._encoder_args(audio_bitrate, profile))
+            cmd.append(dst)
         return cmd
 
-def increment_error_counter(error_file_path):
-    '''Given a file whose only contents are a counter of errors
-       this function will increment it'''
-    if isfile(error_file_path):
-        with open(error_file_path, 'r') as error_file:
-              contents = error_file.read()
-    else:
-        contents = '0'
-    with open(error_file_path, 'w+') as error_file:
-        print("{}: {} Errors".format(error_file_path, contents))
-        try:
-            counter = int(contents) + 1
-        except:
-            counter = 1
-        error_file.write(str(counter))
+    def _cmd(self, progress_fd):
+        '''Generates a conversion command that reports progress to the given pipe'''
+        cmd = ['ffmpeg', '-nostats', '-progress', 'pipe:{}'.format(progress_fd),
+               '-y', '-i', self.src]
+        if self.renditions:
+            return self._ladder_cmd(cmd)
+        # plan() looked at the first video and audio streams, so those are the
+        # ones kept, rather than whichever ffmpeg would pick; subtitle and data
+        # streams often don't fit in an mp4 and are left out
+        cmd.extend(['-map', '0:v:0', '-map', '0:a:0?'])
+        if self.plan in (ConversionPlan.SKIP, ConversionPlan.REMUX):
+            cmd.extend(['-c', 'copy', self.dst])
+            return cmd
+        if self.plan == ConversionPlan.AUDIO:
+            cmd.extend(['-c:v', 'copy', '-acodec', self.profile.audio_codec, '-ab',
+                        self.audio_bitrate or '{}k'.format(self.profile.max_audio_bitrate),
+                        self.dst])
+            return cmd
+        cmd.extend(['-vf', scale_filter(self.width, self.height)])
+        cmd.extend(self._encoder_args(self.audio_bitrate, self.profile))
+        cmd.append(self.dst)
+        return cmd
 
 class Converter(object):
     '''Manages conversion objects and provides and interface to
-       start/stop/pause/resume/recover conversions'''
-    def __init__(self):
+       start/stop/pause/resume/recover conversions. threads limits the number
+       of ffmpeg threads per conversion and verbose enables the progress line.
+       make_conversion creates the conversion objects and takes the same
+       arguments as Conversion, which is used by default. If a ScratchStage
+       is given, sources are encoded from and to its scratch directory. If
+       a TrialSearch is given, it picks the settings of full encodes. The
+       outputs are checked by verifier, a Verifier. If ResourceLimits are
+       given, ffmpeg runs under the ResourcePolicy of the source's library,
+       whose threads take precedence over threads. Once cancelled is set,
+       by cancel(), encodes stop until it's cleared again.'''
+    def __init__(self, threads=None, verbose=True, make_conversion=None, stage=None,
+                 search=None, verifier=None, resources=None):
+        self.conversion = None
+        self.cancelled = Event()
+        self.threads = threads
+        self.verbose = verbose
+        self.make_conversion = make_conversion or Conversion
+        self.stage = stage
+        self.search = search
+        self.verifier = verifier or Verifier()
+        self.resources = resources
+    def run_conversion(self, src_file_path, library=None):
+        '''Starts a conversion subprocess for a given source, returns True if
+           the file was successfully converted. If the source belongs to a
+           Library its profile and renditions are used and the outputs and
+           source are moved into the library's directories. Every output is
+           verified before any of them is renamed into place. Raises
+           OutOfSpaceError if the conversion failed because a disk filled up
+           and ConversionSkipped if the source isn't worth converting.'''
+        return self.start_conversion(src_file_path, library)()
+
+    def start_conversion(self, src_file_path, library=None):
+        '''Runs the encode of a source like run_conversion and returns a
+           function that verifies the outputs and moves them into place,
+           returning True if the file was successfully converted. The
+           function doesn't use the Converter, so it can run on another
+           thread while the next encode starts. Raises ConversionCancelled
+           if cancelled before the conversion started.'''
+        # the last conversion is dead, cancel() mustn't mistake it for this one's
         self.conversion = None
-    def run_conversion(self, src_file_path):
-        '''Starts a conversion subprocess for a given source'''
-        dst_file_path = splitext(src_file_path)[0] + '.converting.mp4'
-        final_dst_file_path = splitext(src_file_path)[0] + '.mp4'
-        log_file_path = splitext(src_file_path)[0] + '.conversion.log'
-        error_file_path = splitext(src_file_path)[0] + '.conversion.error'
+        if not self.stage:
+            return self._encode(src_file_path, src_file_path, None, library)
+        stage = self.stage
+        work_dir = stage.work_directory(src_file_path)
+        def unstage():
+            stage.release(src_file_path)
+            rmtree(work_dir, ignore_errors=True)
         try:
-            self.conversion = Conversion(src_file_path, dst_file_path, log_file_path)
-            self.conversion.start()
-            converting = True
-        except (StopIteration, MediaInfoError):
-            print("Error, failed to start conversion of {}".format(src_file_path))
-            converting = False
-        while converting:
+            finish = self._encode(src_file_path, stage.acquire(src_file_path), work_dir, library)
+        except BaseException:
+            unstage()
+            raise
+        def finish_staged():
             try:
+                return finish()
+            finally:
+                unstage()
+        return finish_staged
+
+    def _encode(self, src_file_path, work_src_file_path, work_dir, library):
+        '''Encodes work_src_file_path, which is either the source or its
+           staged copy, into work_dir if given and returns the function that
+           finishes the conversion'''
+        dst_file_path, final_dst_file_path, log_file_path = conversion_paths(src_file_path,
+                                                                             library)
+        work_dst_file_path = join(work_dir, basename(dst_file_path)) if work_dir else \
+                             dst_file_path
+        profile = library.profile if library else DEFAULT_PROFILE
+        renditions = library.renditions if library else []
+        if self.search and not self.cancelled.is_set():
+            try:
+                chosen = self.search.choose(src_file_path, profile, renditions,
+                                            work_src_file_path, work_dir, self.cancelled)
+            except TrialCancelled as cancelled:
+                raise ConversionCancelled(str(cancelled))
+            if chosen is None:
+                raise ConversionSkipped("Trial encodes of {} didn't make it any smaller"
+                                        .format(src_file_path))
+            profile, renditions = chosen
+        if self.cancelled.is_set():
+            raise ConversionCancelled("Cancelled {} before converting it".format(src_file_path))
+        threads, group = self.threads, None
+        if self.resources:
+            group = self.resources.group(library.name if library else '',
+                                         [work_src_file_path, dirname(work_dst_file_path)])
+            threads = group.policy.threads or threads
+        started = perf_counter()
+        try:
+            try:
+                makedirs(dirname(final_dst_file_path) or '.', exist_ok=True)
+                self.conversion = self.make_conversion(work_src_file_path, work_dst_file_path,
+                                                       log_file_path, threads, profile, renditions)
+                self.conversion.resources = group
+                self.conversion.start()
+                if self.cancelled.is_set():
+                    # cancel() came in while the conversion was being created
+                    self.conversion.kill()
+                converting = True
+            except (MediaInfoError, OSError):
+                print("Error, failed to start conversion of {}".format(src_file_path))
+                converting = False
+            while converting and self.conversion.running():
                 elapsed = str(self.conversion.elapsed())
                 eta = str(self.conversion.eta())
                 output_size = human_readable_size(self.conversion.output_size())
                 progress = percentage(self.conversion.progress())
-                if output_size is not None and progress is not None:
+                if self.verbose:
                     output_str = "Converting [{}]: {} Progress {} ETA: {}\r".format(elapsed,
                                                                                     output_size,
                                                                                     progress, eta)
                     sys.stdout.write(output_str)
+                    sys.stdout.flush()
                 sleep(0.5)
-                sys.stdout.flush()
-            except psutil.NoSuchProcess:
-                print()
-                print("Conversion process ended...")
-                break
-        result = {'error':'Conversion could not be started'} if not self.conversion else self.conversion.result()
-        if 'error' in result:
-            print("There was an error during conversion: {}".format(result))
-            increment_error_counter(error_file_path)
-            log_failed_conversion(log_file_path)
-        elif getsize(dst_file_path) < 10000:
-            print("There was an error during conversion: {} is too small...".format(dst_file_path))
-            increment_error_counter(error_file_path)
-            log_failed_conversion(log_file_path)
-        elif not MediaInfo(dst_file_path).valid():
-            print("There was an error during conversion: {} media info is invalid".format(dst_file_path))
-            increment_error_counter(error_file_path)
+            if converting:
+                if self.verbose:
+                    print()
+                print("Conversion of {} ended...".format(src_file_path))
+            result = self.conversion.result() if converting else \
+                     {'error': 'Conversion could not be started'}
+            METRICS.observe('ffmpeg', perf_counter() - started)
+        finally:
+            # the cgroup is removed even if waiting for ffmpeg failed
+            if group is not None:
+                self.resources.release(group)
+        if 'error' in result and is_out_of_space(result.get('stderr')):
+            print("Ran out of disk space converting {}".format(src_file_path))
+            self._discard(work_dst_file_path, renditions)
+            raise OutOfSpaceError(work_dst_file_path)
+        return partial(self._finish, self.conversion, result, src_file_path, work_dst_file_path,
+                       library, renditions)
+
+    def _finish(self, conversion, result, src_file_path, work_dst_file_path, library,
+                renditions):
+        '''Verifies the outputs of an encode and moves them and the source to
+           where they belong, returns True if the conversion succeeded'''
+        dst_file_path, final_dst_file_path, log_file_path = conversion_paths(src_file_path,
+                                                                             library)
+        with METRICS.timed('verify'):
+            if 'error' in result:
+                failure = "{}".format(result)
+            else:
+                failure = self.verifier.check(conversion, [work_dst_file_path] +
+                                              [rendition_path(work_dst_file_path, rendition)
+                                               for rendition in renditions])
+        if failure:
+            print("There was an error during conversion: {}".format(failure))
             log_failed_conversion(log_file_path)
-        else:
-            remove(src_file_path)
+            return False
+        saved = getsize(src_file_path) - getsize(work_dst_file_path)
+        with METRICS.timed('move'):
+            if work_dst_file_path != dst_file_path:
+                # a single copy back next to the final path, the renames below are atomic
+                try:
+                    for rendition in renditions:
+                        move(rendition_path(work_dst_file_path, rendition),
+                             rendition_path(dst_file_path, rendition))
+                    move(work_dst_file_path, dst_file_path)
+                except OSError as error:
+                    self._discard(dst_file_path, renditions)
+                    if error.errno == ENOSPC:
+                        raise OutOfSpaceError(dst_file_path)
+                    raise
+            retire_source(src_file_path, library)
+            for rendition in renditions:
+                rename(rendition_path(dst_file_path, rendition),
+                       rendition_path(final_dst_file_path, rendition))
             rename(dst_file_path, final_dst_file_path)
-            log_successful_conversion(log_file_path)
+        METRICS.record_savings(saved)
+        log_successful_conversion(log_file_path)
+        return True
+
+    @staticmethod
+    def _discard(dst_file_path, renditions):
+        '''Removes whatever exists of an output and its renditions'''
+        for file_path in [dst_file_path] + [rendition_path(dst_file_path, rendition)
+                                            for rendition in renditions]:
+            try:
+                remove(file_path)
+            except OSError:
+                pass
+
+    def cancel(self):
+        '''Stops the current encode, at its next trial sample if the trials
+           are running and by killing its conversion if that has started'''
+        self.cancelled.set()
+        conversion = self.conversion
+        if conversion:
+            conversion.kill()
+
+    def pause(self):
+        '''Pauses the current conversion, if any'''
+        if self.conversion:
+            self.conversion.pause()
+
+    def resume(self):
+        '''Resumes the current conversion, if it was paused'''
+        if self.conversion:
+            self.conversion.resume()
 
     def status(self):
-        pass
+        '''Returns the ConversionStatus of the current conversion'''
+        return self.conversion.status if self.conversion else ConversionStatus.NONE
+
+def submit(args):
+    '''Sends the request described by the arguments to a running service,
+       returns False if there is no service to send it to'''
+    from control import find_socket, request, ControlError
+    file_paths = list(args.to_convert)
+    if args.from_file:
+        with (sys.stdin if args.from_file == '-' else open(args.from_file)) as path_file:
+            file_paths.extend(line.strip() for line in path_file if line.strip())
+    socket_path = args.socket or find_socket(file_paths)
+    if socket_path is None:
+        return False
+    try:
+        if args.status:
+            response = request(socket_path, 'status')
+            for status, count in response['jobs'].items():
+                print("{}: {}".format(status, count))
+            for line in response['workers']:
+                print(line)
+        elif args.pause or args.resume:
+            request(socket_path, 'pause' if args.pause else 'resume')
+        elif args.limit:
+            changes = dict(limit.partition('=')[::2] for limit in args.limit)
+            response = request(socket_path, 'limits', library=args.library, changes=changes)
+            for name, value in sorted(response['policy'].items()):
+                print("{}: {}".format(name, 'max' if value is None else value))
+        elif args.cancel:
+            response = request(socket_path, 'cancel', paths=file_paths)
+            print("Stopped {} running conversions".format(len(response['stopped'])))
+        else:
+            response = request(socket_path, 'submit', paths=file_paths,
+                               priority=args.priority)
+            print("Queued {} files".format(response['queued']))
+            for file_path in response['rejected']:
+                print("Not in any library or not a media file: {}".format(file_path))
+    except ControlError as error:
+        print(error)
+    return True
 
 def main():
-    '''Process arguments and starts the Converter'''
+    '''Process arguments and submits the files to a running service, or
+       converts them in this process if there is none or --local is given'''
     args = process_converter_args()
+    if not args.local and submit(args):
+        return
+    if args.status or args.pause or args.resume or args.cancel or args.limit:
+        print("No running service found, use --socket to point at its control socket")
+        return
     converter = Converter()
-    converter.run_conversion(args.to_convert)
+    for file_path in args.to_convert:
+        converter.run_conversion(file_path)
 
 if __name__ == '__main__':
     main()
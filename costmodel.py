@@ -0,0 +1,124 @@
+'''Learns how long conversions take from the ones that already ran and
+   predicts the wall time of the ones that are still waiting'''
+import sqlite3
+from collections import namedtuple
+from os.path import splitext
+from threading import Lock
+from time import time
+
+from config import DEFAULT_PROFILE
+from constants import HEIGHT, WIDTH, MODEL_SMOOTHING, PROBE_BACKEND
+from decisions import plan, ConversionPlan
+from mediainfo import MediaInfo, MediaInfoError
+from metrics import METRICS
+
+Features = namedtuple('Features', 'plan codec duration pixels bitrate')
+
+# seconds of SD media converted per second of wall time, until there's
+# something better to go on
+DEFAULT_SPEEDS = {ConversionPlan.SKIP: 50.0, ConversionPlan.REMUX: 50.0,
+                  ConversionPlan.AUDIO: 20.0, ConversionPlan.FULL: 1.0}
+
+def features(info, profile=DEFAULT_PROFILE):
+    '''Returns the Features of a source that its conversion time depends
+       on, given its MediaInfo'''
+    video = info.result.video[0] if info.result.video else None
+    pixels = (video.width or 0) * (video.height or 0) if video else 0
+    return Features(plan(info, splitext(info.file_path)[1], profile).name,
+                    (video.codec or '').lower() if video else '',
+                    info.duration() or 0.0, pixels, info.result.bitrate or 0)
+
+def work(source):
+    '''Returns the amount of work a conversion takes in seconds of SD media.
+       Only a full encode has to touch every pixel, the other plans mostly
+       just copy the streams.'''
+    if source.plan == ConversionPlan.FULL.name and source.pixels:
+        return source.duration * source.pixels / float(WIDTH * HEIGHT)
+    return source.duration
+
+class CostModel(object):
+    '''Predicts the wall time of conversions from their Features. Keeps an
+       exponentially weighted average of the observed speed for each
+       library, plan and source codec, falling back to the plan and codec
+       across libraries and then to the plan alone while there's little
+       to go on. Observations are kept in a SQLite database at db_path so
+       the model survives restarts, and the relative error of its
+       predictions is exported as the prediction_error gauge.'''
+    def __init__(self, db_path, cache=None, backend=PROBE_BACKEND, smoothing=MODEL_SMOOTHING):
+        self.cache = cache
+        self.backend = backend
+        self.smoothing = smoothing
+        self.speeds = {}
+        self.error = None
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS observations ('
+                         'id INTEGER PRIMARY KEY, path TEXT NOT NULL, library TEXT NOT NULL, '
+                         'plan TEXT NOT NULL, codec TEXT NOT NULL, duration REAL NOT NULL, '
+                         'pixels INTEGER NOT NULL, bitrate REAL NOT NULL, '
+                         'seconds REAL NOT NULL, predicted REAL, recorded REAL NOT NULL)')
+        self._db.commit()
+        rows = self._db.execute('SELECT library, plan, codec, duration, pixels, bitrate, '
+                                'seconds, predicted FROM observations ORDER BY id').fetchall()
+        for row in rows:
+            self._learn(row[0], Features(*row[1:6]), row[6], row[7])
+        if self.error is not None:
+            METRICS.set('prediction_error', self.error)
+
+    @staticmethod
+    def _keys(library_name, source):
+        return [(library_name, source.plan, source.codec), ('', source.plan, source.codec),
+                ('', source.plan, '')]
+
+    def _average(self, previous, value):
+        return value if previous is None else previous + self.smoothing * (value - previous)
+
+    def _learn(self, library_name, source, seconds, predicted):
+        '''Folds an observation into the speeds and the prediction error'''
+        if seconds <= 0 or not work(source):
+            return
+        speed = work(source) / seconds
+        for key in set(self._keys(library_name, source)):
+            self.speeds[key] = self._average(self.speeds.get(key), speed)
+        if predicted:
+            self.error = self._average(self.error, abs(seconds - predicted) / seconds)
+
+    def predict(self, source, library_name=''):
+        '''Returns the predicted wall time in seconds of converting a source
+           with the given Features'''
+        with self._lock:
+            for key in self._keys(library_name, source):
+                if key in self.speeds:
+                    return work(source) / self.speeds[key]
+        return work(source) / DEFAULT_SPEEDS[ConversionPlan[source.plan]]
+
+    def features(self, file_path, library=None):
+        '''Returns the Features of a source, or None if it can't be probed'''
+        try:
+            info = MediaInfo(file_path, self.cache, self.backend)
+        except (MediaInfoError, OSError):
+            return None
+        return features(info, library.profile if library else DEFAULT_PROFILE)
+
+    def estimate(self, file_path, library=None):
+        '''Returns the predicted wall time in seconds of converting a file for
+           a Library, which is 0 for files that can't be probed since those
+           fail right away'''
+        source = self.features(file_path, library)
+        return self.predict(source, library.name if library else '') if source else 0.0
+
+    def record(self, file_path, library_name, source, seconds, predicted=None):
+        '''Feeds the wall time a conversion actually took back into the model'''
+        with self._lock:
+            self._db.execute('INSERT INTO observations (path, library, plan, codec, duration, '
+                             'pixels, bitrate, seconds, predicted, recorded) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (file_path, library_name) + tuple(source) +
+                             (seconds, predicted, time()))
+            self._db.commit()
+            self._learn(library_name, source, seconds, predicted)
+            error = self.error
+        if error is not None:
+            METRICS.set('prediction_error', error)
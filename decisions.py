@@ -0,0 +1,42 @@
+'''Decides, per stream, how much work a source needs to reach the SD format'''
+from enum import IntEnum
+
+from config import DEFAULT_PROFILE
+
+ConversionPlan = IntEnum('ConversionPlan', 'SKIP REMUX AUDIO FULL')
+
+# codec names as reported by mediainfo and by ffprobe
+H264_CODECS = {'avc', 'h264'}
+MP4_AUDIO_CODECS = {'aac', 'mpeg audio', 'mp3', 'ac-3', 'ac3', 'e-ac-3', 'eac3'}
+
+def video_complies(video, profile=DEFAULT_PROFILE, check_codec=True):
+    '''Returns True if a video stream can be copied into the output as is'''
+    return video is not None and \
+           (not check_codec or (video.codec or '').lower() in H264_CODECS) and \
+           video.width is not None and video.width <= profile.max_width and \
+           video.height is not None and video.height <= profile.max_height
+
+def audio_complies(audio, profile=DEFAULT_PROFILE):
+    '''Returns True if an audio stream (or its absence) can be copied into the output'''
+    if audio is None:
+        return True
+    bitrate = audio.bitrate or audio.max_bitrate
+    return (audio.codec or '').lower() in MP4_AUDIO_CODECS and \
+           (bitrate is None or bitrate / 1000.0 <= profile.max_audio_bitrate)
+
+def plan(info, extension, profile=DEFAULT_PROFILE):
+    '''Returns the cheapest ConversionPlan that brings the file described by
+       a MediaInfo into the profile's SD format: nothing for a compliant mp4, a remux
+       for a compliant file in another container, an audio-only transcode
+       when only the audio is out of spec, and a full re-encode otherwise.
+       Like before, the video codec of files that are already mp4 is trusted.'''
+    video = info.result.video[0] if info.result.video else None
+    audio = info.result.audio[0] if info.result.audio else None
+    if video is None and extension == '.mp4':
+        print("Media info for {} has no video, cannot compare to SD".format(info.file_path))
+        return ConversionPlan.SKIP
+    if not video_complies(video, profile, extension != '.mp4'):
+        return ConversionPlan.FULL
+    if not audio_complies(audio, profile):
+        return ConversionPlan.AUDIO
+    return ConversionPlan.SKIP if extension == '.mp4' else ConversionPlan.REMUX
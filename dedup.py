@@ -0,0 +1,175 @@
+'''Recognizes sources with identical content, wherever and under whatever
+   name they turn up, so that each is only encoded once and the copies
+   reuse its output'''
+import sqlite3
+from fcntl import ioctl
+from hashlib import sha1
+from os import link, remove, rename, makedirs
+from os.path import getsize, abspath, dirname, exists
+from shutil import copy2
+from threading import Lock
+from time import time
+
+from config import DEFAULT_PROFILE
+from constants import FINGERPRINT_BLOCK, FINGERPRINT_BLOCKS, STAGE_CHUNK_SIZE
+from converter import ConversionStatus, conversion_paths, rendition_path, retire_source
+from metrics import METRICS
+
+# the Linux ioctl that clones a file's extents on copy-on-write filesystems
+FICLONE = 0x40049409
+
+def fingerprint(file_path, full=False, block_size=FINGERPRINT_BLOCK, blocks=FINGERPRINT_BLOCKS):
+    '''Returns a fingerprint of a file's content: its size along with a hash
+       of blocks sampled at fixed offsets from its start to its end, or of
+       all of it when full is set'''
+    size = getsize(file_path)
+    digest = sha1()
+    with open(file_path, 'rb') as media_file:
+        if full:
+            for chunk in iter(lambda: media_file.read(STAGE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        else:
+            for index in range(blocks):
+                media_file.seek(max(0, size - block_size) * index // max(1, blocks - 1))
+                digest.update(media_file.read(block_size))
+    return '{}:{}'.format(size, digest.hexdigest())
+
+def output_key(library=None):
+    '''Returns a key for the outputs a library makes of a source, so that
+       only libraries that encode identically share their outputs'''
+    profile = library.profile if library else DEFAULT_PROFILE
+    renditions = library.renditions if library else []
+    settings = [[getattr(profile, slot) for slot in profile.__slots__]]
+    settings.extend([rendition.name] + [getattr(rendition.profile, slot)
+                                        for slot in rendition.profile.__slots__]
+                    for rendition in renditions)
+    return sha1(repr(settings).encode('UTF-8')).hexdigest()[:16]
+
+def link_or_copy(src_file_path, dst_file_path):
+    '''Makes dst_file_path a copy of src_file_path as cheaply as the
+       filesystem allows: a hard link, else a reflink (a copy-on-write
+       clone), else a plain copy. Returns which of the three it made.'''
+    if exists(dst_file_path):
+        remove(dst_file_path)
+    try:
+        link(src_file_path, dst_file_path)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        with open(src_file_path, 'rb') as src_file, open(dst_file_path, 'wb') as dst_file:
+            ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return 'reflink'
+    except OSError:
+        pass
+    copy2(src_file_path, dst_file_path)
+    return 'copy'
+
+class Deduplicator(object):
+    '''Keeps an index at db_path of the finished output of each source
+       fingerprint, and tracks which fingerprints are being converted
+       right now. A job whose source has an output on record reuses it,
+       and a job whose twin is being converted is parked, still marked as
+       running in the queue, until the twin finishes and then reuses its
+       output, or goes back in the queue if the twin failed.'''
+    CONVERT, REUSE, WAIT = range(3)
+
+    def __init__(self, db_path, full=False):
+        self.full = full
+        self._converting = {}
+        self._owners = {}
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS outputs ('
+                         'key TEXT PRIMARY KEY, output TEXT NOT NULL, '
+                         'size INTEGER NOT NULL, recorded REAL NOT NULL)')
+        self._db.commit()
+
+    def _output(self, key):
+        '''Returns the recorded output for a key if it's still there and
+           unchanged, must be called with the lock held'''
+        row = self._db.execute('SELECT output, size FROM outputs WHERE key = ?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            if getsize(row[0]) == row[1]:
+                return row[0]
+        except OSError:
+            pass
+        self._db.execute('DELETE FROM outputs WHERE key = ?', (key,))
+        self._db.commit()
+        return None
+
+    def claim(self, job, library=None):
+        '''Decides what to do with a job. Returns a (CONVERT, None) tuple if
+           the job is the first of its content and should be converted,
+           (REUSE, output) if there's a finished output to reuse and
+           (WAIT, None) if the job was parked behind a running twin.'''
+        try:
+            key = '{}/{}'.format(fingerprint(job.path, self.full), output_key(library))
+        except OSError:
+            return self.CONVERT, None
+        with self._lock:
+            if key in self._converting:
+                self._converting[key].append((job, library))
+                print("Waiting on the conversion of a copy of {}".format(job.path))
+                return self.WAIT, None
+            output = self._output(key)
+            if output is not None:
+                return self.REUSE, output
+            self._converting[key] = []
+            self._owners[job.id] = key
+        return self.CONVERT, None
+
+    def settle(self, job, output=None):
+        '''Records how a converted job went, given its final output if it
+           succeeded, and returns the (job, library) tuples of the twins
+           that were waiting for it'''
+        with self._lock:
+            key = self._owners.pop(job.id, None)
+            if key is None:
+                return []
+            if output is not None:
+                try:
+                    self._db.execute('INSERT OR REPLACE INTO outputs (key, output, size, '
+                                     'recorded) VALUES (?, ?, ?, ?)',
+                                     (key, output, getsize(output), time()))
+                    self._db.commit()
+                except OSError:
+                    pass
+            return self._converting.pop(key, [])
+
+    @staticmethod
+    def reuse(job, library, output, queue):
+        '''Links, or failing that copies, an identical source's output and its
+           renditions into place for a job, retires its source like a
+           conversion would and records the outcome in the queue. Returns
+           True if it succeeded.'''
+        dst_file_path, final_dst_file_path, _ = conversion_paths(job.path, library)
+        renditions = library.renditions if library else []
+        outputs = [(output, dst_file_path, final_dst_file_path)]
+        outputs.extend((rendition_path(output, rendition),
+                        rendition_path(dst_file_path, rendition),
+                        rendition_path(final_dst_file_path, rendition))
+                       for rendition in renditions)
+        try:
+            output_size = getsize(output)
+            saved = getsize(job.path) - output_size
+            for src_file_path, partial_path, final_path in outputs:
+                if abspath(src_file_path) != abspath(final_path):
+                    makedirs(dirname(final_path) or '.', exist_ok=True)
+                    link_or_copy(src_file_path, partial_path)
+                    rename(partial_path, final_path)
+            retire_source(job.path, library)
+        except OSError as error:
+            print("Unable to reuse {} for {}: {}".format(output, job.path, error))
+            queue.finish(job, ConversionStatus.ERROR, str(error))
+            return False
+        print("{} is a copy of an already converted source, reused {}".format(job.path, output))
+        METRICS.inc('deduplicated')
+        METRICS.record_savings(saved)
+        queue.finish(job, ConversionStatus.DONE, output_size=output_size)
+        return True
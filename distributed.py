@@ -0,0 +1,397 @@
+'''A coordinator that hands out jobs from the JobQueue to remote workers over
+   HTTP, and the worker that claims and converts them. Workers are expected
+   to see the media under the same paths as the coordinator, for example
+   through a shared network mount. Every request carries a token shared by
+   the coordinator and its workers.'''
+import json
+from hmac import compare_digest
+from os import environ
+from os.path import getsize
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from socket import gethostname
+from threading import Thread, Event, Lock
+from time import monotonic, time, sleep
+from urllib.error import URLError, HTTPError
+from urllib.request import Request, urlopen
+from uuid import uuid4
+
+from arrow import utcnow as now
+from constants import RETRY_LIMIT, LEASE_DURATION, CLAIM_WAIT, SPACE_RECHECK, REFUSED_RECHECK
+from converter import ConversionStatus, ConversionSkipped, OutOfSpaceError, conversion_paths
+from jobqueue import Job
+from metrics import METRICS
+from workerpool import move_to_error_directory
+
+TOKEN_ENV = 'AUTO_CONVERTER_TOKEN'
+TOKEN_HEADER = 'X-Auto-Converter-Token'
+
+def find_token(token=None):
+    '''Returns the token shared with the workers: the given one, or the one
+       in the environment, or None if there is neither'''
+    return token or environ.get(TOKEN_ENV) or None
+
+class Lease(object):
+    '''A job claimed by a remote worker, which it holds until expires unless
+       it sends a heartbeat'''
+    __slots__ = ('id', 'job', 'worker', 'expires', 'started', 'progress', 'speed', 'source',
+                 'predicted')
+    def __init__(self, job, worker, duration, source=None, predicted=None):
+        self.id = uuid4().hex
+        self.job = job
+        self.worker = worker
+        self.expires = monotonic() + duration
+        self.started = now()
+        self.progress = 0.0
+        self.speed = None
+        self.source = source
+        self.predicted = predicted
+
+class _CoordinatorHandler(BaseHTTPRequestHandler):
+    '''Dispatches the JSON POST requests of the worker protocol to the
+       Coordinator, refusing the ones without its token'''
+    def do_POST(self): # pylint: disable=invalid-name
+        coordinator = self.server.coordinator
+        if not compare_digest(self.headers.get(TOKEN_HEADER, '').encode('UTF-8'),
+                              coordinator.token.encode('UTF-8')):
+            self.send_error(403)
+            return
+        routes = {'/claim': coordinator.claim, '/heartbeat': coordinator.heartbeat,
+                  '/complete': coordinator.complete}
+        if self.path not in routes:
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.send_error(400)
+            return
+        status, response = routes[self.path](request)
+        body = json.dumps(response).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+class Coordinator(object):
+    '''Serves the JobQueue on the given host and port to remote workers
+       that send the shared token. Each claimed job is leased for lease_duration seconds, a worker has to heartbeat
+       to keep it, and jobs whose lease expires are put back in the queue.
+       Offers the same interface as a WorkerPool so the service and the
+       LoadGovernor can drive either, including feeding a CostModel and
+       deduplicating sources with a Deduplicator.'''
+    def __init__(self, queue, port, token, libraries=None, host='127.0.0.1',
+                 lease_duration=LEASE_DURATION, costs=None, dedup=None):
+        self.queue = queue
+        self.token = token
+        self.libraries = libraries or {}
+        self.costs = costs
+        self.dedup = dedup
+        self.lease_duration = lease_duration
+        self.paused = False
+        self.leases = {}
+        self._lock = Lock()
+        self._done = Queue()
+        self._stopped = Event()
+        self.server = ThreadingHTTPServer((host, port), _CoordinatorHandler)
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        Thread(target=self.server.serve_forever, daemon=True, name='coordinator').start()
+        Thread(target=self._reap, daemon=True, name='lease-reaper').start()
+
+    def claim(self, request):
+        '''Leases the next job to a worker, waiting up to CLAIM_WAIT seconds
+           for one. Answers 204 when there's nothing to do.'''
+        if self.paused:
+            sleep(CLAIM_WAIT)
+            return 204, {}
+        job = self.queue.get(CLAIM_WAIT)
+        while job is not None and self.dedup and self._deduplicate(job):
+            job = self.queue.get(CLAIM_WAIT)
+        if job is None:
+            return 204, {}
+        METRICS.observe('queue_wait', max(0.0, time() - job.queued))
+        source = predicted = None
+        if self.costs:
+            source = self.costs.features(job.path, self.libraries.get(job.library))
+            predicted = self.costs.predict(source, job.library) if source else None
+        lease = Lease(job, request.get('worker', 'unknown'), self.lease_duration, source,
+                      predicted)
+        with self._lock:
+            self.leases[lease.id] = lease
+        METRICS.set('active_workers', len(self.leases))
+        return 200, {'lease': lease.id, 'duration': self.lease_duration, 'job': job._asdict()}
+
+    def heartbeat(self, request):
+        '''Extends a lease and records the progress reported with it.
+           Answers 410 if the lease has already expired.'''
+        with self._lock:
+            lease = self.leases.get(request.get('lease'))
+            if lease is None:
+                return 410, {}
+            lease.expires = monotonic() + self.lease_duration
+            lease.progress = request.get('progress', lease.progress)
+            lease.speed = request.get('speed')
+        return 200, {'paused': self.paused}
+
+    def complete(self, request):
+        '''Records the outcome of a leased job. Answers 410 if the lease had
+           expired, in which case the job was already handed to someone else.'''
+        with self._lock:
+            lease = self.leases.pop(request.get('lease'), None)
+        if lease is None:
+            return 410, {}
+        METRICS.set('active_workers', len(self.leases))
+        job, result = lease.job, bool(request.get('result'))
+        self._settle(job, result and not request.get('out_of_space'))
+        if request.get('out_of_space'):
+            # a full disk says nothing about the source, so it doesn't count as an attempt
+            print("{} ran out of disk space on {}, requeueing it".format(lease.worker, job.path))
+            self.queue.release(job, SPACE_RECHECK)
+            return 200, {}
+        if request.get('refused'):
+            # left for workers that know the job's library, which this one doesn't
+            print("{} refused {}: {}".format(lease.worker, job.path, request.get('error')))
+            self.queue.release(job, REFUSED_RECHECK)
+            return 200, {}
+        if request.get('skipped'):
+            print("{} skipped {}: {}".format(lease.worker, job.path, request.get('error')))
+            METRICS.inc('skipped')
+            self.queue.finish(job, ConversionStatus.STOPPED, request.get('error'))
+            return 200, {}
+        stats = request.get('stats') or {}
+        if 'ffmpeg_seconds' in stats:
+            METRICS.observe('ffmpeg', stats['ffmpeg_seconds'])
+        if result:
+            METRICS.inc('converted')
+            METRICS.record_savings(stats.get('bytes_saved', 0))
+            if lease.source and 'ffmpeg_seconds' in stats:
+                self.costs.record(job.path, job.library, lease.source, stats['ffmpeg_seconds'],
+                                  lease.predicted)
+        else:
+            METRICS.inc('failed')
+        output_size = _size(conversion_paths(job.path, self.libraries.get(job.library))[1]) \
+                      if result else None
+        self.queue.finish(job, ConversionStatus.DONE if result else ConversionStatus.ERROR,
+                          request.get('error'), output_size)
+        if not result and self.queue.attempts(job.path) > RETRY_LIMIT:
+            move_to_error_directory(job.path, self.libraries.get(job.library))
+        elif not result:
+            METRICS.inc('retried')
+        print("{} {} {}".format(lease.worker, 'converted' if result else 'failed on', job.path))
+        self._done.put((job, result))
+        return 200, {}
+
+    def _reap(self):
+        '''Requeues the jobs of leases that weren't renewed in time'''
+        while not self._stopped.wait(min(5.0, self.lease_duration / 4.0)):
+            with self._lock:
+                expired = [lease for lease in self.leases.values()
+                           if lease.expires < monotonic()]
+                for lease in expired:
+                    del self.leases[lease.id]
+            for lease in expired:
+                print("Lease of {} by {} expired, requeueing it".format(lease.job.path,
+                                                                        lease.worker))
+                self._settle(lease.job, False)
+                self.queue.release(lease.job)
+
+    def _deduplicate(self, job):
+        '''Reuses the output of an identical source for a job or parks the job
+           behind the running conversion of one, returns False if the job
+           has to be converted'''
+        library = self.libraries.get(job.library)
+        action, output = self.dedup.claim(job, library)
+        if action == self.dedup.REUSE:
+            self._done.put((job, self.dedup.reuse(job, library, output, self.queue)))
+        return action != self.dedup.CONVERT
+
+    def _settle(self, job, result):
+        '''Hands the output of a conversion to the twins that waited on it,
+           or puts them back in the queue if it failed'''
+        if not self.dedup:
+            return
+        output = conversion_paths(job.path, self.libraries.get(job.library))[1] if result else None
+        for twin, library in self.dedup.settle(job, output):
+            if output:
+                self._done.put((twin, self.dedup.reuse(twin, library, output, self.queue)))
+            else:
+                self.queue.release(twin)
+
+    def completed(self):
+        '''Returns a list of (job, succeeded) tuples for jobs that finished
+           since the last call'''
+        results = []
+        while True:
+            try:
+                results.append(self._done.get_nowait())
+            except Empty:
+                return results
+
+    def cancel(self, file_path):
+        '''Revokes the lease on a file, which makes its worker stop the
+           conversion at its next heartbeat, returns True if it was leased'''
+        with self._lock:
+            leases = [lease for lease in self.leases.values() if lease.job.path == file_path]
+            for lease in leases:
+                del self.leases[lease.id]
+        for lease in leases:
+            self._settle(lease.job, False)
+            self.queue.finish(lease.job, ConversionStatus.STOPPED, 'Cancelled')
+        return bool(leases)
+
+    def active(self):
+        '''Returns the number of jobs that are currently leased'''
+        return len(self.leases)
+
+    def encode_speed(self):
+        '''Returns the combined speed reported by the workers as a multiple of realtime'''
+        with self._lock:
+            return sum(lease.speed or 0.0 for lease in self.leases.values())
+
+    def pause(self):
+        '''Stops handing out jobs and asks the workers to pause theirs'''
+        self.paused = True
+
+    def resume(self):
+        '''Resumes handing out jobs and lets the workers continue'''
+        self.paused = False
+
+    def status(self):
+        '''Returns a list of status lines, one per lease'''
+        with self._lock:
+            leases = list(self.leases.values())
+        if not leases:
+            return ["Coordinator: no jobs leased"]
+        return ["{}: {} [{}] {:0.2f}%{}".format(lease.worker, lease.job.path,
+                                                now() - lease.started, lease.progress * 100.0,
+                                                ' (paused)' if self.paused else '')
+                for lease in leases]
+
+    def stop(self):
+        '''Stops serving workers'''
+        self._stopped.set()
+        self.server.shutdown()
+        self.queue.close()
+
+def _size(file_path):
+    '''Returns the size of a file, or 0 if it doesn't exist'''
+    try:
+        return getsize(file_path)
+    except OSError:
+        return 0
+
+class RemoteWorker(object):
+    '''Claims jobs from a Coordinator at url, which shares token, and
+       converts them with the Converter made by make_converter, heartbeating
+       while it runs. libraries maps library names to the Library each job
+       belongs to.'''
+    def __init__(self, url, make_converter, token, libraries=None, name=None):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.converter = make_converter()
+        self.libraries = libraries or {}
+        self.name = name or '{}-{}'.format(gethostname(), uuid4().hex[:6])
+
+    def _post(self, path, request):
+        '''Posts a JSON request and returns the status and the decoded response'''
+        data = json.dumps(request).encode('UTF-8')
+        http_request = Request(self.url + path, data, {'Content-Type': 'application/json',
+                                                       TOKEN_HEADER: self.token})
+        try:
+            with urlopen(http_request, timeout=CLAIM_WAIT + 30) as response:
+                body = response.read()
+                return response.status, json.loads(body) if body else {}
+        except HTTPError as error:
+            return error.code, {}
+
+    def _heartbeat(self, lease, interval, finished):
+        '''Keeps a lease alive until finished is set, killing the conversion
+           if the coordinator has given the job to someone else'''
+        while not finished.wait(interval):
+            conversion = self.converter.conversion
+            request = {'lease': lease}
+            if conversion is not None and conversion.start_time is not None:
+                try:
+                    request['progress'] = conversion.progress()
+                    request['speed'] = conversion.stats().speed
+                except Exception: # pylint: disable=broad-except
+                    pass
+            try:
+                status, response = self._post('/heartbeat', request)
+            except URLError as error:
+                print("Heartbeat failed: {}".format(error))
+                continue
+            if status == 410:
+                print("Lost the lease, stopping the conversion")
+                if conversion is not None:
+                    conversion.kill()
+                return
+            if response.get('paused'):
+                self.converter.pause()
+            else:
+                self.converter.resume()
+
+    def run_job(self, lease, duration, job):
+        '''Converts a leased job and reports the outcome to the coordinator.
+           Jobs of libraries missing from the worker's config are refused,
+           since their outputs would end up in the wrong place.'''
+        library = self.libraries.get(job.library)
+        if library is None and job.library:
+            error = "[{}] isn't in this worker's config".format(job.library)
+            print("Refusing {}: {}".format(job.path, error))
+            try:
+                self._post('/complete', {'lease': lease, 'result': False, 'error': error,
+                                         'refused': True})
+            except URLError as error:
+                print("Unable to report {} to the coordinator: {}".format(job.path, error))
+            return
+        finished = Event()
+        heartbeat = Thread(target=self._heartbeat, args=(lease, duration / 3.0, finished),
+                           daemon=True)
+        heartbeat.start()
+        started = monotonic()
+        source_size = _size(job.path)
+        result, error, out_of_space, skipped = False, None, False, False
+        try:
+            result = self.converter.run_conversion(job.path, library)
+        except OutOfSpaceError as exception:
+            error, out_of_space = str(exception), True
+        except ConversionSkipped as exception:
+            error, skipped = str(exception), True
+        except Exception as exception: # pylint: disable=broad-except
+            error = str(exception)
+            print("Failed on {}: {}".format(job.path, error))
+        finished.set()
+        heartbeat.join()
+        stats = {'ffmpeg_seconds': monotonic() - started}
+        if result:
+            stats['bytes_saved'] = source_size - _size(conversion_paths(job.path, library)[1])
+        try:
+            self._post('/complete', {'lease': lease, 'result': result, 'error': error,
+                                     'out_of_space': out_of_space, 'skipped': skipped,
+                                     'stats': stats})
+        except URLError as error:
+            print("Unable to report {} to the coordinator: {}".format(job.path, error))
+        if out_of_space:
+            sleep(SPACE_RECHECK)
+
+    def run(self):
+        '''Claims and converts jobs until the coordinator goes away for good'''
+        print("Worker {} claiming jobs from {}".format(self.name, self.url))
+        while True:
+            try:
+                status, response = self._post('/claim', {'worker': self.name})
+            except URLError as error:
+                print("Unable to reach the coordinator: {}".format(error))
+                sleep(CLAIM_WAIT)
+                continue
+            if status != 200:
+                continue
+            job = Job(**response['job'])
+            print("Claimed {}".format(job.path))
+            self.run_job(response['lease'], response['duration'], job)
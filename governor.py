@@ -0,0 +1,87 @@
+'''Pauses and resumes conversions based on how busy the host is'''
+from datetime import datetime
+from os import getloadavg
+from threading import Thread, Event
+
+from constants import GOVERNOR_INTERVAL, GOVERNOR_RESUME_RATIO
+
+def cpu_pressure(pressure_file='/proc/pressure/cpu'):
+    '''Returns the "some" avg10 CPU pressure as a percentage, or None if the
+       kernel doesn't support pressure stall information'''
+    try:
+        with open(pressure_file) as pressure:
+            for line in pressure:
+                if line.startswith('some'):
+                    fields = dict(field.split('=') for field in line.split()[1:])
+                    return float(fields['avg10'])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+def parse_window(window):
+    '''Parses an "HH:MM-HH:MM" time of day window into a pair of times'''
+    start, end = window.split('-')
+    return (datetime.strptime(start.strip(), '%H:%M').time(),
+            datetime.strptime(end.strip(), '%H:%M').time())
+
+def in_window(window, moment):
+    '''Returns True if the time of moment falls into the window, which may
+       wrap around midnight'''
+    start, end = window
+    if start <= end:
+        return start <= moment.time() < end
+    return moment.time() >= start or moment.time() < end
+
+class LoadGovernor(Thread):
+    '''A daemon thread that pauses the pool while the load average or the
+       CPU pressure is above its limit, or while outside of the allowed time
+       of day window, and resumes it once the load has dropped below
+       GOVERNOR_RESUME_RATIO of the limit and the window is open again'''
+    def __init__(self, pool, max_load=None, max_pressure=None, window=None,
+                 interval=GOVERNOR_INTERVAL):
+        Thread.__init__(self, daemon=True, name='load-governor')
+        self.pool = pool
+        self.max_load = max_load
+        self.max_pressure = max_pressure
+        self.window = parse_window(window) if window else None
+        self.interval = interval
+        self.paused = False
+        self._stopped = Event()
+
+    def reason(self):
+        '''Returns why conversions should be paused, or None if they may run.
+           Once paused, the limits are lowered by GOVERNOR_RESUME_RATIO so
+           that jobs don't flap between paused and running.'''
+        ratio = GOVERNOR_RESUME_RATIO if self.paused else 1.0
+        if self.window and not in_window(self.window, datetime.now()):
+            return 'outside of the conversion window'
+        if self.max_load is not None:
+            load = getloadavg()[0]
+            if load > self.max_load * ratio:
+                return 'load average is {:0.2f}'.format(load)
+        if self.max_pressure is not None:
+            pressure = cpu_pressure()
+            if pressure is not None and pressure > self.max_pressure * ratio:
+                return 'CPU pressure is {:0.2f}%'.format(pressure)
+        return None
+
+    def run(self):
+        while not self._stopped.is_set():
+            reason = self.reason()
+            if reason:
+                if not self.paused:
+                    print("Pausing conversions, {}".format(reason))
+                self.paused = True
+                # re-applied every time so that newly started jobs are paused too
+                self.pool.pause()
+            elif self.paused:
+                print("Resuming conversions")
+                self.paused = False
+                self.pool.resume()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        '''Stops the governor, resuming any paused conversions'''
+        self._stopped.set()
+        if self.paused:
+            self.pool.resume()
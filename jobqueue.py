@@ -0,0 +1,264 @@
+'''A durable, SQLite backed priority queue of conversion jobs'''
+import sqlite3
+from collections import namedtuple
+from os import stat
+from threading import Condition
+from time import time
+
+from constants import DEADLINE_STRETCH
+from converter import ConversionStatus
+
+Job = namedtuple('Job', 'id path attempts priority library queued')
+
+# each policy maps a file's stat, its predicted conversion seconds and the
+# time it was queued to its priority, lower values go first
+PRIORITIES = {
+    'smallest': lambda file_stat, predicted, stamp: file_stat.st_size,
+    'oldest': lambda file_stat, predicted, stamp: file_stat.st_mtime,
+    # the source size stands in for the savings until there's a better estimate
+    'savings': lambda file_stat, predicted, stamp: -file_stat.st_size,
+    'shortest': lambda file_stat, predicted, stamp: predicted,
+    # shortest first, but a job waits at most DEADLINE_STRETCH times its own length
+    # for shorter ones that arrive after it
+    'deadline': lambda file_stat, predicted, stamp: stamp + DEADLINE_STRETCH * predicted,
+}
+# the policies that need an estimate of how long each job takes
+COST_PRIORITIES = {'shortest', 'deadline'}
+
+class JobQueue(object):
+    '''Keeps every known conversion job along with its ConversionStatus and
+       attempt count in a WAL-mode SQLite database, so that the queue
+       survives crashes and restarts. Jobs are handed out in order of the
+       chosen priority policy from PRIORITIES within each library, while the
+       libraries themselves take turns in proportion to their weights so a
+       large drop into one library can't starve the others. estimate is
+       called with a file's path and library name to predict how many
+       seconds converting it takes, for the policies in COST_PRIORITIES.'''
+    def __init__(self, db_path, priority='smallest', weights=None, estimate=None):
+        self.db_path = db_path
+        self.priority = PRIORITIES[priority]
+        self.weights = weights or {}
+        self.estimate = estimate if priority in COST_PRIORITIES else None
+        self.closed = False
+        self._virtual = {}
+        self._ready = Condition()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, '
+                         'status INTEGER NOT NULL, priority REAL NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, error TEXT, '
+                         'created REAL NOT NULL, updated REAL NOT NULL, '
+                         "library TEXT NOT NULL DEFAULT '', size INTEGER, output_size INTEGER, "
+                         'held_until REAL NOT NULL DEFAULT 0)')
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(jobs)')]
+        if 'library' not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN library TEXT NOT NULL DEFAULT ''")
+        for column in ('size', 'output_size'):
+            if column not in columns:
+                self._db.execute('ALTER TABLE jobs ADD COLUMN {} INTEGER'.format(column))
+        if 'held_until' not in columns:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN held_until REAL NOT NULL DEFAULT 0')
+        self._db.execute('DROP INDEX IF EXISTS jobs_ready')
+        self._db.execute('CREATE INDEX IF NOT EXISTS jobs_library_ready '
+                         'ON jobs (status, library, priority, id)')
+        self._db.commit()
+        self._libraries = set(self.weights)
+        self._libraries.update(row[0] for row in self._db.execute('SELECT DISTINCT library '
+                                                                  'FROM jobs'))
+
+    def push(self, file_paths, library=''):
+        '''Queues the given files of a library, re-queueing ones that were
+           previously finished and updating the priority of ones that are
+           still waiting. Running jobs are left alone.'''
+        stamp = time()
+        added = 0
+        # priorities are worked out first since estimating them may mean probing
+        priorities = []
+        for file_path in file_paths:
+            try:
+                file_stat = stat(file_path)
+            except OSError:
+                continue
+            predicted = self.estimate(file_path, library) if self.estimate else 0.0
+            priorities.append((file_path, self.priority(file_stat, predicted, stamp),
+                               file_stat.st_size))
+        with self._ready:
+            self._libraries.add(library)
+            for file_path, priority, size in priorities:
+                cursor = self._db.execute('UPDATE jobs SET status = ?, priority = ?, updated = ?, '
+                                          'library = ?, size = ? WHERE path = ? AND status != ?',
+                                          (ConversionStatus.NONE, priority, stamp, library, size,
+                                           file_path, ConversionStatus.RUNNING))
+                if not cursor.rowcount:
+                    cursor = self._db.execute('INSERT OR IGNORE INTO jobs (path, status, priority, '
+                                              'created, updated, library, size) '
+                                              'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                              (file_path, ConversionStatus.NONE, priority,
+                                               stamp, stamp, library, size))
+                added += cursor.rowcount
+            self._db.commit()
+            if added:
+                self._ready.notify_all()
+        return added
+
+    def discard(self, file_paths):
+        '''Removes waiting jobs for files that are no longer candidates'''
+        with self._ready:
+            self._db.executemany('DELETE FROM jobs WHERE path = ? AND status = ?',
+                                 [(file_path, ConversionStatus.NONE) for file_path in file_paths])
+            self._db.commit()
+
+    def reprioritize(self, file_paths, priority):
+        '''Sets the priority of waiting jobs, returning how many were updated'''
+        with self._ready:
+            updated = sum(self._db.execute('UPDATE jobs SET priority = ? '
+                                           'WHERE path = ? AND status = ?',
+                                           (priority, file_path,
+                                            ConversionStatus.NONE)).rowcount
+                          for file_path in file_paths)
+            self._db.commit()
+        return updated
+
+    def _next(self):
+        '''Takes the head job of the library that has received the least
+           service relative to its weight (weighted fair queueing), skipping
+           jobs that are held'''
+        stamp = time()
+        heads = {}
+        for library in self._libraries:
+            row = self._db.execute('SELECT id, path, attempts, priority, library, updated '
+                                   'FROM jobs WHERE status = ? AND library = ? AND held_until <= ? '
+                                   'ORDER BY priority, id LIMIT 1',
+                                   (ConversionStatus.NONE, library, stamp)).fetchone()
+            if row:
+                heads[library] = row
+        if not heads:
+            return None
+        chosen = min(heads, key=lambda library: (self._virtual.get(library, 0.0), library))
+        self._virtual[chosen] = self._virtual.get(chosen, 0.0) + \
+                                1.0 / self.weights.get(chosen, 1.0)
+        for library in self._libraries:
+            # idle libraries don't bank credit to burst with once they get busy
+            if library not in heads:
+                self._virtual[library] = max(self._virtual.get(library, 0.0),
+                                             self._virtual[chosen])
+        row = heads[chosen]
+        self._db.execute('UPDATE jobs SET status = ?, updated = ? WHERE id = ?',
+                         (ConversionStatus.RUNNING, stamp, row[0]))
+        self._db.commit()
+        return Job(*row)
+
+    def _held_for(self):
+        '''Returns the seconds until the first held job may run, or None if
+           no waiting job is held'''
+        row = self._db.execute('SELECT MIN(held_until) FROM jobs WHERE status = ? '
+                               'AND held_until > ?', (ConversionStatus.NONE, time())).fetchone()
+        return max(0.0, row[0] - time()) if row[0] is not None else None
+
+    def get(self, timeout=None):
+        '''Marks the highest priority waiting job as running and returns it,
+           blocking until one is available. Returns None on timeout or once
+           the queue has been closed.'''
+        deadline = time() + timeout if timeout is not None else None
+        with self._ready:
+            job = self._next()
+            while job is None and not self.closed:
+                wait = self._held_for()
+                if deadline is not None:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._ready.wait(wait)
+                job = self._next()
+            return None if self.closed else job
+
+    def peek(self, limit):
+        '''Returns the paths of up to limit waiting jobs in priority order,
+           without taking them'''
+        with self._ready:
+            rows = self._db.execute('SELECT path FROM jobs WHERE status = ? AND held_until <= ? '
+                                    'ORDER BY priority, id LIMIT ?',
+                                    (ConversionStatus.NONE, time(), limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def finish(self, job, status, error=None, output_size=None):
+        '''Records the final status of a running job, counting an attempt
+           against it if it ended in an error, along with the size of its
+           output if it succeeded'''
+        with self._ready:
+            self._db.execute('UPDATE jobs SET status = ?, error = ?, updated = ?, '
+                             'attempts = attempts + ?, output_size = ? WHERE id = ?',
+                             (status, error, time(),
+                              1 if status == ConversionStatus.ERROR else 0, output_size, job.id))
+            self._db.commit()
+
+    def release(self, job, hold=0.0):
+        '''Puts a running job back in the queue without counting an attempt,
+           for jobs whose worker went away, keeping it from being handed out
+           again for hold seconds'''
+        stamp = time()
+        with self._ready:
+            self._db.execute('UPDATE jobs SET status = ?, updated = ?, held_until = ? '
+                             'WHERE id = ? AND status = ?',
+                             (ConversionStatus.NONE, stamp, stamp + hold if hold else 0.0,
+                              job.id, ConversionStatus.RUNNING))
+            self._db.commit()
+            self._ready.notify_all()
+
+    def attempts(self, file_path):
+        '''Returns the number of failed attempts to convert a file'''
+        with self._ready:
+            row = self._db.execute('SELECT attempts FROM jobs WHERE path = ?',
+                                   (file_path,)).fetchone()
+        return row[0] if row else 0
+
+    def reset(self, file_path):
+        '''Clears the failed attempt counter of a file'''
+        with self._ready:
+            self._db.execute('UPDATE jobs SET attempts = 0, error = NULL WHERE path = ?',
+                             (file_path,))
+            self._db.commit()
+
+    def recover(self):
+        '''Puts jobs that were left running by a crash back in the queue and
+           returns a list of their (path, library) tuples'''
+        with self._ready:
+            paths = self._db.execute('SELECT path, library FROM jobs WHERE status = ?',
+                                     (ConversionStatus.RUNNING,)).fetchall()
+            self._db.execute('UPDATE jobs SET status = ?, updated = ? WHERE status = ?',
+                             (ConversionStatus.NONE, time(), ConversionStatus.RUNNING))
+            self._db.commit()
+            if paths:
+                self._ready.notify_all()
+        return paths
+
+    def counts(self):
+        '''Returns a dict mapping each ConversionStatus to its number of jobs'''
+        with self._ready:
+            rows = self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        counts = {status: 0 for status in ConversionStatus}
+        counts.update({ConversionStatus(status): count for status, count in rows})
+        return counts
+
+    def entries(self, statuses=None):
+        '''Returns the (path, library, status, attempts, error, size,
+           output_size, updated) tuples of every job, or of the jobs with
+           one of the given statuses, in the order they were queued'''
+        query = 'SELECT path, library, status, attempts, error, size, output_size, updated ' \
+                'FROM jobs'
+        params = ()
+        if statuses:
+            query += ' WHERE status IN ({})'.format(', '.join('?' * len(statuses)))
+            params = tuple(statuses)
+        with self._ready:
+            rows = self._db.execute(query + ' ORDER BY id', params).fetchall()
+        return [row[:2] + (ConversionStatus(row[2]),) + row[3:] for row in rows]
+
+    def close(self):
+        '''Wakes up and stops anything waiting for a job'''
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
@@ -1,9 +1,6 @@
 '''Contains all the properties and methods necessary to manage mediainfo objects'''
-from subprocess import check_output
-from re import compile as cmpl
-
-from constants import HEIGHT, WIDTH, BITRATES, AUDIO_KEYS, BITRATE_KEYS
-from utils import str2float
+from constants import HEIGHT, WIDTH, BITRATES, PROBE_BACKEND
+from probe import probe, ProbeResult
 
 class MediaInfoError(Exception):
     '''Exception that indicates an error with mediainfo'''
@@ -20,88 +17,103 @@ class VideoWidthError(MediaInfoError):
         Exception.__init__(self, "Unable to determine video width for: {}".format(video_file))
 
 class MediaInfo(object):
-    '''An object that represents metadata about a media file based on the mediainfo linux program'''
-    def __init__(self, file_path):
-        '''Constructor for a media info object that represents the metadata of a media file'''
+    '''An object that represents metadata about a media file based on the
+       structured output of one of the probe backends'''
+    def __init__(self, file_path, cache=None, backend=PROBE_BACKEND, result=None):
+        '''Constructor for a media info object that represents the metadata of a media file,
+           if a ProbeCache is given it is consulted before probing the file'''
         self.file_path = file_path
-        self.info = {}
-        char = None
-        output = check_output('mediainfo "' + self.file_path + '"', shell=True).decode('UTF-8')
-        for line in output.split('\n'):
-            match = cmpl(r'(.+[^\s])\s+: (.+)').match(line)
-            if match:
-                self.info[char][match.group(1)] = match.group(2)
-            elif len(line) > 1:
-                char = line
-                self.info[char] = {}
+        self.result = result or self._cached(file_path, cache)
+        if self.result is None:
+            self.result = probe([file_path], backend).get(file_path)
+            if self.result is None:
+                raise MediaInfoError("Unable to probe {}".format(file_path))
+            if cache:
+                cache.put(file_path, self.result.to_dict())
 
-    def video_height(self):
-        '''Returns the height of the video in pixels'''
+    @staticmethod
+    def _cached(file_path, cache):
+        '''Returns the cached ProbeResult for a file if there is a usable one'''
+        data = cache.get(file_path) if cache else None
         try:
-            result =  int(str2float(self.info["Video"]["Height"]) if \
-                          str2float(self.info["Video"]["Height"]) < HEIGHT else HEIGHT)
-            return result
-        except KeyError:
+            return ProbeResult.from_dict(data) if data else None
+        except (KeyError, TypeError):
+            return None
+
+    @classmethod
+    def batch(cls, file_paths, cache=None, backend=PROBE_BACKEND):
+        '''Returns a dict of MediaInfo objects for the given files, probing
+           all of the ones that aren't cached in as few invocations as possible'''
+        infos = {}
+        missing = []
+        for file_path in file_paths:
+            try:
+                result = cls._cached(file_path, cache)
+            except OSError:
+                continue
+            if result:
+                infos[file_path] = cls(file_path, result=result)
+            else:
+                missing.append(file_path)
+        for file_path, result in probe(missing, backend).items():
+            if cache:
+                try:
+                    cache.put(file_path, result.to_dict())
+                except OSError:
+                    continue
+            infos[file_path] = cls(file_path, result=result)
+        return infos
+
+    def _video(self):
+        return self.result.video[0] if self.result.video else None
+
+    def _audio(self):
+        return self.result.audio[0] if self.result.audio else None
+
+    def video_height(self, max_height=HEIGHT):
+        '''Returns the height of the video in pixels, capped at max_height'''
+        video = self._video()
+        if video is None or video.height is None:
             raise VideoHeightError
+        return min(video.height, max_height)
 
-    def video_width(self):
-        '''Returns the width of the video in pixels'''
-        try:
-            result =  int(str2float(self.info["Video"]["Width"]) if \
-                          str2float(self.info["Video"]["Width"]) < WIDTH else WIDTH)
-            return result
-        except KeyError:
+    def video_width(self, max_width=WIDTH):
+        '''Returns the width of the video in pixels, capped at max_width'''
+        video = self._video()
+        if video is None or video.width is None:
             raise VideoWidthError
+        return min(video.width, max_width)
+
+    def duration(self):
+        '''Returns the duration of the media in seconds, or None if unknown'''
+        if self.result.duration:
+            return self.result.duration
+        video = self._video()
+        return video.duration if video else None
 
     def _bitrate(self):
-        A = self.info[next(a for a in AUDIO_KEYS if a in self.info)] if \
-            [a for a in AUDIO_KEYS if a in self.info] else None
-        if A:
-            return A[next(b for b in BITRATE_KEYS if b in A)] if \
-                   [b for b in BITRATE_KEYS if b in A] else None
-        else:
+        '''Returns the audio bitrate in kb/s, or None if unknown'''
+        audio = self._audio()
+        if audio is None:
             return None
-        
-    def abr(self):
-        '''Returns the audiobitrate in human-reabable kilobytes'''
-        def pick_bitrate(bitrate):
+        bitrate = audio.bitrate or audio.max_bitrate
+        return bitrate / 1000.0 if bitrate else None
+
+    def abr(self, max_bitrate=max(BITRATES)):
+        '''Returns the audiobitrate in human-reabable kilobytes, capped at max_bitrate'''
+        bitrates = [b for b in BITRATES if b <= max_bitrate] or [min(BITRATES)]
+        def pick_bitrate(br):
             '''Picks the best possible bitrate out of the BITRATES array'''
-            br = int(str2float(next(b for b in bitrate.split('/') \
-                     if 'Unknown' not in b)))
-            if br in BITRATES:
+            if br in bitrates:
                 return br
-            elif br < min(BITRATES):
-                return min(BITRATES)
-            elif br > max(BITRATES):
-                return max(BITRATES)
+            elif br < min(bitrates):
+                return min(bitrates)
+            elif br > max(bitrates):
+                return max(bitrates)
             else:
-                return min(BITRATES, key=lambda x: abs(x-br))
+                return min(bitrates, key=lambda x: abs(x-br))
         B = self._bitrate()
         if B:
-            return str(pick_bitrate(B)) + 'k'
+            return str(pick_bitrate(int(B))) + 'k'
         else:
             return None
-
-    def valid(self):
-        if 'Video' not in self.info:
-            return False
-        elif 'Audio' not in self.info:
-            return False
-        elif 'Width' in self.info['Video']:
-            return False
-        elif 'Height' in self.info['Video']:
-            return False
-        return True
-
-    def more_than_sd(self):
-        try:
-            if str2float(self.info["Video"]["Width"]) > WIDTH:
-                return True
-            elif str2float(self.info["Video"]["Height"]) > HEIGHT:
-                return True
-            elif str2float(self._bitrate()) > max(BITRATES):
-                return True
-            return False
-        except KeyError:
-            print("Media info for {} is invalid, cannot compare to SD".format(self.file_path))
-            return False
@@ -0,0 +1,157 @@
+'''Counters, gauges and per-stage timings for the conversion service, served
+   in the Prometheus text format and written out as JSON snapshots'''
+import json
+from contextlib import contextmanager
+from os import rename
+from threading import Thread, Event
+from time import perf_counter, time
+
+from constants import METRICS_INTERVAL
+
+PREFIX = 'auto_converter_'
+STAGES = ('scan', 'probe', 'queue_wait', 'ffmpeg', 'verify', 'move')
+COUNTERS = ('converted', 'failed', 'retried', 'skipped', 'deduplicated', 'bytes_saved',
+            'bytes_grown')
+GAUGES = ('queue_depth', 'active_workers', 'encode_speed', 'prediction_error')
+
+class StageTimer(object):
+    '''The number of times a stage ran along with its total and longest
+       duration in seconds'''
+    __slots__ = ('count', 'total', 'max')
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        '''Records a single run of the stage'''
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+class Metrics(object):
+    '''All of the service's metrics, allocated up front so that recording
+       one is a dict lookup and an attribute update. Updates deliberately
+       don't take a lock: a rare lost increment between threads is a better
+       trade than contention in the conversion loop.'''
+    def __init__(self):
+        self.stages = {stage: StageTimer() for stage in STAGES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.gauges = dict.fromkeys(GAUGES, 0.0)
+
+    def inc(self, counter, amount=1):
+        '''Increments a counter'''
+        self.counters[counter] += amount
+
+    def record_savings(self, saved):
+        '''Counts the bytes a conversion saved, or those it grew the file by
+           if saved is negative, since a counter can't go down'''
+        if saved >= 0:
+            self.counters['bytes_saved'] += saved
+        else:
+            self.counters['bytes_grown'] -= saved
+
+    def set(self, gauge, value):
+        '''Sets a gauge to a value'''
+        self.gauges[gauge] = value
+
+    def observe(self, stage, seconds):
+        '''Records a run of a stage that took the given number of seconds'''
+        self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timed(self, stage):
+        '''Times the body of the with statement as a run of the stage'''
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage].observe(perf_counter() - started)
+
+    def snapshot(self):
+        '''Returns the current metrics as a dict that can be serialized to JSON'''
+        return {'time': time(), 'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                'stages': {stage: {'count': timer.count, 'seconds': timer.total,
+                                   'max_seconds': timer.max}
+                           for stage, timer in self.stages.items()}}
+
+    def prometheus(self):
+        '''Returns the current metrics in the Prometheus text exposition format'''
+        lines = []
+        for counter, value in self.counters.items():
+            name = PREFIX + counter + '_total'
+            lines.extend(['# TYPE {} counter'.format(name), '{} {}'.format(name, value)])
+        for gauge, value in self.gauges.items():
+            name = PREFIX + gauge
+            lines.extend(['# TYPE {} gauge'.format(name), '{} {}'.format(name, value)])
+        name = PREFIX + 'stage_seconds'
+        lines.append('# TYPE {} summary'.format(name))
+        for stage, timer in self.stages.items():
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, timer.count))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, timer.total))
+        lines.append('# TYPE {}_max gauge'.format(name))
+        for stage, timer in self.stages.items():
+            lines.append('{}_max{{stage="{}"}} {}'.format(name, stage, timer.max))
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+def serve_metrics(port, host='127.0.0.1'):
+    '''Starts serving the metrics over HTTP in a daemon thread and returns
+       the server: /metrics in the Prometheus format and /metrics.json as
+       JSON. http.server is imported here since it's slow to import and
+       most users of this module never serve anything.'''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        '''Answers GET requests for the metrics'''
+        def do_GET(self): # pylint: disable=invalid-name
+            if self.path == '/metrics':
+                body, content_type = METRICS.prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(METRICS.snapshot()), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('UTF-8')
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True, name='metrics-server').start()
+    return server
+
+class SnapshotWriter(Thread):
+    '''A daemon thread that atomically rewrites a JSON snapshot of the
+       metrics every interval seconds'''
+    def __init__(self, file_path, interval=METRICS_INTERVAL):
+        Thread.__init__(self, daemon=True, name='metrics-snapshot')
+        self.file_path = file_path
+        self.interval = interval
+        self._stopped = Event()
+
+    def write(self):
+        '''Writes a snapshot of the current metrics'''
+        with open(self.file_path + '.tmp', 'w') as snapshot_file:
+            json.dump(METRICS.snapshot(), snapshot_file)
+        rename(self.file_path + '.tmp', self.file_path)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as error:
+                print("Unable to write metrics to {}: {}".format(self.file_path, error))
+
+    def stop(self):
+        '''Stops the thread after writing a final snapshot'''
+        self._stopped.set()
+        self.write()
@@ -0,0 +1,171 @@
+'''Probe backends that read media metadata as structured JSON from either
+   mediainfo or ffprobe and map it into a small typed stream model'''
+import json
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import check_output, CalledProcessError, DEVNULL
+
+from constants import PROBE_BATCH_SIZE
+from metrics import METRICS
+
+class ProbeError(Exception):
+    '''Exception that indicates a file could not be probed'''
+    pass
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _int(value):
+    value = _float(value)
+    return int(value) if value is not None else None
+
+class StreamInfo(object):
+    '''A single video or audio stream. Bit rates are in bits per second and
+       the duration is in seconds.'''
+    __slots__ = ('kind', 'codec', 'width', 'height', 'bitrate', 'max_bitrate',
+                 'duration', 'frame_count', 'channels')
+    def __init__(self, kind, codec=None, width=None, height=None, bitrate=None,
+                 max_bitrate=None, duration=None, frame_count=None, channels=None):
+        self.kind = kind
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.bitrate = bitrate
+        self.max_bitrate = max_bitrate
+        self.duration = duration
+        self.frame_count = frame_count
+        self.channels = channels
+
+    def to_dict(self):
+        '''Returns the stream as a dict that can be serialized to JSON'''
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+class ProbeResult(object):
+    '''The container level metadata of a file along with its streams'''
+    __slots__ = ('path', 'container', 'duration', 'size', 'bitrate', 'video', 'audio')
+    def __init__(self, path, container=None, duration=None, size=None, bitrate=None):
+        self.path = path
+        self.container = container
+        self.duration = duration
+        self.size = size
+        self.bitrate = bitrate
+        self.video = []
+        self.audio = []
+
+    def add(self, stream):
+        '''Adds a stream to the video or audio list depending on its kind'''
+        if stream.kind == 'video':
+            self.video.append(stream)
+        elif stream.kind == 'audio':
+            self.audio.append(stream)
+
+    def to_dict(self):
+        '''Returns the result as a dict that can be serialized to JSON'''
+        return {'path': self.path, 'container': self.container, 'duration': self.duration,
+                'size': self.size, 'bitrate': self.bitrate,
+                'streams': [stream.to_dict() for stream in self.video + self.audio]}
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Rebuilds a result from the output of to_dict, raises KeyError if
+           the data isn't in that format'''
+        result = cls(data['path'], data['container'], data['duration'], data['size'],
+                     data['bitrate'])
+        for stream in data['streams']:
+            result.add(StreamInfo(**stream))
+        return result
+
+class MediaInfoBackend(object):
+    '''Probes files with mediainfo --Output=JSON, many files per invocation'''
+    name = 'mediainfo'
+
+    def _cmd(self, file_paths):
+        return ['mediainfo', '--Output=JSON'] + list(file_paths)
+
+    def probe(self, file_paths):
+        '''Returns a dict mapping each probed path to its ProbeResult, paths
+           that couldn't be probed are left out'''
+        results = {}
+        for start in range(0, len(file_paths), PROBE_BATCH_SIZE):
+            batch = file_paths[start:start + PROBE_BATCH_SIZE]
+            try:
+                output = json.loads(check_output(self._cmd(batch), stderr=DEVNULL))
+            except (OSError, CalledProcessError, ValueError):
+                continue
+            # a single file gives an object, several files give a list of them
+            for document in output if isinstance(output, list) else [output]:
+                result = self._parse(document.get('media') or {})
+                if result:
+                    results[result.path] = result
+        return results
+
+    def _parse(self, media):
+        if '@ref' not in media:
+            return None
+        result = ProbeResult(media['@ref'])
+        for track in media.get('track', []):
+            kind = track.get('@type')
+            if kind == 'General':
+                result.container = track.get('Format')
+                result.duration = _float(track.get('Duration'))
+                result.size = _int(track.get('FileSize'))
+                result.bitrate = _int(track.get('OverallBitRate'))
+            elif kind in ('Video', 'Audio'):
+                result.add(StreamInfo(kind.lower(), track.get('Format'),
+                                      _int(track.get('Width')), _int(track.get('Height')),
+                                      _int(track.get('BitRate')),
+                                      _int(track.get('BitRate_Maximum')),
+                                      _float(track.get('Duration')),
+                                      _int(track.get('FrameCount')),
+                                      _int(track.get('Channels'))))
+        return result
+
+class FFProbeBackend(object):
+    '''Probes files with ffprobe -print_format json. ffprobe only takes one
+       input per invocation so batches are probed concurrently instead.'''
+    name = 'ffprobe'
+
+    def _cmd(self, file_path):
+        return ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format',
+                '-show_streams', file_path]
+
+    def _probe_one(self, file_path):
+        try:
+            output = json.loads(check_output(self._cmd(file_path), stderr=DEVNULL))
+        except (OSError, CalledProcessError, ValueError):
+            return None
+        container = output.get('format', {})
+        result = ProbeResult(file_path, container.get('format_name'),
+                             _float(container.get('duration')), _int(container.get('size')),
+                             _int(container.get('bit_rate')))
+        for stream in output.get('streams', []):
+            tags = stream.get('tags', {})
+            result.add(StreamInfo(stream.get('codec_type'), stream.get('codec_name'),
+                                  _int(stream.get('width')), _int(stream.get('height')),
+                                  _int(stream.get('bit_rate')),
+                                  _int(stream.get('max_bit_rate')),
+                                  _float(stream.get('duration')),
+                                  _int(stream.get('nb_frames') or tags.get('NUMBER_OF_FRAMES')),
+                                  _int(stream.get('channels'))))
+        return result
+
+    def probe(self, file_paths):
+        '''Returns a dict mapping each probed path to its ProbeResult, paths
+           that couldn't be probed are left out'''
+        if len(file_paths) == 1:
+            results = [self._probe_one(file_paths[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(8, len(file_paths) or 1)) as executor:
+                results = list(executor.map(self._probe_one, file_paths))
+        return {result.path: result for result in results if result}
+
+BACKENDS = {backend.name: backend for backend in (MediaInfoBackend(), FFProbeBackend())}
+
+def probe(file_paths, backend):
+    '''Probes a list of files with the named backend'''
+    if backend not in BACKENDS:
+        raise ProbeError('Unknown probe backend: {}'.format(backend))
+    with METRICS.timed('probe'):
+        return BACKENDS[backend].probe(list(file_paths))
@@ -0,0 +1,96 @@
+'''A persistent, SQLite backed cache of mediainfo probe results'''
+import sqlite3
+from json import dumps, loads
+from os import stat
+from os.path import abspath
+from threading import Lock
+
+from constants import PROBE_CACHE_SIZE
+
+class ProbeCache(object):
+    '''Caches probe results keyed on a file's inode, size and mtime so that
+       files which have not changed are never probed a second time. The
+       least recently used entries are evicted once the cache grows past
+       max_entries.'''
+    def __init__(self, db_path, max_entries=PROBE_CACHE_SIZE):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS probes ('
+                         'path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, '
+                         'mtime_ns INTEGER, accessed INTEGER, info TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS probes_accessed ON probes (accessed)')
+        count, clock = self._db.execute('SELECT COUNT(*), MAX(accessed) FROM probes').fetchone()
+        self._count = count
+        self._clock = clock or 0
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get(self, file_path, file_stat=None):
+        '''Returns the cached probe result for a file or None if there is no
+           entry or the file has changed since it was probed'''
+        file_path = abspath(file_path)
+        file_stat = file_stat or stat(file_path)
+        with self._lock:
+            row = self._db.execute('SELECT inode, size, mtime_ns, info FROM probes '
+                                   'WHERE path = ?', (file_path,)).fetchone()
+            if row and tuple(row[:3]) == (file_stat.st_ino, file_stat.st_size,
+                                          file_stat.st_mtime_ns):
+                self._db.execute('UPDATE probes SET accessed = ? WHERE path = ?',
+                                 (self._tick(), file_path))
+                self.hits += 1
+                return loads(row[3])
+            self.misses += 1
+            return None
+
+    def put(self, file_path, info, file_stat=None):
+        '''Stores the probe result for a file, evicting the least recently
+           used entries if the cache is full'''
+        file_path = abspath(file_path)
+        file_stat = file_stat or stat(file_path)
+        with self._lock:
+            cursor = self._db.execute('UPDATE probes SET inode = ?, size = ?, mtime_ns = ?, '
+                                      'accessed = ?, info = ? WHERE path = ?',
+                                      (file_stat.st_ino, file_stat.st_size,
+                                       file_stat.st_mtime_ns, self._tick(),
+                                       dumps(info), file_path))
+            if not cursor.rowcount:
+                self._db.execute('INSERT INTO probes VALUES (?, ?, ?, ?, ?, ?)',
+                                 (file_path, file_stat.st_ino, file_stat.st_size,
+                                  file_stat.st_mtime_ns, self._tick(), dumps(info)))
+                self._count += 1
+            if self._count > self.max_entries:
+                excess = self._count - self.max_entries
+                self._db.execute('DELETE FROM probes WHERE path IN (SELECT path FROM probes '
+                                 'ORDER BY accessed LIMIT ?)', (excess,))
+                self._count -= excess
+                self.evictions += excess
+
+    def invalidate(self, file_path):
+        '''Removes any cached probe result for a file'''
+        with self._lock:
+            cursor = self._db.execute('DELETE FROM probes WHERE path = ?', (abspath(file_path),))
+            self._count -= cursor.rowcount
+
+    def flush(self):
+        '''Commits any pending cache updates to disk'''
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        '''Commits pending updates and closes the cache database'''
+        self.flush()
+        self._db.close()
+
+    def stats(self):
+        '''Returns a dict with the hit/miss counters and the size of the cache'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': self._count}
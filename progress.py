@@ -0,0 +1,80 @@
+'''Parses the key/value progress stream that ffmpeg writes with -progress
+   and collects the tail of its log output'''
+from collections import deque
+from os import fdopen
+from threading import Thread
+
+def _number(value, cast):
+    '''Casts an ffmpeg progress value, which may be N/A or carry a unit suffix'''
+    try:
+        return cast(value.rstrip('xkbits/'))
+    except ValueError:
+        return None
+
+class FFmpegProgress(object):
+    '''The latest progress reported by an ffmpeg process. out_time is the
+       position in the output in seconds and speed is the encoding speed as
+       a multiple of realtime.'''
+    __slots__ = ('frame', 'fps', 'bitrate', 'total_size', 'out_time', 'speed', 'finished')
+    def __init__(self):
+        self.frame = 0
+        self.fps = 0.0
+        self.bitrate = None
+        self.total_size = 0
+        self.out_time = 0.0
+        self.speed = None
+        self.finished = False
+
+    def update(self, key, value):
+        '''Updates the progress from a single key=value line'''
+        if key == 'frame':
+            self.frame = _number(value, int) or self.frame
+        elif key == 'fps':
+            self.fps = _number(value, float) or self.fps
+        elif key == 'bitrate':
+            self.bitrate = _number(value, float)
+        elif key == 'total_size':
+            self.total_size = _number(value, int) or self.total_size
+        elif key == 'out_time_us':
+            out_time = _number(value, int)
+            if out_time is not None and out_time >= 0:
+                self.out_time = out_time / 1000000.0
+        elif key == 'speed':
+            self.speed = _number(value, float)
+        elif key == 'progress':
+            self.finished = value == 'end'
+
+class ProgressReader(Thread):
+    '''A daemon thread that reads ffmpeg's progress stream from a file
+       descriptor so that the progress can be polled without blocking'''
+    def __init__(self, fd):
+        Thread.__init__(self, daemon=True)
+        self.fd = fd
+        self.progress = FFmpegProgress()
+
+    def run(self):
+        with fdopen(self.fd, 'rb') as stream:
+            for line in stream:
+                key, _, value = line.decode('UTF-8', 'replace').strip().partition('=')
+                if value:
+                    self.progress.update(key, value)
+
+class LogTail(Thread):
+    '''A daemon thread that copies ffmpeg's stderr into its log file while
+       keeping the last few lines around for error reporting'''
+    def __init__(self, stream, log_file, lines=20):
+        Thread.__init__(self, daemon=True)
+        self.stream = stream
+        self.log_file = log_file
+        self.lines = deque(maxlen=lines)
+
+    def run(self):
+        with self.stream, self.log_file:
+            for line in self.stream:
+                line = line.decode('UTF-8', 'replace')
+                self.log_file.write(line)
+                self.lines.append(line.rstrip())
+
+    def tail(self):
+        '''Returns the last lines written by ffmpeg as a single string'''
+        return '\n'.join(self.lines)
@@ -0,0 +1,221 @@
+'''Reports on the files of the libraries and what became of them, from the
+   job queue when the service keeps one and otherwise from the conversion
+   logs found by walking the directories'''
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import scandir, makedirs
+from os.path import join, dirname, relpath, isfile, getsize
+from shutil import move
+
+from constants import REPORT_WORKERS
+from control import request, ControlError
+from converter import ConversionStatus, conversion_paths
+from utils import is_media_file
+
+SUCCESSFUL, FAILED, PENDING, IN_PROGRESS, STOPPED = \
+    'successful', 'failed', 'pending', 'in_progress', 'stopped'
+STATES = {ConversionStatus.NONE: PENDING, ConversionStatus.RUNNING: IN_PROGRESS,
+          ConversionStatus.PAUSED: IN_PROGRESS, ConversionStatus.STOPPED: STOPPED,
+          ConversionStatus.ERROR: FAILED, ConversionStatus.DONE: SUCCESSFUL}
+FIELDS = ('path', 'library', 'state', 'size', 'output_size', 'saved', 'errors', 'error')
+# the outcome is the last line of a conversion log, after ffmpeg's output
+LOG_TAIL = 64
+
+class Entry(object):
+    '''A file in the report along with what became of it'''
+    __slots__ = FIELDS
+    def __init__(self, path, library, state, size=None, output_size=None, errors=0, error=None):
+        self.path = path
+        self.library = library
+        self.state = state
+        self.size = size
+        self.output_size = output_size
+        self.saved = size - output_size if size is not None and output_size is not None else None
+        self.errors = errors
+        self.error = error
+
+    def to_dict(self):
+        '''Returns the entry as a dict that can be serialized to JSON'''
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+def _size(file_path):
+    '''Returns the size of a file, or None if it doesn't exist'''
+    try:
+        return getsize(file_path)
+    except OSError:
+        return None
+
+def from_queue(queue, libraries, workers=REPORT_WORKERS):
+    '''Returns the Entries for the jobs in a JobQueue. Only the jobs that
+       were queued before the queue kept sizes have their files looked at,
+       by a pool of threads since there may be many of them on a slow disk.'''
+    def sizes(row):
+        path, library, status, _, _, size, output_size, _ = row
+        if size is None:
+            size = _size(path)
+        if output_size is None and status == ConversionStatus.DONE:
+            output_size = _size(conversion_paths(path, libraries.get(library))[1])
+        return size, output_size
+
+    rows = queue.entries()
+    with ThreadPoolExecutor(workers) as executor:
+        unsized = [row for row in rows
+                   if row[5] is None or (row[6] is None and row[2] == ConversionStatus.DONE)]
+        found = dict(zip([row[0] for row in unsized], executor.map(sizes, unsized)))
+    return [Entry(path, library, STATES[status], *found.get(path, (size, output_size)),
+                  errors=attempts, error=error)
+            for path, library, status, attempts, error, size, output_size, _ in rows]
+
+def _scan(directory):
+    '''Lists a directory, returns its subdirectories and its files with their sizes'''
+    directories, files = [], {}
+    try:
+        with scandir(directory) as dir_entries:
+            for dir_entry in dir_entries:
+                try:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        directories.append(dir_entry.path)
+                    elif dir_entry.is_file():
+                        files[dir_entry.path] = dir_entry.stat().st_size
+                except OSError:
+                    pass
+    except OSError as error:
+        print("Unable to scan {}: {}".format(directory, error))
+    return directories, files
+
+def walk(roots, workers=REPORT_WORKERS):
+    '''Returns a dict mapping every file under the roots to its size, with
+       the directories listed in parallel by a pool of threads'''
+    files = {}
+    with ThreadPoolExecutor(workers) as executor:
+        pending = [executor.submit(_scan, root) for root in set(roots)]
+        while pending:
+            directories, found = pending.pop().result()
+            files.update(found)
+            pending.extend(executor.submit(_scan, directory) for directory in directories)
+    return files
+
+def log_outcome(log_file_path):
+    '''Returns SUCCESSFUL or FAILED from the end of a conversion log, or
+       None if the conversion hasn't finished'''
+    try:
+        with open(log_file_path, 'rb') as log_file:
+            log_file.seek(max(0, getsize(log_file_path) - LOG_TAIL))
+            tail = log_file.read()
+    except OSError:
+        return None
+    if b'Conversion Successful' in tail:
+        return SUCCESSFUL
+    if b'Conversion Failure' in tail:
+        return FAILED
+    return None
+
+def _library_of(output_file_path, libraries):
+    '''Returns the name of the library an output belongs to'''
+    for library in libraries.values():
+        directory = library.output_directory or library.input_directory
+        if not relpath(output_file_path, directory).startswith('..'):
+            return library.name
+    return ''
+
+def from_walk(libraries, workers=REPORT_WORKERS):
+    '''Returns the Entries for the files of the libraries, found by walking
+       their directories and reading the end of every conversion log. Only
+       the logs tell what happened, so a converted source that has been
+       retired is reported by its output without the bytes saved, and mp4
+       files without a log, which may well be in the SD format already,
+       aren't reported at all.'''
+    roots = [library.input_directory for library in libraries.values()]
+    roots.extend(library.output_directory for library in libraries.values()
+                 if library.output_directory)
+    files = walk(roots, workers)
+    logs = [file_path for file_path in files if file_path.endswith('.conversion.log')]
+    with ThreadPoolExecutor(workers) as executor:
+        outcomes = dict(zip(logs, executor.map(log_outcome, logs)))
+    entries = []
+    for library in libraries.values():
+        for file_path, size in files.items():
+            if not is_media_file(file_path) or not library.contains(file_path) or \
+               file_path.endswith('.converting.mp4') or dirname(file_path).endswith('.segments'):
+                continue
+            dst_file_path, final_dst_file_path, log_file_path = conversion_paths(file_path, library)
+            # in place conversions leave their output among the sources
+            if file_path == final_dst_file_path:
+                continue
+            outcome = outcomes.get(log_file_path)
+            if dst_file_path in files:
+                state = IN_PROGRESS
+            elif outcome == FAILED:
+                state = FAILED
+            else:
+                state = PENDING
+            entries.append(Entry(file_path, library.name, state, size, errors=int(state == FAILED)))
+    for log_file_path, outcome in outcomes.items():
+        final_dst_file_path = log_file_path[:-len('.conversion.log')] + '.mp4'
+        if outcome == SUCCESSFUL and final_dst_file_path in files:
+            entries.append(Entry(final_dst_file_path, _library_of(final_dst_file_path, libraries),
+                                 SUCCESSFUL, output_size=files[final_dst_file_path]))
+    return entries
+
+def write_csv(entries, output):
+    '''Writes the entries to a file object as CSV with a header row'''
+    writer = csv.writer(output)
+    writer.writerow(FIELDS)
+    writer.writerows([getattr(entry, field) for field in FIELDS] for entry in entries)
+
+def write_json(entries, output):
+    '''Writes the entries to a file object as a JSON list'''
+    json.dump([entry.to_dict() for entry in entries], output, indent=2)
+    output.write('\n')
+
+def summary(entries):
+    '''Returns a line with the number of files in each state and the total
+       bytes saved'''
+    counts = {}
+    for entry in entries:
+        counts[entry.state] = counts.get(entry.state, 0) + 1
+    saved = sum(entry.saved for entry in entries if entry.saved)
+    return "{}, {:0.1f} GiB saved".format(
+        ', '.join('{} {}'.format(counts.get(state, 0), state)
+                  for state in (SUCCESSFUL, FAILED, PENDING, IN_PROGRESS, STOPPED)),
+        saved / 1024.0 ** 3)
+
+def reset_errors(queue, entries, socket_path=None):
+    '''Clears the error counters of the failed entries and queues them
+       again, returns how many were requeued. When the service is running
+       they're submitted through its control socket, so that its workers
+       wake up for them and they get its priorities.'''
+    failed = [entry for entry in entries if entry.state == FAILED and isfile(entry.path)]
+    for entry in failed:
+        queue.reset(entry.path)
+    if socket_path is not None and failed:
+        try:
+            return request(socket_path, 'submit',
+                           paths=[entry.path for entry in failed])['queued']
+        except ControlError as error:
+            print("{}, queueing the failed files directly".format(error))
+    requeued = 0
+    for entry in failed:
+        requeued += queue.push([entry.path], entry.library)
+    return requeued
+
+def move_failed(entries, libraries, directory=None):
+    '''Moves the sources of the failed entries into directory, or into the
+       error directory of their library when it isn't given, keeping their
+       paths relative to the library. Returns how many were moved.'''
+    moved = 0
+    for entry in entries:
+        library = libraries.get(entry.library)
+        if entry.state != FAILED or library is None or not isfile(entry.path):
+            continue
+        error_path = join(directory, relpath(entry.path, library.input_directory)) \
+                     if directory else library.error_path(entry.path)
+        if not error_path:
+            print("[{}] has no error_directory to move {} to".format(library.name, entry.path))
+            continue
+        print("Moving {} to {}".format(entry.path, error_path))
+        makedirs(dirname(error_path), exist_ok=True)
+        move(entry.path, error_path)
+        moved += 1
+    return moved
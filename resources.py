@@ -0,0 +1,254 @@
+'''Keeps conversions from starving the rest of the host, by running ffmpeg
+   under nice and ionice and, where cgroup v2 can be written to, in a
+   cgroup of its own with CPU, IO and memory limits'''
+from itertools import count
+from os import stat, listdir, getpid, makedirs, rmdir, major, minor, setpriority, PRIO_PROCESS
+from os.path import join, isfile, dirname, exists, normpath, realpath
+from shutil import which
+from subprocess import run, DEVNULL
+from threading import Lock
+
+from config import DEFAULT_RESOURCES, IONICE_CLASSES, parse_resources
+from constants import CGROUP_MOUNT, CGROUP_SERVICE, CGROUP_CONTROLLERS, CPU_PERIOD
+
+def own_cgroup(cgroup_file='/proc/self/cgroup'):
+    '''Returns the directory of the cgroup v2 this process runs in, or None
+       if it isn't in a cgroup v2 hierarchy'''
+    try:
+        with open(cgroup_file) as cgroups:
+            for line in cgroups:
+                if line.startswith('0::'):
+                    return normpath(join(CGROUP_MOUNT, line.strip()[3:].lstrip('/')))
+    except OSError:
+        pass
+    return None
+
+def block_device(file_path):
+    '''Returns the "major:minor" of the whole disk a file, or the nearest
+       directory above it that exists, is stored on, which is what io.max
+       takes, or None if it isn't on a block device'''
+    while not exists(file_path) and dirname(file_path) != file_path:
+        file_path = dirname(file_path)
+    try:
+        device = stat(file_path).st_dev
+    except OSError:
+        return None
+    if not major(device):
+        # network and virtual filesystems have no block device to limit
+        return None
+    sysfs = '/sys/dev/block/{}:{}'.format(major(device), minor(device))
+    if isfile(join(sysfs, 'partition')):
+        try:
+            with open(join(dirname(realpath(sysfs)), 'dev')) as disk:
+                return disk.read().strip()
+        except OSError:
+            return None
+    return '{}:{}'.format(major(device), minor(device))
+
+def ionice_args(policy):
+    '''Returns the ionice options for a policy, or None if it sets no class'''
+    if policy.ionice is None:
+        return None
+    args = ['-c', str(IONICE_CLASSES.index(policy.ionice) + 1)]
+    if policy.ionice_level is not None and policy.ionice != 'idle':
+        args.extend(['-n', str(policy.ionice_level)])
+    return args
+
+class Cgroups(object):
+    '''A cgroup v2 subtree at root, the service's own cgroup by default,
+       under which each conversion gets a cgroup of its own. Processes can't
+       share a cgroup with child cgroups that have controllers enabled, so
+       the service moves itself into a CGROUP_SERVICE child first, which
+       works for a systemd unit with Delegate=yes. Anything else left in
+       root keeps the controllers from being enabled.'''
+    def __init__(self, root=None):
+        self.root = root or own_cgroup()
+        self.controllers = []
+
+    @staticmethod
+    def _write(file_path, value):
+        with open(file_path, 'w') as cgroup_file:
+            cgroup_file.write(value)
+
+    def setup(self):
+        '''Enables the controllers for the conversion cgroups, returns True
+           if the subtree can be used'''
+        if self.root is None:
+            print("Not running in a cgroup v2 hierarchy, limiting with nice and ionice only")
+            return False
+        try:
+            with open(join(self.root, 'cgroup.controllers')) as controllers:
+                available = controllers.read().split()
+            if realpath(self.root) != realpath(CGROUP_MOUNT):
+                service = join(self.root, CGROUP_SERVICE)
+                makedirs(service, exist_ok=True)
+                self._write(join(service, 'cgroup.procs'), str(getpid()))
+            self.controllers = [controller for controller in CGROUP_CONTROLLERS
+                                if controller in available]
+            self._write(join(self.root, 'cgroup.subtree_control'),
+                        ' '.join('+' + controller for controller in self.controllers))
+        except OSError as error:
+            print("Unable to use cgroups under {}, limiting with nice and ionice only: {}"
+                  .format(self.root, error))
+            return False
+        print("Limiting conversions with cgroups under {} ({})".format(
+            self.root, ', '.join(self.controllers)))
+        return True
+
+    def create(self, name):
+        '''Creates a cgroup for a conversion and returns its directory'''
+        path = join(self.root, name)
+        # one left behind by a crash is empty and can be reused
+        makedirs(path, exist_ok=True)
+        return path
+
+    def limit(self, path, policy, devices=()):
+        '''Writes a policy's limits to a cgroup, lifting the ones it doesn't set'''
+        if 'cpu' in self.controllers:
+            quota = int(policy.cpu_max * CPU_PERIOD) if policy.cpu_max else 'max'
+            self._write(join(path, 'cpu.max'), '{} {}'.format(quota, CPU_PERIOD))
+        if 'memory' in self.controllers:
+            self._write(join(path, 'memory.max'), str(policy.memory_max or 'max'))
+        if 'io' in self.controllers:
+            rate = policy.io_max or 'max'
+            for device in devices:
+                self._write(join(path, 'io.max'), '{} rbps={} wbps={}'.format(device, rate, rate))
+
+    def attach(self, path, pid):
+        '''Moves a process into a cgroup'''
+        self._write(join(path, 'cgroup.procs'), str(pid))
+
+    @staticmethod
+    def remove(path):
+        '''Removes a cgroup once its processes are gone'''
+        rmdir(path)
+
+class ResourceGroup(object):
+    '''The ffmpeg processes of a single conversion and the ResourcePolicy
+       they run under, with a cgroup of their own if cgroups is given'''
+    def __init__(self, name, policy, cgroups=None, paths=()):
+        self.policy = policy
+        self.pids = []
+        self.devices = sorted({device for device in map(block_device, paths) if device})
+        self.cgroups = cgroups
+        self.cgroup = None
+        if cgroups is not None:
+            try:
+                self.cgroup = cgroups.create(name)
+                cgroups.limit(self.cgroup, policy, self.devices)
+            except OSError as error:
+                print("Unable to create the cgroup {}: {}".format(name, error))
+                self.close()
+
+    def wrap(self, cmd):
+        '''Returns a command that runs cmd under the policy's nice and
+           ionice. Both exec the command, so its pid stays the same.'''
+        prefix = []
+        if self.policy.nice is not None and which('nice'):
+            prefix.extend(['nice', '-n', str(self.policy.nice)])
+        if ionice_args(self.policy) and which('ionice'):
+            prefix.extend(['ionice'] + ionice_args(self.policy))
+        return prefix + list(cmd)
+
+    def attach(self, pid):
+        '''Adds a started ffmpeg process to the group'''
+        self.pids.append(pid)
+        if self.cgroup is not None:
+            try:
+                self.cgroups.attach(self.cgroup, pid)
+            except OSError as error:
+                print("Unable to move {} into {}: {}".format(pid, self.cgroup, error))
+
+    def _threads(self):
+        '''Returns the ids of every thread of the group's live processes,
+           since nice and ionice are set per thread'''
+        tids = []
+        for pid in self.pids:
+            try:
+                tids.extend(int(tid) for tid in listdir('/proc/{}/task'.format(pid)))
+            except OSError:
+                pass
+        return tids
+
+    def apply(self, policy):
+        '''Switches the running processes to a new policy. Unprivileged
+           processes can only lower their own priority, so raising it back
+           may be refused; a new -threads only applies to later conversions.'''
+        self.policy = policy
+        tids = self._threads()
+        refused = None
+        for tid in tids:
+            # threads can exit or refuse one by one, the others still get reniced
+            try:
+                setpriority(PRIO_PROCESS, tid, policy.nice or 0)
+            except OSError as error:
+                refused = error
+        if refused is not None:
+            print("Unable to renice some conversion threads: {}".format(refused))
+        if tids and which('ionice'):
+            # class 0 puts the processes back to the default
+            run(['ionice'] + (ionice_args(policy) or ['-c', '0']) + ['-p'] +
+                [str(tid) for tid in tids],
+                stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        if self.cgroup is not None:
+            try:
+                self.cgroups.limit(self.cgroup, policy, self.devices)
+            except OSError as error:
+                print("Unable to change the limits of {}: {}".format(self.cgroup, error))
+
+    def close(self):
+        '''Removes the group's cgroup, once its processes have exited'''
+        if self.cgroup is not None:
+            try:
+                self.cgroups.remove(self.cgroup)
+            except OSError as error:
+                print("Unable to remove the cgroup {}: {}".format(self.cgroup, error))
+            self.cgroup = None
+
+class ResourceLimits(object):
+    '''Hands out a ResourceGroup with its library's ResourcePolicy to every
+       conversion, and applies changed policies to the running ones.
+       libraries maps library names to Libraries. Per conversion cgroups
+       are used when cgroups, a Cgroups, is given and could be set up.'''
+    def __init__(self, libraries, cgroups=None):
+        self.policies = {name: library.resources for name, library in libraries.items()}
+        self.cgroups = cgroups if cgroups is not None and cgroups.setup() else None
+        self._groups = {}
+        self._ids = count()
+        self._lock = Lock()
+
+    def policy(self, library_name=''):
+        '''Returns the current ResourcePolicy of a library'''
+        with self._lock:
+            return self.policies.get(library_name, DEFAULT_RESOURCES)
+
+    def group(self, library_name='', paths=()):
+        '''Returns a new ResourceGroup for a conversion of a library that
+           reads and writes the given paths, to be released when it ends'''
+        with self._lock:
+            name = 'conversion-{}'.format(next(self._ids))
+            policy = self.policies.get(library_name, DEFAULT_RESOURCES)
+        group = ResourceGroup(name, policy, self.cgroups, paths)
+        with self._lock:
+            self._groups[group] = library_name
+        return group
+
+    def release(self, group):
+        '''Forgets a group whose conversion has ended and removes its cgroup'''
+        with self._lock:
+            self._groups.pop(group, None)
+        group.close()
+
+    def update(self, library_name, changes):
+        '''Changes limits of a library, given as a mapping of option names
+           to strings like the ones in the config file, and applies them to
+           its running conversions. Returns the new policy. Raises
+           ConfigError if a limit is invalid.'''
+        with self._lock:
+            policy = parse_resources(changes, self.policies.get(library_name,
+                                                                DEFAULT_RESOURCES))
+            self.policies[library_name] = policy
+            groups = [group for group, name in self._groups.items() if name == library_name]
+        for group in groups:
+            group.apply(policy)
+        return policy
@@ -0,0 +1,150 @@
+'''An incremental directory scanner that only revisits directories that changed'''
+from collections import namedtuple
+from os import scandir, stat
+from os.path import join, dirname, basename
+
+ScanDelta = namedtuple('ScanDelta', 'new changed removed')
+
+class _DirectoryState(object):
+    '''The last observed state of a single directory'''
+    __slots__ = ('mtime_ns', 'subdirs', 'files')
+    def __init__(self, mtime_ns):
+        self.mtime_ns = mtime_ns
+        self.subdirs = set()
+        self.files = {}
+
+class IncrementalScanner(object):
+    '''Remembers the mtime of every directory under root along with the
+       verdict of the decide function for every file. Subsequent scans only
+       list directories whose mtime has moved, so a scan of an unchanged tree
+       costs one stat call per directory. Note that a file modified in place
+       does not move its directory's mtime, use invalidate() for those. If
+       given, prefetch is called with the list of files in a directory that
+       are about to be decided so that they can be probed in one batch.'''
+    def __init__(self, root, decide, prefetch=None):
+        self.root = root
+        self.decide = decide
+        self.prefetch = prefetch
+        self.verdicts = {}
+        self._dirs = {}
+
+    def scan(self, full=False):
+        '''Scans the tree and returns a ScanDelta of paths that became
+           candidates, candidates whose file changed, and paths which are no
+           longer candidates. If full is set every directory is listed.'''
+        delta = ScanDelta([], [], [])
+        stack = [self.root]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime_ns = stat(dir_path).st_mtime_ns
+            except OSError:
+                self._forget_dir(dir_path, delta)
+                continue
+            state = self._dirs.get(dir_path)
+            if state is None or full or state.mtime_ns != mtime_ns:
+                state = self._list_dir(dir_path, mtime_ns, state, delta)
+            stack.extend(state.subdirs)
+        return delta
+
+    def _list_dir(self, dir_path, mtime_ns, old_state, delta):
+        '''Lists a directory, deciding on any new or modified files'''
+        state = _DirectoryState(mtime_ns)
+        old_files = old_state.files if old_state else {}
+        try:
+            entries = list(scandir(dir_path))
+        except OSError:
+            entries = []
+        undecided = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    state.subdirs.add(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            signature = (entry_stat.st_size, entry_stat.st_mtime_ns)
+            state.files[entry.name] = signature
+            previous = old_files.get(entry.name)
+            if previous != signature or entry.path not in self.verdicts:
+                undecided.append((entry, previous))
+        if self.prefetch and undecided:
+            self.prefetch([entry.path for entry, _ in undecided])
+        for entry, previous in undecided:
+            was_candidate = self.verdicts.get(entry.path, False)
+            verdict = self.verdicts[entry.path] = self.decide(entry.path)
+            if verdict and previous is None:
+                delta.new.append(entry.path)
+            elif verdict:
+                delta.changed.append(entry.path)
+            elif was_candidate:
+                delta.removed.append(entry.path)
+        for name in old_files:
+            if name not in state.files:
+                self._forget_file(join(dir_path, name), delta)
+        if old_state:
+            for subdir in old_state.subdirs - state.subdirs:
+                self._forget_dir(subdir, delta)
+        self._dirs[dir_path] = state
+        return state
+
+    def _forget_file(self, file_path, delta):
+        if self.verdicts.pop(file_path, False):
+            delta.removed.append(file_path)
+
+    def _forget_dir(self, dir_path, delta):
+        state = self._dirs.pop(dir_path, None)
+        if state:
+            for name in state.files:
+                self._forget_file(join(dir_path, name), delta)
+            for subdir in state.subdirs:
+                self._forget_dir(subdir, delta)
+
+    def refresh(self, file_paths):
+        '''Re-decides a set of individual files, for example ones reported by
+           a DirectoryWatcher, without listing their directories. Returns a
+           ScanDelta like scan()'''
+        delta = ScanDelta([], [], [])
+        if self.prefetch and file_paths:
+            self.prefetch(list(file_paths))
+        for file_path in file_paths:
+            state = self._dirs.get(dirname(file_path))
+            name = basename(file_path)
+            try:
+                file_stat = stat(file_path)
+            except OSError:
+                if state:
+                    state.files.pop(name, None)
+                self._forget_file(file_path, delta)
+                continue
+            was_candidate = self.verdicts.get(file_path)
+            if state:
+                state.files[name] = (file_stat.st_size, file_stat.st_mtime_ns)
+            verdict = self.verdicts[file_path] = self.decide(file_path)
+            if verdict and was_candidate is None:
+                delta.new.append(file_path)
+            elif verdict:
+                delta.changed.append(file_path)
+            elif was_candidate:
+                delta.removed.append(file_path)
+        return delta
+
+    def invalidate(self, file_path):
+        '''Forces the verdict for a file to be recomputed on the next scan'''
+        self.verdicts.pop(file_path, None)
+        state = self._dirs.get(dirname(file_path))
+        if state:
+            state.mtime_ns = None
+
+    def candidates(self):
+        '''Returns the list of files that should currently be converted'''
+        return [path for path, verdict in self.verdicts.items() if verdict]
+
+    def summary(self):
+        '''Returns a (done, left) tuple counting files that are converted (or
+           don't need to be) and files that are left to convert'''
+        left = sum(1 for verdict in self.verdicts.values() if verdict)
+        return len(self.verdicts) - left, left
@@ -0,0 +1,312 @@
+'''Resumable segmented encoding: the source is split on keyframes into
+   chunks which are encoded separately and then concatenated losslessly'''
+import json
+from csv import reader
+from os import rename, remove, stat, makedirs
+from os.path import join, isfile, splitext, basename, getsize
+from shutil import rmtree
+from subprocess import Popen, DEVNULL
+from threading import Thread, Event, Lock
+from time import sleep
+
+from arrow import utcnow as now
+from config import DEFAULT_PROFILE
+from converter import Conversion, ConversionStatus, rendition_path
+from mediainfo import MediaInfoError
+from progress import FFmpegProgress
+
+MANIFEST = 'manifest.json'
+# how much of the end of the log a failed split or concat is reported with
+LOG_TAIL = 4096
+
+class SegmentError(Exception):
+    '''Exception that indicates a failure to split, encode or join segments,
+       along with the end of ffmpeg's output if it was ffmpeg that failed'''
+    def __init__(self, message, stderr=None):
+        Exception.__init__(self, message)
+        self.stderr = stderr
+
+def log_tail(log_file_path, size=LOG_TAIL):
+    '''Returns the last size bytes of a log as a string'''
+    try:
+        with open(log_file_path, 'rb') as log_file:
+            log_file.seek(max(0, getsize(log_file_path) - size))
+            return log_file.read().decode('UTF-8', 'replace')
+    except OSError:
+        return None
+
+def segment_directory(src_file_path):
+    '''Returns the working directory used for the segments of a source'''
+    return splitext(src_file_path)[0] + '.segments'
+
+class ChunkConversion(Conversion):
+    '''The Conversion of one chunk of a SegmentedConversion. The chunk isn't
+       probed: it gets the plan, output size and audio bitrate decided for
+       the whole source, so that every chunk is encoded alike and they can
+       be joined without re-encoding.'''
+    def __init__(self, parent, src_file_path, dst_file_path, log_file_path, duration):
+        self.parent = parent
+        self.chunk_duration = duration
+        Conversion.__init__(self, src_file_path, dst_file_path, log_file_path, parent.threads,
+                            parent.profile, parent.renditions)
+
+    def _probe(self):
+        parent = self.parent
+        self.info = parent.info
+        self.audio_bitrate = parent.audio_bitrate
+        self.height = parent.height
+        self.width = parent.width
+        self.ladder = [(rendition_path(self.dst, rendition),) + rung[1:]
+                       for rendition, rung in zip(self.renditions, parent.ladder)]
+        self.duration = self.chunk_duration
+        self.plan = parent.plan
+
+class SegmentedConversion(Conversion):
+    '''A Conversion that encodes the source in chunks of segment_duration
+       seconds, up to parallel chunks at a time. Finished chunks are recorded
+       in a manifest so that a restarted conversion picks up at the first
+       incomplete chunk instead of starting over.'''
+    # the progress of finished chunks only records their duration and size
+    counts_frames = False
+    def __init__(self, src_file_path, dst_file_path, log_file_path, threads=None,
+                 profile=DEFAULT_PROFILE, renditions=(), segment_duration=300, parallel=1):
+        Conversion.__init__(self, src_file_path, dst_file_path, log_file_path, threads, profile,
+                            renditions)
+        self.segment_duration = segment_duration
+        self.parallel = parallel
+        self.workdir = segment_directory(src_file_path)
+        self.manifest = None
+        self.resumed_time = 0.0
+        self.active = []
+        self._process = None
+        self._driver = None
+        self._error = None
+        self._killed = False
+        self._lock = Lock()
+        self._unpaused = Event()
+        self._unpaused.set()
+
+    def start(self):
+        '''Starts splitting and encoding the source in a background thread'''
+        self.start_time = now()
+        print("Converting {} in {}s segments to: {}x{} Bit-Rate: {}"\
+              .format(self.src, self.segment_duration, self.width, self.height,
+                      self.audio_bitrate))
+        self.status = ConversionStatus.RUNNING
+        self._driver = Thread(target=self._run, daemon=True)
+        self._driver.start()
+
+    def running(self):
+        '''Returns True while the conversion has not finished'''
+        return self._driver.is_alive()
+
+    def kill(self):
+        '''Stops the conversion, finished chunks are kept for the next attempt'''
+        self._killed = True
+        self._unpaused.set()
+        with self._lock:
+            for conversion in self.active:
+                conversion.kill()
+            # the split or a concat, which can take a while on a long source
+            if self._process is not None and self._process.poll() is None:
+                self._process.terminate()
+
+    def pause(self):
+        '''Pauses the chunks being encoded and holds off on starting new ones'''
+        if self.status == ConversionStatus.RUNNING:
+            self._unpaused.clear()
+            with self._lock:
+                for conversion in self.active:
+                    conversion.pause()
+            self.paused_at = now()
+            self.status = ConversionStatus.PAUSED
+
+    def resume(self):
+        '''Resumes the chunks being encoded'''
+        if self.status == ConversionStatus.PAUSED:
+            with self._lock:
+                for conversion in self.active:
+                    conversion.resume()
+            self._unpaused.set()
+            self.paused_total += now() - self.paused_at
+            self.paused_at = None
+            self.status = ConversionStatus.RUNNING
+
+    def stats(self):
+        '''Returns an FFmpegProgress covering all chunks, finished or active'''
+        stats = FFmpegProgress()
+        if not self.manifest:
+            return stats
+        for chunk in self.manifest['chunks']:
+            if chunk['done']:
+                stats.out_time += chunk['duration']
+                stats.total_size += chunk['size']
+        with self._lock:
+            for conversion in self.active:
+                active = conversion.stats()
+                stats.out_time += active.out_time
+                stats.total_size += active.total_size
+                stats.frame += active.frame
+        return stats
+
+    def eta(self):
+        '''Outputs a timedelta indicating the estimated time to completion,
+           based only on the chunks encoded since this conversion started'''
+        out_time = self.stats().out_time
+        elapsed = self.elapsed()
+        encoded = out_time - self.resumed_time
+        if not self.duration or encoded <= 0 or elapsed.total_seconds() <= 0:
+            return float('inf')
+        return elapsed * (max(0, self.duration - out_time) / encoded)
+
+    def result(self):
+        '''Waits for the conversion and returns a dict with an error and the
+           output that explains it if it failed, ffmpeg's or that of the
+           OSError raised when a file couldn't be written'''
+        self._driver.join()
+        if self._error:
+            self.status = ConversionStatus.ERROR
+            return {'error': self._error,
+                    'stderr': getattr(self._error, 'stderr', None) or str(self._error)}
+        self.status = ConversionStatus.DONE
+        return {'returncode': 0}
+
+    def _run(self):
+        try:
+            self.manifest = self._load_manifest() or self._split()
+            self.resumed_time = sum(chunk['duration'] for chunk in self.manifest['chunks']
+                                    if chunk['done'])
+            self._encode()
+            self._concat()
+            rmtree(self.workdir, ignore_errors=True)
+        except (SegmentError, MediaInfoError, OSError, ValueError) as error:
+            self._error = error
+        finally:
+            with self._lock:
+                for conversion in self.active:
+                    conversion.kill()
+
+    def _check_call(self, cmd):
+        with open(self.log, 'a+') as log_file:
+            with self._lock:
+                if self._killed:
+                    raise SegmentError('Conversion of {} was stopped'.format(self.src))
+                process = Popen(self.resources.wrap(cmd) if self.resources else cmd,
+                                stdin=DEVNULL, stdout=log_file, stderr=log_file)
+                self._process = process
+            if self.resources:
+                self.resources.attach(process.pid)
+            if process.wait():
+                log_file.flush()
+                raise SegmentError('{} exited with {}'.format(cmd[0], process.returncode),
+                                   log_tail(self.log))
+
+    def _signature(self):
+        src_stat = stat(self.src)
+        return [src_stat.st_size, src_stat.st_mtime_ns, self.segment_duration]
+
+    def _load_manifest(self):
+        '''Returns the manifest left by a previous attempt, if it matches the source'''
+        manifest_path = join(self.workdir, MANIFEST)
+        if not isfile(manifest_path):
+            return None
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get('signature') != self._signature():
+            rmtree(self.workdir, ignore_errors=True)
+            return None
+        done = sum(1 for chunk in manifest['chunks'] if chunk['done'])
+        print("Resuming {} at segment {} of {}".format(self.src, done + 1,
+                                                       len(manifest['chunks'])))
+        return manifest
+
+    def _save_manifest(self):
+        '''Atomically writes the manifest to the working directory'''
+        manifest_path = join(self.workdir, MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+        rename(manifest_path + '.tmp', manifest_path)
+
+    def _split(self):
+        '''Splits the source on keyframes into chunks without re-encoding it'''
+        makedirs(self.workdir, exist_ok=True)
+        segment_list = join(self.workdir, 'segments.csv')
+        self._check_call(['ffmpeg', '-nostats', '-y', '-i', self.src,
+                          '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy',
+                          '-f', 'segment', '-segment_time', str(self.segment_duration),
+                          '-reset_timestamps', '1',
+                          '-segment_list', segment_list, '-segment_list_type', 'csv',
+                          join(self.workdir, 'chunk%05d.mkv')])
+        with open(segment_list) as segment_file:
+            chunks = [{'name': row[0], 'duration': float(row[2]) - float(row[1]),
+                       'done': False, 'size': 0}
+                      for row in reader(segment_file) if row]
+        if not chunks:
+            raise SegmentError('No segments were produced for {}'.format(self.src))
+        self.manifest = {'signature': self._signature(), 'chunks': chunks}
+        self._save_manifest()
+        return self.manifest
+
+    def _encoded_path(self, chunk):
+        return join(self.workdir, 'encoded-' + splitext(chunk['name'])[0] + '.mp4')
+
+    def _encode(self):
+        '''Encodes every unfinished chunk, up to parallel of them at a time'''
+        pending = [chunk for chunk in self.manifest['chunks'] if not chunk['done']]
+        running = []
+        while pending or running:
+            self._unpaused.wait()
+            if self._killed:
+                raise SegmentError('Conversion of {} was stopped'.format(self.src))
+            while pending and len(running) < self.parallel and self._unpaused.is_set():
+                chunk = pending.pop(0)
+                chunk_path = join(self.workdir, chunk['name'])
+                encoding_path = splitext(self._encoded_path(chunk))[0] + '.converting.mp4'
+                conversion = ChunkConversion(self, chunk_path, encoding_path,
+                                             join(self.workdir, chunk['name'] + '.log'),
+                                             chunk['duration'])
+                # every chunk runs under the limits of the whole conversion
+                conversion.resources = self.resources
+                conversion.start()
+                running.append((chunk, conversion))
+                with self._lock:
+                    self.active.append(conversion)
+            sleep(0.5)
+            for chunk, conversion in [job for job in running if not job[1].running()]:
+                running.remove((chunk, conversion))
+                result = conversion.result()
+                with self._lock:
+                    self.active.remove(conversion)
+                if 'error' in result:
+                    for _, other in running:
+                        other.kill()
+                    raise SegmentError('Segment {} failed: {}'.format(chunk['name'],
+                                                                      result.get('stderr')),
+                                       result.get('stderr'))
+                rename(conversion.dst, self._encoded_path(chunk))
+                for rendition in self.renditions:
+                    rename(rendition_path(conversion.dst, rendition),
+                           rendition_path(self._encoded_path(chunk), rendition))
+                chunk['size'] = getsize(self._encoded_path(chunk))
+                chunk['done'] = True
+                self._save_manifest()
+                remove(join(self.workdir, chunk['name']))
+
+    def _concat(self):
+        '''Joins the encoded chunks into the destination, and those of each
+           rendition into the rendition's output, without re-encoding'''
+        self._concat_chunks(self._encoded_path, self.dst, 'concat.txt')
+        for rendition in self.renditions:
+            self._concat_chunks(lambda chunk, rendition=rendition:
+                                rendition_path(self._encoded_path(chunk), rendition),
+                                rendition_path(self.dst, rendition),
+                                'concat.{}.txt'.format(rendition.name))
+
+    def _concat_chunks(self, chunk_path, dst_file_path, list_name):
+        concat_list = join(self.workdir, list_name)
+        with open(concat_list, 'w') as concat_file:
+            for chunk in self.manifest['chunks']:
+                name = basename(chunk_path(chunk)).replace("'", "'\\''")
+                concat_file.write("file '{}'\n".format(name))
+        self._check_call(['ffmpeg', '-nostats', '-y', '-f', 'concat', '-safe', '0',
+                          '-i', concat_list, '-c', 'copy', dst_file_path])
@@ -0,0 +1,163 @@
+'''Stages sources on a local scratch directory so that ffmpeg reads and
+   writes local files instead of going over the network'''
+from hashlib import sha1
+from os import stat, remove, makedirs, posix_fadvise, POSIX_FADV_SEQUENTIAL
+from os.path import join, splitext, basename
+from shutil import copyfileobj, copystat, rmtree
+from threading import Thread, Lock, Event
+from time import monotonic
+
+from constants import STAGE_CHUNK_SIZE
+
+def scratch_name(file_path):
+    '''Returns a short name that is unique to a path, for files in the scratch directory'''
+    return sha1(file_path.encode('UTF-8', 'surrogateescape')).hexdigest()[:16]
+
+def copy_sequential(src_file_path, dst_file_path, chunk_size=STAGE_CHUNK_SIZE):
+    '''Copies a file with large sequential reads, hinting the kernel to read
+       ahead. The modification time is copied along so that the copy looks
+       like the same file to anything that compares it.'''
+    with open(src_file_path, 'rb') as src_file, open(dst_file_path, 'wb') as dst_file:
+        try:
+            posix_fadvise(src_file.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+        copyfileobj(src_file, dst_file, chunk_size)
+    copystat(src_file_path, dst_file_path)
+
+class _StagedFile(object):
+    '''A source that is being, or has been, copied to the scratch directory'''
+    __slots__ = ('local_path', 'size', 'mtime_ns', 'ready', 'failed', 'users', 'used')
+    def __init__(self, local_path, size, mtime_ns):
+        self.local_path = local_path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ready = Event()
+        self.failed = False
+        self.users = 0
+        self.used = monotonic()
+
+class ScratchStage(object):
+    '''Copies sources into scratch_dir ahead of time while other jobs encode,
+       keeping at most budget bytes of staged sources. Staged sources that
+       aren't in use are evicted least recently used first to make room,
+       and a source that doesn't fit is simply read from where it is.
+       Outputs are written to scratch_dir too, so it needs some headroom
+       beyond the budget.'''
+    def __init__(self, scratch_dir, budget):
+        self.scratch_dir = scratch_dir
+        self.budget = budget
+        self.used = 0
+        self._staged = {}
+        self._lock = Lock()
+        makedirs(join(scratch_dir, 'sources'), exist_ok=True)
+
+    def _local_path(self, file_path):
+        return join(self.scratch_dir, 'sources', scratch_name(file_path) + splitext(file_path)[1])
+
+    def _reserve(self, file_path):
+        '''Makes room for a source and registers it, returning its entry or
+           None if it can't be staged. Must be called with the lock held.'''
+        try:
+            file_stat = stat(file_path)
+        except OSError:
+            return None
+        size = file_stat.st_size
+        if size > self.budget:
+            return None
+        idle = sorted((entry.used, path) for path, entry in self._staged.items()
+                      if not entry.users and entry.ready.is_set())
+        while self.used + size > self.budget and idle:
+            self._evict(idle.pop(0)[1])
+        if self.used + size > self.budget:
+            return None
+        entry = self._staged[file_path] = _StagedFile(self._local_path(file_path), size,
+                                                      file_stat.st_mtime_ns)
+        self.used += size
+        return entry
+
+    def _evict(self, file_path):
+        '''Drops a staged source. Must be called with the lock held.'''
+        entry = self._staged.pop(file_path)
+        self.used -= entry.size
+        try:
+            remove(entry.local_path)
+        except OSError:
+            pass
+
+    def _copy(self, file_path, entry):
+        try:
+            copy_sequential(file_path, entry.local_path)
+        except OSError as error:
+            print("Unable to stage {}: {}".format(file_path, error))
+            entry.failed = True
+        entry.ready.set()
+
+    def prefetch(self, file_paths):
+        '''Starts copying any of the given sources that aren't staged yet in
+           the background, in order, for as long as they fit in the budget'''
+        started = []
+        with self._lock:
+            for file_path in file_paths:
+                if file_path in self._staged:
+                    continue
+                entry = self._reserve(file_path)
+                if entry is None:
+                    break
+                started.append((file_path, entry))
+        for file_path, entry in started:
+            Thread(target=self._copy, args=(file_path, entry), daemon=True,
+                   name='stage-{}'.format(basename(file_path))).start()
+
+    def acquire(self, file_path):
+        '''Returns the local copy of a source, waiting for its prefetch to
+           finish or copying it now if it wasn't prefetched. Returns the
+           source itself if it can't be staged.'''
+        copy_now = False
+        with self._lock:
+            entry = self._staged.get(file_path)
+            if entry is not None and not entry.users and entry.ready.is_set() and \
+               not self._current(file_path, entry):
+                self._evict(file_path)
+                entry = None
+            if entry is None:
+                entry = self._reserve(file_path)
+                if entry is None:
+                    return file_path
+                copy_now = True
+            entry.users += 1
+        if copy_now:
+            self._copy(file_path, entry)
+        entry.ready.wait()
+        if entry.failed:
+            self.release(file_path)
+            return file_path
+        return entry.local_path
+
+    @staticmethod
+    def _current(file_path, entry):
+        '''Returns True if a source hasn't changed since it was staged'''
+        try:
+            file_stat = stat(file_path)
+        except OSError:
+            return False
+        return (file_stat.st_size, file_stat.st_mtime_ns) == (entry.size, entry.mtime_ns)
+
+    def release(self, file_path, discard=True):
+        '''Stops using the local copy of a source, deleting it when discard
+           is set and no one else uses it'''
+        with self._lock:
+            entry = self._staged.get(file_path)
+            if entry is None:
+                return
+            entry.users = max(0, entry.users - 1)
+            entry.used = monotonic()
+            if (discard or entry.failed) and not entry.users:
+                self._evict(file_path)
+
+    def work_directory(self, file_path):
+        '''Returns a fresh local directory to write the outputs of a source to'''
+        work_dir = join(self.scratch_dir, 'work', scratch_name(file_path))
+        rmtree(work_dir, ignore_errors=True)
+        makedirs(work_dir)
+        return work_dir
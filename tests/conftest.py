@@ -0,0 +1,5 @@
+'''Makes the modules at the root of the repository importable from the tests'''
+import sys
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
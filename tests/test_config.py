@@ -0,0 +1,33 @@
+'''Tests for reading libraries from a config file'''
+import unittest
+from os.path import dirname, join
+from tempfile import TemporaryDirectory
+
+from config import load_config, ConfigError
+
+EXAMPLE = join(dirname(dirname(__file__)), 'examples', 'config.ini')
+
+class RenditionsTest(unittest.TestCase):
+    def _load(self, options):
+        with TemporaryDirectory() as tmp:
+            config_path = join(tmp, 'config.ini')
+            with open(config_path, 'w') as config_file:
+                config_file.write('[Movies]\ninput_directory = {}\n{}\n'.format(tmp, options))
+            return load_config(config_path)
+
+    def test_example_loads(self):
+        movies = load_config(EXAMPLE)[0]
+        for rendition in movies.renditions:
+            self.assertLessEqual(rendition.profile.max_width, movies.profile.max_width)
+            self.assertLessEqual(rendition.profile.max_height, movies.profile.max_height)
+
+    def test_smaller_rendition(self):
+        library = self._load('max_width = 720\nmax_height = 480\nrenditions = 360p:640x360:96')[0]
+        self.assertEqual([rendition.name for rendition in library.renditions], ['360p'])
+
+    def test_larger_rendition(self):
+        with self.assertRaises(ConfigError):
+            self._load('max_width = 720\nmax_height = 480\nrenditions = 480p:854x480:128')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+'''Tests for the helpers of the converter module and cancelling encodes'''
+import io
+import unittest
+from threading import Event
+from unittest import mock
+
+from converter import Conversion, Converter, ConversionCancelled, is_out_of_space, scale_filter
+from config import EncodingProfile, Rendition
+from decisions import ConversionPlan
+from progress import LogTail
+from trials import TrialCancelled, TrialSearch
+
+def ffmpeg_tail(output):
+    '''Runs ffmpeg's stderr through a LogTail and returns its tail'''
+    log_tail = LogTail(io.BytesIO(output), io.StringIO())
+    log_tail.run()
+    return log_tail.tail()
+
+class IsOutOfSpaceTest(unittest.TestCase):
+    def test_full_disk(self):
+        tail = ffmpeg_tail(b'frame=  100 fps=25\n'
+                           b'[mp4 @ 0x55d5] Error writing trailer: No space left on device\n'
+                           b'Conversion failed!\n')
+        self.assertTrue(is_out_of_space(tail))
+
+    def test_other_failure(self):
+        tail = ffmpeg_tail(b'movie.mkv: Invalid data found when processing input\n')
+        self.assertFalse(is_out_of_space(tail))
+
+    def test_no_output(self):
+        self.assertFalse(is_out_of_space(None))
+        self.assertFalse(is_out_of_space(''))
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = Converter(verbose=False, search=mock.Mock(), make_conversion=mock.Mock())
+        # the dead conversion of the previous job
+        self.converter.conversion = mock.Mock()
+        self.previous = self.converter.conversion
+
+    def test_during_trials(self):
+        def choose(*args):
+            self.converter.cancel()
+            self.assertIsNone(self.converter.conversion)
+            raise TrialCancelled('Trials of movie.mkv cancelled')
+        self.converter.search.choose.side_effect = choose
+        with self.assertRaises(ConversionCancelled):
+            self.converter.start_conversion('movie.mkv')
+        self.previous.kill.assert_not_called()
+        self.converter.make_conversion.assert_not_called()
+
+    def test_before_trials(self):
+        self.converter.cancel()
+        with self.assertRaises(ConversionCancelled):
+            self.converter.start_conversion('movie.mkv')
+        self.converter.search.choose.assert_not_called()
+
+    def test_search_stops_between_samples(self):
+        search = TrialSearch(cache=None)
+        info = mock.Mock(file_path='movie.mkv')
+        info.duration.return_value = 3600.0
+        cancelled = Event()
+        cancelled.set()
+        with mock.patch.object(search, '_sample') as sample:
+            with self.assertRaises(TrialCancelled):
+                search._search(info, mock.Mock(), 'trials', cancelled)
+        sample.assert_not_called()
+
+def fake_probe(conversion):
+    '''Stands in for probing a source that doesn't exist'''
+    conversion.plan, conversion.width, conversion.height = ConversionPlan.FULL, 640, 360
+    conversion.audio_bitrate, conversion.duration, conversion.ladder = '128k', 60.0, []
+
+class CommandTest(unittest.TestCase):
+    def _cmd(self, conversion_plan):
+        with mock.patch.object(Conversion, '_probe', fake_probe):
+            conversion = Conversion('movie.mkv', 'movie.converting.mp4', 'movie.log')
+        conversion.plan = conversion_plan
+        return conversion._cmd(3)
+
+    def test_keeps_the_planned_streams(self):
+        for conversion_plan in (ConversionPlan.REMUX, ConversionPlan.AUDIO, ConversionPlan.FULL):
+            cmd = self._cmd(conversion_plan)
+            maps = [cmd[index + 1] for index, arg in enumerate(cmd) if arg == '-map']
+            self.assertEqual(maps, ['0:v:0', '0:a:0?'], conversion_plan)
+
+class LadderTest(unittest.TestCase):
+    def test_scope_source_keeps_its_aspect_ratio(self):
+        # a 2.39:1 film, whose renditions would be squeezed into 16:9 boxes
+        info = mock.Mock()
+        info.video_width.side_effect = lambda max_width: min(1920, max_width)
+        info.video_height.side_effect = lambda max_height: min(804, max_height)
+        info.abr.return_value = '128k'
+        renditions = [Rendition('480p', EncodingProfile(854, 480, 128)),
+                      Rendition('360p', EncodingProfile(640, 360, 96))]
+        with mock.patch('converter.MediaInfo', return_value=info), \
+             mock.patch('converter.plan', return_value=ConversionPlan.FULL):
+            conversion = Conversion('film.mkv', 'film.converting.mp4', 'film.log',
+                                    renditions=renditions)
+        cmd = conversion._cmd(3)
+        graph = cmd[cmd.index('-filter_complex') + 1].split(';')
+        self.assertEqual(len(graph), 4)
+        for scale, box in zip(graph[1:], ('1136:640', '854:480', '640:360')):
+            self.assertIn('scale={}:force_original_aspect_ratio=decrease:'
+                          'force_divisible_by=2'.format(box), scale)
+
+    def test_single_output_keeps_its_aspect_ratio(self):
+        with mock.patch.object(Conversion, '_probe', fake_probe):
+            conversion = Conversion('film.mkv', 'film.converting.mp4', 'film.log')
+        cmd = conversion._cmd(3)
+        self.assertNotIn('-s:v', cmd)
+        self.assertEqual(cmd[cmd.index('-vf') + 1], scale_filter(640, 360))
+
+class StartFailureTest(unittest.TestCase):
+    def test_never_started(self):
+        with mock.patch.object(Conversion, '_probe'):
+            conversion = Conversion('movie.mkv', 'movie.converting.mp4', 'movie.log')
+        self.assertFalse(conversion.running())
+        self.assertIn('error', conversion.result())
+
+    def test_releases_the_group(self):
+        with mock.patch.object(Conversion, '_probe', fake_probe), \
+             mock.patch('converter.Popen', side_effect=OSError(24, 'Too many open files')):
+            resources = mock.Mock()
+            converter = Converter(verbose=False, make_conversion=Conversion,
+                                  resources=resources)
+            converter.conversion = None
+            with mock.patch.object(Conversion, '_cmd', return_value=['ffmpeg']):
+                finish = converter.start_conversion('movie.mkv')
+        resources.release.assert_called_once_with(resources.group.return_value)
+        with mock.patch.object(converter.verifier, 'check'), \
+             mock.patch('converter.log_failed_conversion'):
+            self.assertFalse(finish())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+'''Tests for predicting how long conversions take'''
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from constants import HEIGHT, WIDTH
+from costmodel import CostModel, Features, DEFAULT_SPEEDS, work
+from decisions import ConversionPlan
+
+SD = WIDTH * HEIGHT
+
+def full(duration=600.0, codec='hevc', pixels=SD):
+    return Features(ConversionPlan.FULL.name, codec, duration, pixels, 0)
+
+class WorkTest(unittest.TestCase):
+    def test_full_encodes_scale_with_pixels(self):
+        self.assertEqual(work(full(pixels=4 * SD)), 2400.0)
+
+    def test_copies_go_by_duration(self):
+        self.assertEqual(work(Features(ConversionPlan.REMUX.name, 'h264', 600.0, 4 * SD, 0)),
+                         600.0)
+
+class CostModelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.db_path = join(self.tmp.name, 'costs.db')
+        self.model = CostModel(self.db_path, smoothing=0.5)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_default_speeds(self):
+        self.assertEqual(self.model.predict(full()), 600.0 / DEFAULT_SPEEDS[ConversionPlan.FULL])
+
+    def test_learns_and_falls_back(self):
+        self.model.record('a.mkv', 'Movies', full(), 300.0)
+        self.assertAlmostEqual(self.model.predict(full(1200.0), 'Movies'), 600.0)
+        # other libraries go by the plan and codec across libraries
+        self.assertAlmostEqual(self.model.predict(full(1200.0), 'TV'), 600.0)
+        # and other codecs by the plan alone
+        self.assertAlmostEqual(self.model.predict(full(1200.0, 'mpeg2'), 'TV'), 600.0)
+        self.model.record('b.mkv', 'Movies', full(), 150.0)
+        self.assertAlmostEqual(self.model.predict(full(), 'Movies'), 600.0 / 3.0)
+
+    def test_prediction_error(self):
+        self.model.record('a.mkv', 'Movies', full(), 300.0, predicted=150.0)
+        self.assertAlmostEqual(self.model.error, 0.5)
+
+    def test_survives_restarts(self):
+        self.model.record('a.mkv', 'Movies', full(), 300.0)
+        self.assertAlmostEqual(CostModel(self.db_path).predict(full(), 'Movies'), 300.0)
+
+    def test_ignores_empty_observations(self):
+        self.model.record('a.mkv', 'Movies', full(duration=0.0), 300.0)
+        self.model.record('b.mkv', 'Movies', full(), 0.0)
+        self.assertEqual(self.model.speeds, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+'''Tests for deciding how much work a source needs'''
+import unittest
+from types import SimpleNamespace
+
+from config import EncodingProfile
+from decisions import plan, ConversionPlan
+from probe import ProbeResult, StreamInfo
+
+PROFILE = EncodingProfile(1136, 640, 192)
+
+def info(video=None, audio=None):
+    '''Returns a stand-in for a MediaInfo with the given streams'''
+    result = ProbeResult('movie')
+    for stream in (video, audio):
+        if stream is not None:
+            result.add(stream)
+    return SimpleNamespace(result=result, file_path='movie')
+
+def h264(width=1136, height=640, codec='AVC'):
+    return StreamInfo('video', codec, width, height)
+
+def aac(bitrate=128000, codec='AAC', max_bitrate=None):
+    return StreamInfo('audio', codec, bitrate=bitrate, max_bitrate=max_bitrate)
+
+class PlanTest(unittest.TestCase):
+    def test_compliant_mp4_is_skipped(self):
+        self.assertEqual(plan(info(h264(), aac()), '.mp4', PROFILE), ConversionPlan.SKIP)
+
+    def test_mp4_without_video_is_skipped(self):
+        self.assertEqual(plan(info(audio=aac()), '.mp4', PROFILE), ConversionPlan.SKIP)
+
+    def test_compliant_mkv_is_remuxed(self):
+        self.assertEqual(plan(info(h264(codec='h264'), aac(codec='aac')), '.mkv', PROFILE),
+                         ConversionPlan.REMUX)
+
+    def test_no_audio_is_compliant(self):
+        self.assertEqual(plan(info(h264()), '.mkv', PROFILE), ConversionPlan.REMUX)
+
+    def test_audio_codec(self):
+        self.assertEqual(plan(info(h264(), aac(codec='DTS')), '.mkv', PROFILE),
+                         ConversionPlan.AUDIO)
+
+    def test_audio_bitrate(self):
+        self.assertEqual(plan(info(h264(), aac(bitrate=192000)), '.mkv', PROFILE),
+                         ConversionPlan.REMUX)
+        self.assertEqual(plan(info(h264(), aac(bitrate=256000)), '.mkv', PROFILE),
+                         ConversionPlan.AUDIO)
+
+    def test_max_bitrate_stands_in_for_a_missing_bitrate(self):
+        self.assertEqual(plan(info(h264(), aac(bitrate=None, max_bitrate=320000)), '.mkv',
+                              PROFILE), ConversionPlan.AUDIO)
+        self.assertEqual(plan(info(h264(), aac(bitrate=None)), '.mkv', PROFILE),
+                         ConversionPlan.REMUX)
+
+    def test_video_larger_than_the_profile(self):
+        self.assertEqual(plan(info(h264(width=1137), aac()), '.mkv', PROFILE),
+                         ConversionPlan.FULL)
+        self.assertEqual(plan(info(h264(height=641), aac()), '.mp4', PROFILE),
+                         ConversionPlan.FULL)
+
+    def test_unknown_size(self):
+        self.assertEqual(plan(info(h264(width=None), aac()), '.mkv', PROFILE),
+                         ConversionPlan.FULL)
+
+    def test_video_codec(self):
+        self.assertEqual(plan(info(h264(codec='HEVC'), aac()), '.mkv', PROFILE),
+                         ConversionPlan.FULL)
+        # the codec of files that are already mp4 is trusted
+        self.assertEqual(plan(info(h264(codec='HEVC'), aac()), '.mp4', PROFILE),
+                         ConversionPlan.SKIP)
+
+    def test_no_video_in_another_container(self):
+        self.assertEqual(plan(info(audio=aac()), '.mkv', PROFILE), ConversionPlan.FULL)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+'''Tests for recognizing copies of sources'''
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from config import EncodingProfile, Library
+from dedup import Deduplicator, fingerprint, output_key
+from jobqueue import Job
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _file(self, name, data):
+        file_path = join(self.tmp.name, name)
+        with open(file_path, 'wb') as media_file:
+            media_file.write(data)
+        return file_path
+
+    def test_copies_match_whatever_their_name(self):
+        data = bytes(range(256)) * 1024
+        self.assertEqual(fingerprint(self._file('a.mkv', data), block_size=64),
+                         fingerprint(self._file('b.mkv', data), block_size=64))
+
+    def test_sampled_blocks(self):
+        data = bytearray(256 * 1024)
+        original = self._file('a.mkv', bytes(data))
+        data[-1] = 1
+        changed_at_the_end = self._file('b.mkv', bytes(data))
+        data[-1], data[100000] = 0, 1
+        changed_between_samples = self._file('c.mkv', bytes(data))
+        self.assertNotEqual(fingerprint(original, block_size=64),
+                            fingerprint(changed_at_the_end, block_size=64))
+        # only a full hash sees changes between the sampled blocks
+        self.assertEqual(fingerprint(original, block_size=64),
+                         fingerprint(changed_between_samples, block_size=64))
+        self.assertNotEqual(fingerprint(original, full=True),
+                            fingerprint(changed_between_samples, full=True))
+
+    def test_size_is_part_of_it(self):
+        self.assertNotEqual(fingerprint(self._file('a.mkv', b'x' * 10)),
+                            fingerprint(self._file('b.mkv', b'x' * 11)))
+
+    def test_output_key_follows_the_profile(self):
+        library = Library('Movies', self.tmp.name)
+        self.assertEqual(output_key(library), output_key(None))
+        smaller = Library('Small', self.tmp.name, profile=EncodingProfile(640, 360, 96))
+        self.assertNotEqual(output_key(smaller), output_key(library))
+
+class ClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.dedup = Deduplicator(join(self.tmp.name, 'fingerprints.db'))
+        self.jobs = []
+        for index, name in enumerate(('a.mkv', 'b.mkv', 'c.mkv')):
+            file_path = join(self.tmp.name, name)
+            with open(file_path, 'wb') as media_file:
+                media_file.write(b'same content')
+            self.jobs.append(Job(index, file_path, 0, 0.0, '', 0.0))
+        self.output = join(self.tmp.name, 'a.mp4')
+        with open(self.output, 'wb') as output_file:
+            output_file.write(b'converted')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_twins_wait_then_reuse(self):
+        first, second, third = self.jobs
+        self.assertEqual(self.dedup.claim(first), (Deduplicator.CONVERT, None))
+        self.assertEqual(self.dedup.claim(second), (Deduplicator.WAIT, None))
+        self.assertEqual(self.dedup.settle(first, self.output), [(second, None)])
+        self.assertEqual(self.dedup.claim(third), (Deduplicator.REUSE, self.output))
+
+    def test_failed_conversion_records_nothing(self):
+        first, second, _ = self.jobs
+        self.dedup.claim(first)
+        self.dedup.claim(second)
+        self.assertEqual(self.dedup.settle(first), [(second, None)])
+        self.assertEqual(self.dedup.claim(second), (Deduplicator.CONVERT, None))
+
+    def test_changed_output_is_forgotten(self):
+        first, second, _ = self.jobs
+        self.dedup.claim(first)
+        self.dedup.settle(first, self.output)
+        with open(self.output, 'ab') as output_file:
+            output_file.write(b' and then some')
+        self.assertEqual(self.dedup.claim(second), (Deduplicator.CONVERT, None))
+
+if __name__ == '__main__':
+    unittest.main()
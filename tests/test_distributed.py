@@ -0,0 +1,71 @@
+'''Tests for the coordinator's worker protocol'''
+import json
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+from urllib.error import HTTPError
+from unittest import mock
+from urllib.request import Request, urlopen
+
+from converter import ConversionStatus
+from distributed import Coordinator, RemoteWorker, TOKEN_HEADER
+from jobqueue import Job, JobQueue
+
+class TokenTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.coordinator = Coordinator(JobQueue(join(self.tmp.name, 'jobs.db')), 0, 'secret')
+        self.url = 'http://127.0.0.1:{}/heartbeat'.format(self.coordinator.server.server_port)
+
+    def tearDown(self):
+        self.coordinator.stop()
+        self.tmp.cleanup()
+
+    def _post(self, headers):
+        headers['Content-Type'] = 'application/json'
+        request = Request(self.url, json.dumps({'lease': 'unknown'}).encode('UTF-8'), headers)
+        try:
+            with urlopen(request, timeout=5) as response:
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+    def test_listens_on_loopback(self):
+        self.assertEqual(self.coordinator.server.server_address[0], '127.0.0.1')
+
+    def test_refuses_missing_token(self):
+        self.assertEqual(self._post({}), 403)
+
+    def test_refuses_wrong_token(self):
+        self.assertEqual(self._post({TOKEN_HEADER: 'guess'}), 403)
+
+    def test_accepts_token(self):
+        # an unknown lease, but the request got through to the coordinator
+        self.assertEqual(self._post({TOKEN_HEADER: 'secret'}), 410)
+
+class UnknownLibraryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.source = join(self.tmp.name, 'movie.mkv')
+        with open(self.source, 'wb') as source:
+            source.write(b'x')
+        self.queue = JobQueue(join(self.tmp.name, 'jobs.db'))
+        self.queue.push([self.source], 'Movies')
+        self.coordinator = Coordinator(self.queue, 0, 'secret')
+        self.worker = RemoteWorker('http://127.0.0.1:{}'.format(
+            self.coordinator.server.server_port), mock.Mock, 'secret')
+
+    def tearDown(self):
+        self.coordinator.stop()
+        self.tmp.cleanup()
+
+    def test_refused_and_held(self):
+        status, response = self.worker._post('/claim', {'worker': self.worker.name})
+        self.assertEqual(status, 200)
+        self.worker.run_job(response['lease'], response['duration'], Job(**response['job']))
+        self.worker.converter.run_conversion.assert_not_called()
+        self.assertEqual(self.queue.counts()[ConversionStatus.NONE], 1)
+        self.assertEqual(self.queue.peek(1), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+'''Tests for the load governor'''
+import unittest
+from datetime import datetime, time
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from governor import LoadGovernor, cpu_pressure, in_window, parse_window
+
+class WindowTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_window('01:30 - 06:00'), (time(1, 30), time(6, 0)))
+
+    def test_parse_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_window('1am-6am')
+
+    def test_daytime_window(self):
+        window = parse_window('09:00-17:00')
+        self.assertTrue(in_window(window, datetime(2020, 1, 1, 9, 0)))
+        self.assertTrue(in_window(window, datetime(2020, 1, 1, 16, 59)))
+        self.assertFalse(in_window(window, datetime(2020, 1, 1, 17, 0)))
+        self.assertFalse(in_window(window, datetime(2020, 1, 1, 3, 0)))
+
+    def test_window_wraps_midnight(self):
+        window = parse_window('22:00-06:00')
+        self.assertTrue(in_window(window, datetime(2020, 1, 1, 23, 0)))
+        self.assertTrue(in_window(window, datetime(2020, 1, 1, 0, 0)))
+        self.assertTrue(in_window(window, datetime(2020, 1, 1, 5, 59)))
+        self.assertFalse(in_window(window, datetime(2020, 1, 1, 6, 0)))
+        self.assertFalse(in_window(window, datetime(2020, 1, 1, 12, 0)))
+
+class PressureTest(unittest.TestCase):
+    def test_some_avg10(self):
+        with TemporaryDirectory() as tmp:
+            pressure_file = join(tmp, 'cpu')
+            with open(pressure_file, 'w') as pressure:
+                pressure.write('some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n'
+                               'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+            self.assertEqual(cpu_pressure(pressure_file), 12.5)
+
+    def test_unsupported(self):
+        with TemporaryDirectory() as tmp:
+            self.assertIsNone(cpu_pressure(join(tmp, 'missing')))
+
+class ReasonTest(unittest.TestCase):
+    def test_outside_window(self):
+        governor = LoadGovernor(mock.Mock(), window='22:00-06:00')
+        with mock.patch('governor.datetime') as clock:
+            clock.now.return_value = datetime(2020, 1, 1, 12, 0)
+            self.assertEqual(governor.reason(), 'outside of the conversion window')
+            clock.now.return_value = datetime(2020, 1, 1, 23, 0)
+            self.assertIsNone(governor.reason())
+
+    def test_load_hysteresis(self):
+        governor = LoadGovernor(mock.Mock(), max_load=4.0)
+        with mock.patch('governor.getloadavg', return_value=(3.5, 0, 0)):
+            self.assertIsNone(governor.reason())
+            governor.paused = True
+            self.assertEqual(governor.reason(), 'load average is 3.50')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+'''Tests for the job queue'''
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import time
+
+from jobqueue import JobQueue
+
+class HeldJobTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.sources = []
+        for name, size in (('small.mkv', 1), ('large.mkv', 2)):
+            self.sources.append(join(self.tmp.name, name))
+            with open(self.sources[-1], 'wb') as source:
+                source.write(b'x' * size)
+        self.queue = JobQueue(join(self.tmp.name, 'jobs.db'))
+        self.queue.push(self.sources)
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp.cleanup()
+
+    def test_held_job_is_skipped(self):
+        job = self.queue.get(0)
+        self.queue.release(job, 60)
+        self.assertEqual(self.queue.peek(2), [self.sources[1]])
+        self.assertEqual(self.queue.get(0).path, self.sources[1])
+        self.assertIsNone(self.queue.get(0.1))
+
+    def test_held_job_comes_back(self):
+        job = self.queue.get(0)
+        self.queue.release(job, 0.2)
+        self.queue.get(0)
+        started = time()
+        self.assertEqual(self.queue.get(5).path, self.sources[0])
+        self.assertLess(time() - started, 2)
+
+    def test_release_without_hold(self):
+        job = self.queue.get(0)
+        self.queue.release(job)
+        self.assertEqual(self.queue.get(0).path, self.sources[0])
+
+class FairQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.queue = JobQueue(join(self.tmp.name, 'jobs.db'), weights={'A': 2, 'B': 1})
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp.cleanup()
+
+    def push(self, library, count):
+        sources = []
+        for index in range(count):
+            sources.append(join(self.tmp.name, '{}{}.mkv'.format(library, index)))
+            with open(sources[-1], 'wb') as source:
+                source.write(b'x')
+        self.queue.push(sources, library)
+
+    def handouts(self, count):
+        return ''.join(self.queue.get(0).library for _ in range(count))
+
+    def test_weighted_share(self):
+        self.push('A', 6)
+        self.push('B', 6)
+        self.assertEqual(self.handouts(6), 'ABAABA')
+
+    def test_unweighted_library_gets_a_share(self):
+        self.push('A', 2)
+        self.push('C', 2)
+        self.assertEqual(sorted(self.handouts(3)), ['A', 'A', 'C'])
+
+    def test_idle_library_does_not_burst(self):
+        self.push('A', 6)
+        self.assertEqual(self.handouts(3), 'AAA')
+        self.push('B', 3)
+        self.assertEqual(self.handouts(3), 'ABA')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,18 @@
+'''Tests for the service's metrics'''
+import unittest
+
+from metrics import Metrics
+
+class SavingsTest(unittest.TestCase):
+    def test_counters_only_go_up(self):
+        metrics = Metrics()
+        metrics.record_savings(1000)
+        metrics.record_savings(-300)
+        self.assertEqual(metrics.counters['bytes_saved'], 1000)
+        self.assertEqual(metrics.counters['bytes_grown'], 300)
+        lines = metrics.prometheus().splitlines()
+        self.assertIn('# TYPE auto_converter_bytes_saved_total counter', lines)
+        self.assertIn('auto_converter_bytes_grown_total 300', lines)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+'''Tests for parsing the JSON of the probe backends'''
+import unittest
+from os.path import dirname, join
+from unittest import mock
+
+from probe import MediaInfoBackend, FFProbeBackend
+
+FIXTURES = join(dirname(__file__), 'fixtures')
+
+def fixture(name):
+    with open(join(FIXTURES, name), 'rb') as fixture_file:
+        return fixture_file.read()
+
+class MediaInfoBackendTest(unittest.TestCase):
+    def setUp(self):
+        with mock.patch('probe.check_output', return_value=fixture('mediainfo.json')):
+            self.results = MediaInfoBackend().probe(['/media/movies/film.mkv',
+                                                     '/media/movies/clip.mp4', 'broken.avi'])
+
+    def test_skips_files_without_media(self):
+        self.assertEqual(sorted(self.results), ['/media/movies/clip.mp4',
+                                                '/media/movies/film.mkv'])
+
+    def test_container_and_streams(self):
+        film = self.results['/media/movies/film.mkv']
+        self.assertEqual((film.container, film.duration, film.size, film.bitrate),
+                         ('Matroska', 7322.048, 1468006400, 1603917))
+        self.assertEqual(len(film.video), 1)
+        video = film.video[0]
+        self.assertEqual((video.codec, video.width, video.height, video.bitrate,
+                          video.frame_count), ('AVC', 1920, 804, 1400000, 175553))
+        self.assertEqual([(audio.codec, audio.channels) for audio in film.audio],
+                         [('AAC', 2), ('DTS', 6)])
+
+    def test_missing_fields(self):
+        clip = self.results['/media/movies/clip.mp4']
+        self.assertIsNone(clip.bitrate)
+        self.assertEqual(clip.audio, [])
+        self.assertEqual((clip.video[0].bitrate, clip.video[0].max_bitrate), (None, 2000000))
+
+    def test_single_file_gives_an_object(self):
+        document = b'{"media": {"@ref": "a.mkv", "track": [{"@type": "General"}]}}'
+        with mock.patch('probe.check_output', return_value=document):
+            self.assertEqual(list(MediaInfoBackend().probe(['a.mkv'])), ['a.mkv'])
+
+    def test_invalid_output(self):
+        with mock.patch('probe.check_output', return_value=b'not json'):
+            self.assertEqual(MediaInfoBackend().probe(['a.mkv']), {})
+
+class FFProbeBackendTest(unittest.TestCase):
+    def test_container_and_streams(self):
+        with mock.patch('probe.check_output', return_value=fixture('ffprobe.json')):
+            film = FFProbeBackend().probe(['/media/movies/film.mkv'])['/media/movies/film.mkv']
+        self.assertEqual((film.container, film.duration, film.size, film.bitrate),
+                         ('matroska,webm', 7322.048, 1468006400, 1603917))
+        video = film.video[0]
+        self.assertEqual((video.codec, video.width, video.height, video.frame_count),
+                         ('h264', 1920, 804, 175553))
+        self.assertEqual([(audio.codec, audio.channels, audio.bitrate) for audio in film.audio],
+                         [('aac', 2, 128000), ('dts', 6, None)])
+
+    def test_failed_probe(self):
+        with mock.patch('probe.check_output', side_effect=OSError('no ffprobe')):
+            self.assertEqual(FFProbeBackend().probe(['a.mkv', 'b.mkv']), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+'''Tests for acting on the report of failed files'''
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from types import SimpleNamespace
+
+from config import Library
+from control import ControlServer
+from converter import ConversionStatus
+from jobqueue import JobQueue
+from report import Entry, FAILED, reset_errors
+
+class ResetErrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.source = join(self.tmp.name, 'movie.mkv')
+        with open(self.source, 'wb') as source:
+            source.write(b'x')
+        # the service's queue, and the report's own connection to it
+        self.service_queue = JobQueue(join(self.tmp.name, 'jobs.db'), 'oldest')
+        self.service_queue.push([self.source], 'Movies')
+        job = self.service_queue.get(0)
+        self.service_queue.finish(job, ConversionStatus.ERROR, 'failed')
+        self.queue = JobQueue(join(self.tmp.name, 'jobs.db'))
+        self.entries = [Entry(self.source, 'Movies', FAILED, errors=1)]
+
+    def tearDown(self):
+        self.queue.close()
+        self.service_queue.close()
+        self.tmp.cleanup()
+
+    def test_through_the_service(self):
+        control = ControlServer(join(self.tmp.name, 'control.sock'),
+                                SimpleNamespace(queue=self.service_queue),
+                                {'Movies': Library('Movies', self.tmp.name)})
+        control.start()
+        try:
+            # a worker waiting in the service is woken by the submit
+            waiting = []
+            worker = Thread(target=lambda: waiting.append(self.service_queue.get(5)))
+            worker.start()
+            self.assertEqual(reset_errors(self.queue, self.entries, control.socket_path), 1)
+            worker.join()
+        finally:
+            control.stop()
+        self.assertEqual(waiting[0].path, self.source)
+        self.assertEqual(self.queue.attempts(self.source), 0)
+
+    def test_without_a_service(self):
+        self.assertEqual(reset_errors(self.queue, self.entries,
+                                      join(self.tmp.name, 'missing.sock')), 1)
+        self.assertEqual(self.queue.peek(1), [self.source])
+        self.assertEqual(self.queue.attempts(self.source), 0)
+
+if __name__ == '__main__':
+    unittest.main()
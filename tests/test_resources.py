@@ -0,0 +1,160 @@
+'''Tests for the resource limits of conversions, none of which need root'''
+import tempfile
+import unittest
+from os import getpid, makedirs
+from os.path import join, exists
+from unittest import mock
+
+from config import Library, ResourcePolicy, parse_resources
+from constants import CGROUP_MOUNT, CGROUP_SERVICE, CPU_PERIOD
+from resources import Cgroups, ResourceGroup, ResourceLimits, ionice_args, own_cgroup
+
+def read(file_path):
+    with open(file_path) as cgroup_file:
+        return cgroup_file.read()
+
+class IoniceArgsTest(unittest.TestCase):
+    def test_no_class(self):
+        self.assertIsNone(ionice_args(ResourcePolicy()))
+
+    def test_classes(self):
+        self.assertEqual(ionice_args(ResourcePolicy(ionice='realtime')), ['-c', '1'])
+        self.assertEqual(ionice_args(ResourcePolicy(ionice='best-effort', ionice_level=7)),
+                         ['-c', '2', '-n', '7'])
+
+    def test_idle_has_no_level(self):
+        self.assertEqual(ionice_args(ResourcePolicy(ionice='idle', ionice_level=7)), ['-c', '3'])
+
+@mock.patch('resources.which', return_value='/usr/bin/found')
+class WrapTest(unittest.TestCase):
+    def test_no_limits(self, _):
+        self.assertEqual(ResourceGroup('job', ResourcePolicy()).wrap(['ffmpeg', '-y']),
+                         ['ffmpeg', '-y'])
+
+    def test_nice_and_ionice(self, _):
+        group = ResourceGroup('job', parse_resources({'nice': '10', 'ionice': 'best-effort:4'}))
+        self.assertEqual(group.wrap(['ffmpeg', '-y']),
+                         ['nice', '-n', '10', 'ionice', '-c', '2', '-n', '4', 'ffmpeg', '-y'])
+
+    def test_idle(self, _):
+        group = ResourceGroup('job', parse_resources({'ionice': 'idle'}))
+        self.assertEqual(group.wrap(['ffmpeg']), ['ionice', '-c', '3', 'ffmpeg'])
+
+    def test_missing_tools(self, which):
+        which.return_value = None
+        group = ResourceGroup('job', ResourcePolicy(nice=10, ionice='idle'))
+        self.assertEqual(group.wrap(['ffmpeg']), ['ffmpeg'])
+
+class OwnCgroupTest(unittest.TestCase):
+    def own_cgroup(self, content):
+        with tempfile.NamedTemporaryFile('w', suffix='cgroup') as cgroup_file:
+            cgroup_file.write(content)
+            cgroup_file.flush()
+            return own_cgroup(cgroup_file.name)
+
+    def test_unified(self):
+        self.assertEqual(self.own_cgroup('0::/system.slice/auto-converter.service\n'),
+                         join(CGROUP_MOUNT, 'system.slice/auto-converter.service'))
+
+    def test_root(self):
+        self.assertEqual(self.own_cgroup('0::/\n'), CGROUP_MOUNT)
+
+    def test_v1_only(self):
+        self.assertIsNone(self.own_cgroup('12:cpu,cpuacct:/user.slice\n'))
+
+    def test_missing(self):
+        self.assertIsNone(own_cgroup('/nonexistent/cgroup'))
+
+class CgroupsTest(unittest.TestCase):
+    '''Runs against a temporary directory laid out like a delegated cgroup2 subtree'''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        with open(join(self.root, 'cgroup.controllers'), 'w') as controllers:
+            controllers.write('cpuset cpu io memory pids\n')
+        self.cgroups = Cgroups(self.root)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_setup(self):
+        self.assertTrue(self.cgroups.setup())
+        self.assertEqual(self.cgroups.controllers, ['cpu', 'io', 'memory'])
+        self.assertEqual(read(join(self.root, 'cgroup.subtree_control')), '+cpu +io +memory')
+        self.assertEqual(read(join(self.root, CGROUP_SERVICE, 'cgroup.procs')), str(getpid()))
+
+    def test_limit(self):
+        self.cgroups.setup()
+        path = self.cgroups.create('conversion-0')
+        policy = parse_resources({'cpu_max': '1.5', 'memory_max': '2G', 'io_max': '50M'})
+        self.cgroups.limit(path, policy, ['8:0'])
+        self.assertEqual(read(join(path, 'cpu.max')), '{} {}'.format(150000, CPU_PERIOD))
+        self.assertEqual(read(join(path, 'memory.max')), str(2 * 1024 ** 3))
+        self.assertEqual(read(join(path, 'io.max')), '8:0 rbps=52428800 wbps=52428800')
+
+    def test_lifted_limits(self):
+        self.cgroups.setup()
+        path = self.cgroups.create('conversion-0')
+        self.cgroups.limit(path, parse_resources({'cpu_max': 'max', 'memory_max': ''}), ['8:0'])
+        self.assertEqual(read(join(path, 'cpu.max')), 'max {}'.format(CPU_PERIOD))
+        self.assertEqual(read(join(path, 'memory.max')), 'max')
+        self.assertEqual(read(join(path, 'io.max')), '8:0 rbps=max wbps=max')
+
+    def test_missing_controller(self):
+        with open(join(self.root, 'cgroup.controllers'), 'w') as controllers:
+            controllers.write('cpu\n')
+        self.cgroups.setup()
+        path = self.cgroups.create('conversion-0')
+        self.cgroups.limit(path, ResourcePolicy(cpu_max=2, memory_max=1024), ['8:0'])
+        self.assertEqual(read(join(path, 'cpu.max')), '200000 {}'.format(CPU_PERIOD))
+        self.assertFalse(exists(join(path, 'memory.max')))
+
+    def test_attach(self):
+        self.cgroups.setup()
+        path = self.cgroups.create('conversion-0')
+        self.cgroups.attach(path, 1234)
+        self.assertEqual(read(join(path, 'cgroup.procs')), '1234')
+
+    def test_runtime_update(self):
+        library = Library('TV', self.root, resources=ResourcePolicy(cpu_max=1))
+        limits = ResourceLimits({'TV': library}, self.cgroups)
+        group = limits.group('TV')
+        self.assertEqual(read(join(group.cgroup, 'cpu.max')), '100000 {}'.format(CPU_PERIOD))
+        limits.update('TV', {'cpu_max': '0.5'})
+        self.assertEqual(group.policy.cpu_max, 0.5)
+        self.assertEqual(read(join(group.cgroup, 'cpu.max')), '50000 {}'.format(CPU_PERIOD))
+
+class FallbackTest(unittest.TestCase):
+    def test_not_a_cgroup(self):
+        with tempfile.TemporaryDirectory() as root:
+            cgroups = Cgroups(root)
+            self.assertFalse(cgroups.setup())
+            library = Library('TV', root, resources=ResourcePolicy(nice=10, cpu_max=1))
+            limits = ResourceLimits({'TV': library}, cgroups)
+            self.assertIsNone(limits.cgroups)
+            group = limits.group('TV')
+            self.assertIsNone(group.cgroup)
+            with mock.patch('resources.which', return_value='/usr/bin/nice'):
+                self.assertEqual(group.wrap(['ffmpeg']), ['nice', '-n', '10', 'ffmpeg'])
+            group.attach(1234)
+            limits.release(group)
+
+    def test_unwritable_root(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(join(root, 'cgroup.controllers'), 'w') as controllers:
+                controllers.write('cpu io memory\n')
+            makedirs(join(root, 'cgroup.subtree_control'))
+            self.assertFalse(Cgroups(root).setup())
+
+class ApplyTest(unittest.TestCase):
+    def test_renices_every_thread(self):
+        group = ResourceGroup('job', ResourcePolicy())
+        with mock.patch.object(group, '_threads', return_value=[11, 12, 13]), \
+             mock.patch('resources.which', return_value=None), \
+             mock.patch('resources.setpriority', side_effect=[OSError(1, 'refused'), None, None]) \
+             as setpriority:
+            group.apply(ResourcePolicy(nice=15))
+        self.assertEqual([call[0][1] for call in setpriority.call_args_list], [11, 12, 13])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+'''Tests for the incremental scanner'''
+import unittest
+from os import stat, utime
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from scanner import IncrementalScanner
+
+class FullScanTest(unittest.TestCase):
+    def test_catches_files_modified_in_place(self):
+        with TemporaryDirectory() as root:
+            file_path = join(root, 'movie.mkv')
+            with open(file_path, 'wb') as movie:
+                movie.write(b'x')
+            scanner = IncrementalScanner(root, lambda file_path: True)
+            self.assertEqual(scanner.scan().new, [file_path])
+            dir_mtime_ns = stat(root).st_mtime_ns
+            with open(file_path, 'ab') as movie:
+                movie.write(b'more')
+            utime(root, ns=(dir_mtime_ns, dir_mtime_ns))
+            self.assertEqual(scanner.scan().changed, [])
+            self.assertEqual(scanner.scan(full=True).changed, [file_path])
+
+if __name__ == '__main__':
+    unittest.main()
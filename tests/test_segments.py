@@ -0,0 +1,68 @@
+'''Tests for segmented conversions'''
+import unittest
+from errno import ENOSPC
+from os.path import join
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest import mock
+
+from config import EncodingProfile, Rendition
+from converter import is_out_of_space
+from decisions import ConversionPlan
+from segments import ChunkConversion, SegmentedConversion
+
+def fake_probe(conversion):
+    '''Stands in for probing a source that doesn't exist'''
+    conversion.plan, conversion.width, conversion.height = ConversionPlan.FULL, 640, 360
+    conversion.audio_bitrate, conversion.duration, conversion.ladder = '128k', 600.0, []
+
+class ChunkConversionTest(unittest.TestCase):
+    def test_follows_the_whole_source(self):
+        rendition = Rendition('360p', EncodingProfile(640, 360, 96))
+        parent = SimpleNamespace(threads=2, profile=EncodingProfile(), renditions=[rendition],
+                                 info=object(), audio_bitrate='128k', width=720, height=404,
+                                 plan=ConversionPlan.FULL,
+                                 ladder=[('movie.360p.converting.mp4', 640, 360, '96k',
+                                          rendition.profile)])
+        with mock.patch('converter.MediaInfo') as media_info:
+            chunk = ChunkConversion(parent, 'chunk00001.mkv', 'encoded-chunk00001.converting.mp4',
+                                    'chunk00001.mkv.log', 300.0)
+        media_info.assert_not_called()
+        self.assertEqual((chunk.plan, chunk.width, chunk.height, chunk.audio_bitrate),
+                         (ConversionPlan.FULL, 720, 404, '128k'))
+        self.assertEqual(chunk.duration, 300.0)
+        self.assertEqual(chunk.ladder, [('encoded-chunk00001.360p.converting.mp4', 640, 360,
+                                         '96k', rendition.profile)])
+        self.assertIn('-threads', chunk._cmd(3))
+
+class OutOfSpaceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        with mock.patch.object(SegmentedConversion, '_probe', fake_probe):
+            self.conversion = SegmentedConversion(join(self.tmp.name, 'movie.mkv'),
+                                                  join(self.tmp.name, 'movie.converting.mp4'),
+                                                  join(self.tmp.name, 'movie.log'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_split_fills_the_disk(self):
+        def ffmpeg(cmd, **kwargs):
+            kwargs['stderr'].write('[segment @ 0x55d5] Failed to open segment: '
+                                   'No space left on device\n')
+            return mock.Mock(pid=1, returncode=1, **{'wait.return_value': 1})
+        with mock.patch('segments.Popen', side_effect=ffmpeg):
+            self.conversion.start()
+            result = self.conversion.result()
+        self.assertIn('error', result)
+        self.assertTrue(is_out_of_space(result['stderr']))
+
+    def test_manifest_fills_the_disk(self):
+        full = OSError(ENOSPC, 'No space left on device', 'manifest.json.tmp')
+        with mock.patch.object(SegmentedConversion, '_load_manifest', side_effect=full):
+            self.conversion.start()
+            result = self.conversion.result()
+        self.assertTrue(is_out_of_space(result['stderr']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+'''Tests for checking the outputs of a conversion'''
+import struct
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from verify import Verifier, mp4_boxes, track_handlers
+
+def box(box_type, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def hdlr(handler):
+    # version and flags, pre_defined, the handler type, reserved and an empty name
+    return box(b'hdlr', b'\0' * 8 + handler + b'\0' * 13)
+
+def trak(handler):
+    return box(b'trak', box(b'mdia', hdlr(handler)))
+
+class Mp4Test(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.mp4 = join(self.tmp.name, 'movie.mp4')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, data):
+        with open(self.mp4, 'wb') as mp4_file:
+            mp4_file.write(data)
+
+    def test_boxes(self):
+        moov = box(b'moov', trak(b'vide') + trak(b'soun'))
+        self._write(box(b'ftyp', b'isom') + moov + box(b'mdat', b'x' * 100))
+        boxes = mp4_boxes(self.mp4)
+        self.assertEqual([box_type for box_type, _, _ in boxes], ['ftyp', 'moov', 'mdat'])
+        self.assertEqual(boxes[1], ('moov', 12, len(moov)))
+        self.assertEqual(track_handlers(self.mp4, boxes[1]), ['vide', 'soun'])
+
+    def test_large_and_open_ended_boxes(self):
+        large = struct.pack('>I4sQ', 1, b'free', 16 + 4) + b'abcd'
+        self._write(box(b'ftyp') + large + struct.pack('>I4s', 0, b'mdat') + b'x' * 10)
+        self.assertEqual(mp4_boxes(self.mp4), [('ftyp', 0, 8), ('free', 8, 20),
+                                               ('mdat', 28, 18)])
+
+    def test_truncated(self):
+        self._write(box(b'ftyp') + box(b'mdat', b'x' * 100)[:-10])
+        with self.assertRaises(ValueError):
+            mp4_boxes(self.mp4)
+
+    def test_check_file(self):
+        padding = box(b'mdat', b'x' * 10000)
+        self._write(box(b'ftyp') + box(b'moov', trak(b'vide') + trak(b'soun')) + padding)
+        self.assertIsNone(Verifier.check_file(self.mp4))
+        self._write(box(b'ftyp') + box(b'moov', trak(b'vide')) + padding)
+        self.assertIn('no audio track', Verifier.check_file(self.mp4))
+        self.assertIsNone(Verifier.check_file(self.mp4, audio=False))
+        self._write(box(b'ftyp') + padding)
+        self.assertIn('missing mp4 boxes', Verifier.check_file(self.mp4))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+'''Tests for the worker pool'''
+import unittest
+from unittest import mock
+
+from arrow import utcnow as now
+from converter import Converter, ConversionSkipped
+from workerpool import Worker
+
+class WorkerStatusTest(unittest.TestCase):
+    def test_status_during_trials(self):
+        worker = Worker(0, Converter(verbose=False, search=mock.Mock()))
+        # the dead conversion of the previous job
+        worker.converter.conversion = mock.Mock()
+        worker.job, worker.started = 'movie.mkv', now()
+        statuses = []
+        def choose(*args):
+            statuses.append(worker.status())
+        worker.converter.search.choose.side_effect = choose
+        with self.assertRaises(ConversionSkipped):
+            worker.converter.start_conversion('movie.mkv')
+        self.assertEqual(len(statuses), 1)
+        self.assertIn('movie.mkv', statuses[0])
+        self.assertIn('staging/searching', statuses[0])
+
+    def test_idle(self):
+        worker = Worker(0, Converter(verbose=False))
+        self.assertIn('idle', worker.status())
+
+if __name__ == '__main__':
+    unittest.main()
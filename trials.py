@@ -0,0 +1,188 @@
+'''Picks the x264 settings for a source by encoding a few short samples of
+   it with each candidate setting and measuring their size, speed and SSIM'''
+import re
+from os.path import getsize, join, splitext
+from subprocess import run, CalledProcessError, DEVNULL, PIPE
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from config import EncodingProfile, Rendition
+from constants import TRIAL_CRFS, TRIAL_PRESETS, TRIAL_SAMPLES, TRIAL_SECONDS
+from constants import TRIAL_SIZE_TOLERANCE, PROBE_BACKEND
+from decisions import plan, ConversionPlan
+from mediainfo import MediaInfo, MediaInfoError
+
+SSIM_PATTERN = re.compile(r'SSIM .*All:([0-9.]+)')
+
+class TrialError(Exception):
+    '''Exception that indicates a sample couldn't be encoded or measured'''
+    pass
+
+class TrialCancelled(Exception):
+    '''Exception that indicates the search was cancelled between samples'''
+    pass
+
+def sample_offsets(duration, samples=TRIAL_SAMPLES, seconds=TRIAL_SECONDS):
+    '''Returns the offsets in seconds of samples spread evenly over a source,
+       or a single sample at the start if it's too short to hold them all'''
+    if duration <= samples * seconds:
+        return [0.0]
+    step = (duration - seconds) / samples
+    return [step * (index + 0.5) for index in range(samples)]
+
+def with_settings(profile, crf, preset):
+    '''Returns a copy of an EncodingProfile with a different crf and preset'''
+    return EncodingProfile(profile.max_width, profile.max_height, profile.max_audio_bitrate,
+                           profile.audio_codec, crf, preset, profile.min_ssim)
+
+class Trial(object):
+    '''The combined outcome of encoding every sample with one setting'''
+    __slots__ = ('crf', 'preset', 'size', 'seconds', 'ssim')
+    def __init__(self, crf, preset, size=0, seconds=0.0, ssim=1.0):
+        self.crf = crf
+        self.preset = preset
+        self.size = size
+        self.seconds = seconds
+        self.ssim = ssim
+
+    def to_dict(self):
+        '''Returns the trial as a dict that can be serialized to JSON'''
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+class TrialSearch(object):
+    '''Searches the TRIAL_CRFS and TRIAL_PRESETS for the settings to fully
+       encode a source with, for libraries whose profile sets a min_ssim.
+       The candidates whose worst sample keeps at least min_ssim qualify,
+       and of those the fastest one whose output is within
+       TRIAL_SIZE_TOLERANCE of the smallest is picked. The outcome is kept
+       in cache, a ProbeCache, so that retries don't search again.'''
+    def __init__(self, cache, threads=None, backend=PROBE_BACKEND):
+        self.cache = cache
+        self.threads = threads
+        self.backend = backend
+
+    @staticmethod
+    def _key(profile):
+        return repr([getattr(profile, slot) for slot in profile.__slots__])
+
+    def _run(self, cmd):
+        try:
+            return run(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, check=True,
+                       universal_newlines=True).stderr
+        except (OSError, CalledProcessError) as error:
+            raise TrialError('{} failed: {}'.format(cmd[0], error))
+
+    def _sample(self, src_file_path, offset, size, crf, preset, work_dir):
+        '''Encodes a sample and returns its size, how long the encode took
+           and its SSIM against the scaled source'''
+        sample_path = join(work_dir, 'sample-{}-{}-{:0.0f}.mp4'.format(crf, preset, offset))
+        span = ['-ss', '{:0.3f}'.format(offset), '-t', str(TRIAL_SECONDS), '-i', src_file_path]
+        cmd = ['ffmpeg', '-nostats', '-y'] + span + ['-map', '0:v:0', '-an', '-sn', '-dn',
+                                                    '-s:v', size, '-c:v', 'libx264',
+                                                    '-crf', str(crf), '-preset', preset]
+        if self.threads:
+            cmd.extend(['-threads', str(self.threads)])
+        started = perf_counter()
+        self._run(cmd + [sample_path])
+        seconds = perf_counter() - started
+        output = self._run(['ffmpeg', '-nostats'] + span + ['-i', sample_path, '-lavfi',
+                                                            '[0:v:0]scale={}[reference];'
+                                                            '[1:v:0][reference]ssim'
+                                                            .format(size.replace('x', ':')),
+                                                            '-f', 'null', '-'])
+        ssim = SSIM_PATTERN.findall(output)
+        if not ssim:
+            raise TrialError('No SSIM reported for {}'.format(sample_path))
+        return getsize(sample_path), seconds, float(ssim[-1])
+
+    def _search(self, info, profile, work_dir, cancelled=None):
+        '''Runs every candidate over the samples of the source that a
+           MediaInfo describes and returns the outcome, a dict with the
+           chosen crf and preset that has skip set if even those wouldn't
+           make the source any smaller. Raises TrialCancelled once the
+           cancelled Event is set.'''
+        src_file_path = info.file_path
+        size = '{}x{}'.format(info.video_width(profile.max_width),
+                              info.video_height(profile.max_height))
+        duration = info.duration()
+        offsets = sample_offsets(duration)
+        trials = []
+        for preset in TRIAL_PRESETS:
+            for crf in TRIAL_CRFS:
+                trial = Trial(crf, preset)
+                for offset in offsets:
+                    if cancelled is not None and cancelled.is_set():
+                        raise TrialCancelled('Trials of {} cancelled'.format(src_file_path))
+                    sample_size, seconds, ssim = self._sample(src_file_path, offset, size, crf,
+                                                              preset, work_dir)
+                    trial.size += sample_size
+                    trial.seconds += seconds
+                    trial.ssim = min(trial.ssim, ssim)
+                trials.append(trial)
+        outcome = {'trials': [trial.to_dict() for trial in trials], 'skip': False}
+        qualified = [trial for trial in trials if trial.ssim >= profile.min_ssim] or \
+                    [max(trials, key=lambda trial: trial.ssim)]
+        smallest = min(trial.size for trial in qualified)
+        chosen = min((trial for trial in qualified
+                      if trial.size <= smallest * (1 + TRIAL_SIZE_TOLERANCE)),
+                     key=lambda trial: trial.seconds)
+        outcome.update(crf=chosen.crf, preset=chosen.preset)
+        sampled = min(duration, len(offsets) * TRIAL_SECONDS)
+        audio = int((info.abr(profile.max_audio_bitrate) or '0k')[:-1]) * 1000 / 8.0
+        predicted = (chosen.size / sampled + audio) * duration
+        if predicted >= getsize(src_file_path):
+            outcome['skip'] = True
+        print("Trials for {} picked crf {} preset {}, predicting {:0.0f} MiB{}".format(
+            src_file_path, chosen.crf, chosen.preset, predicted / 1024 ** 2,
+            ', not worth converting' if outcome['skip'] else ''))
+        return outcome
+
+    def outcome(self, src_file_path, info, profile, work_dir=None, cancelled=None):
+        '''Returns the outcome of the search for a source and profile, from
+           the cache if it was searched before. The samples are encoded from
+           the file info describes, which may be a staged copy of the source.
+           Setting the cancelled Event stops the search with TrialCancelled.'''
+        cached = self.cache.get(src_file_path)
+        if cached and cached.get('key') == self._key(profile):
+            return cached
+        if not info.duration():
+            raise TrialError('{} has no known duration'.format(src_file_path))
+        with TemporaryDirectory(prefix='trials-', dir=work_dir) as trial_dir:
+            outcome = self._search(info, profile, trial_dir, cancelled)
+        outcome['key'] = self._key(profile)
+        self.cache.put(src_file_path, outcome)
+        self.cache.flush()
+        return outcome
+
+    def skipped(self, src_file_path, profile):
+        '''Returns True if a search found that a source isn't worth converting'''
+        try:
+            cached = self.cache.get(src_file_path)
+        except OSError:
+            return False
+        return bool(cached and cached.get('key') == self._key(profile) and cached['skip'])
+
+    def choose(self, src_file_path, profile, renditions, work_src_file_path=None,
+               work_dir=None, cancelled=None):
+        '''Returns the profile and renditions to fully encode a source with,
+           using the settings the search picked, or None if the source isn't
+           worth converting. Sources that don't need a full encode, profiles
+           without a min_ssim and sources whose search fails are returned as
+           they are. Raises TrialCancelled if the cancelled Event is set
+           while the search runs.'''
+        if profile.min_ssim is None:
+            return profile, renditions
+        try:
+            info = MediaInfo(work_src_file_path or src_file_path, backend=self.backend)
+            if plan(info, splitext(src_file_path)[1], profile) != ConversionPlan.FULL:
+                return profile, renditions
+            outcome = self.outcome(src_file_path, info, profile, work_dir, cancelled)
+        except (TrialError, MediaInfoError, OSError) as error:
+            print("Unable to run trials for {}: {}".format(src_file_path, error))
+            return profile, renditions
+        if outcome['skip']:
+            return None
+        return with_settings(profile, outcome['crf'], outcome['preset']), \
+               [Rendition(rendition.name, with_settings(rendition.profile, outcome['crf'],
+                                                        outcome['preset']))
+                for rendition in renditions]
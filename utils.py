@@ -1,12 +1,8 @@
 '''Includes various utility functions for the converter service'''
-from re import compile as cmpl
 from argparse import ArgumentParser, Action, ArgumentTypeError
 import os
-from constants import VIDEO_FILE_EXTENSIONS
-
-def str2float(string):
-    '''Converts a string to a floating point value'''
-    return float(cmpl(r'[^\d.]+').sub('', string))
+from constants import VIDEO_FILE_EXTENSIONS, RECONCILE_INTERVAL, PROBE_BACKEND, METRICS_INTERVAL
+from constants import LEASE_DURATION, VERIFY_WORKERS, REPORT_WORKERS
 
 def percentage(value):
     return "{:0.2f}%".format(value * 100.0)
@@ -55,10 +51,31 @@ def log_failed_conversion(log_file_path):
         
 def process_converter_args():
     '''Processes command-line arguments for the converter script'''
-    parser = ArgumentParser(description='A script to convert a given video file into my SD format')
-    parser.add_argument('to_convert', type=str,
-                        action=ReadWriteFile,
-                        help='A file to be converted, will be replaced by resulting file.')
+    parser = ArgumentParser(description='A script to convert given video files into my SD \
+                                         format, by submitting them to a running conversion \
+                                         service if there is one')
+    parser.add_argument('to_convert', type=str, nargs='*',
+                        help='Files to be converted, each will be replaced by the resulting file.')
+    parser.add_argument('-f', '--from-file', type=str,
+                        help='Read further files to convert from this file, one per line, \
+                              or from stdin if given -')
+    parser.add_argument('--socket', type=str,
+                        help='The control socket of the service, found next to the files \
+                              or through AUTO_CONVERTER_SOCKET if not given')
+    parser.add_argument('--local', action='store_true',
+                        help='Convert in this process even if a service is running')
+    parser.add_argument('--priority', type=float,
+                        help='Queue the files with this priority, lower goes first')
+    parser.add_argument('--cancel', action='store_true',
+                        help='Cancel the conversion of the given files instead')
+    parser.add_argument('--status', action='store_true', help='Show what the service is doing')
+    parser.add_argument('--pause', action='store_true', help='Pause all conversions')
+    parser.add_argument('--resume', action='store_true', help='Resume all conversions')
+    parser.add_argument('--limit', type=str, action='append', metavar='NAME=VALUE',
+                        help='Change a resource limit of a library\'s conversions, such as \
+                              nice=15, ionice=idle or cpu_max=1.5, while they run')
+    parser.add_argument('--library', type=str, default='',
+                        help='The library whose limits --limit changes')
     args = parser.parse_args()
     return args
 
@@ -68,12 +85,109 @@ def process_converter_service_args():
                                          files that can and should be converted \
                                          and then converts them to SD.')
     parser.add_argument('to_scan', type=str,
-                        help='A directory to be checked for files that can be converted')
+                        help='A directory to be checked for files that can be converted, \
+                              or a config file defining several libraries')
+    parser.add_argument('--poll', action='store_true',
+                        help='Rescan the directory every 30 seconds instead of watching it with inotify')
+    parser.add_argument('--reconcile-interval', type=float, default=RECONCILE_INTERVAL,
+                        help='Seconds between the full rescans that catch missed inotify events '
+                             'and files modified in place')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of concurrent conversions, derived from the CPU count \
+                              and --threads if not given')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Number of ffmpeg threads per conversion')
+    parser.add_argument('-p', '--priority',
+                        choices=['smallest', 'oldest', 'savings', 'shortest', 'deadline'],
+                        default='smallest', help='The order in which queued files are \
+                              converted, shortest and deadline go by the predicted \
+                              conversion time')
+    parser.add_argument('--max-load', type=float,
+                        help='Pause conversions while the 1 minute load average is above this')
+    parser.add_argument('--max-pressure', type=float,
+                        help='Pause conversions while the CPU pressure (avg10, in percent) \
+                              is above this')
+    parser.add_argument('--window', type=str,
+                        help='Only convert during this time of day, given as HH:MM-HH:MM')
+    parser.add_argument('--segment-duration', type=int,
+                        help='Encode files in resumable segments of this many seconds')
+    parser.add_argument('--segment-workers', type=int, default=1,
+                        help='Number of segments of a file to encode at the same time')
+    parser.add_argument('--probe-backend', choices=['mediainfo', 'ffprobe'],
+                        default=PROBE_BACKEND, help='The program used to read media metadata')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on this local port at /metrics')
+    parser.add_argument('--metrics-file', type=str,
+                        help='Periodically write a JSON snapshot of the metrics to this file')
+    parser.add_argument('--metrics-interval', type=float, default=METRICS_INTERVAL,
+                        help='Seconds between JSON metrics snapshots')
+    parser.add_argument('--scratch-dir', type=str,
+                        help='Stage sources on this local directory and encode there')
+    parser.add_argument('--scratch-budget', type=float, default=50,
+                        help='GiB of sources that may be staged on the scratch directory')
+    parser.add_argument('--no-space-check', action='store_true',
+                        help='Start conversions without checking for free disk space first')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='Convert every copy of a source instead of reusing the output \
+                              of an identical one')
+    parser.add_argument('--full-hash', action='store_true',
+                        help='Recognize copies by hashing all of their content instead of \
+                              sampled blocks')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Hand jobs out to conversion-worker.py processes on this port \
+                              instead of converting locally')
+    parser.add_argument('--bind', type=str, default='127.0.0.1',
+                        help='The address --serve listens on, 0.0.0.0 for every interface')
+    parser.add_argument('--token', type=str,
+                        help='The token remote workers have to send, taken from \
+                              AUTO_CONVERTER_TOKEN if not given')
+    parser.add_argument('--lease-duration', type=float, default=LEASE_DURATION,
+                        help='Seconds a remote worker may go without a heartbeat before \
+                              its job is requeued')
+    parser.add_argument('--verifiers', type=int, default=VERIFY_WORKERS,
+                        help='Number of finished encodes to verify at the same time')
+    parser.add_argument('--deep-verify', action='store_true',
+                        help='Also decode every output in full before accepting it')
+    parser.add_argument('--cgroup', type=str,
+                        help='The cgroup v2 directory to create a cgroup per conversion in, \
+                              by default the one the service runs in')
+    parser.add_argument('--no-cgroups', action='store_true',
+                        help='Limit conversions with nice and ionice only')
+    args = parser.parse_args()
+    return args
+
+def process_converter_worker_args():
+    '''Processes command-line arguments for a remote conversion worker'''
+    parser = ArgumentParser(description='A worker that claims jobs from a conversion \
+                                         service started with --serve and converts them.')
+    parser.add_argument('coordinator', type=str,
+                        help='The URL of the coordinator, e.g. http://host:8750')
+    parser.add_argument('config', type=str, nargs='?',
+                        help='The config file the coordinator was started with, needed \
+                              for the output directories and profiles of its libraries')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='Number of ffmpeg threads per conversion')
+    parser.add_argument('-n', '--name', type=str,
+                        help='The name the worker reports to the coordinator')
+    parser.add_argument('--token', type=str,
+                        help='The token the coordinator was started with, taken from \
+                              AUTO_CONVERTER_TOKEN if not given')
+    parser.add_argument('--segment-duration', type=int,
+                        help='Encode files in resumable segments of this many seconds')
+    parser.add_argument('--segment-workers', type=int, default=1,
+                        help='Number of segments of a file to encode at the same time')
+    parser.add_argument('--deep-verify', action='store_true',
+                        help='Also decode every output in full before accepting it')
+    parser.add_argument('--cgroup', type=str,
+                        help='The cgroup v2 directory to create a cgroup per conversion in, \
+                              by default the one the worker runs in')
+    parser.add_argument('--no-cgroups', action='store_true',
+                        help='Limit conversions with nice and ionice only')
     args = parser.parse_args()
     return args
 
 def process_utils_args():
-    '''Processes command-line arguments for the converter service'''
+    '''Processes command-line arguments for the conversion report'''
     parser = ArgumentParser(description='A set of utility functions to help \
                                          out with conversion of files, like \
                                          listing the total number of files \
@@ -81,13 +195,26 @@ def process_utils_args():
                                          converted, ones that have errors, \
                                          and moving all of them to a \
                                          particular directory.')
-    parser.add_argument('-s', '--list-successful', help='Lists all files in \
-                                                         the current or given \
-                                                         directory that have \
-                                                         been successfully \
-                                                         converted')
-    parser.add_argument('-f', '--list-failed', help='Lists all files in the current or given directory that have not been successfully converted')
+    parser.add_argument('-s', '--list-successful', action='store_true',
+                        help='Lists the files that have been successfully converted')
+    parser.add_argument('-f', '--list-failed', action='store_true',
+                        help='Lists the files that have not been successfully converted')
+    parser.add_argument('-p', '--list-pending', action='store_true',
+                        help='Lists the files that are waiting to be converted')
+    parser.add_argument('-r', '--list-running', action='store_true',
+                        help='Lists the files that are being converted')
     parser.add_argument('directory', nargs='?', default=os.getcwd(),
-                        help='The directory which to scan')
+                        help='The directory, or config file of the libraries, to report on')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv',
+                        help='The format to list the files in')
+    parser.add_argument('--scan', action='store_true',
+                        help='Walk the directories even if the service keeps a job queue')
+    parser.add_argument('--workers', type=int, default=REPORT_WORKERS,
+                        help='Number of threads that walk the directories')
+    parser.add_argument('--reset-errors', action='store_true',
+                        help='Clear the error counts of the failed files and queue them again')
+    parser.add_argument('--move-failed', type=str, nargs='?', const='', metavar='DIRECTORY',
+                        help='Move the failed files to this directory, or to the \
+                              error_directory of their library if not given')
     args = parser.parse_args()
     return args
@@ -0,0 +1,138 @@
+'''Checks the outputs of a conversion before they replace anything, using
+   what ffmpeg reported while encoding and the source's probe data rather
+   than probing the outputs all over again'''
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from os.path import getsize
+from subprocess import run, DEVNULL, PIPE
+
+from constants import MIN_OUTPUT_SIZE, VERIFY_TOLERANCE, VERIFY_MIN_SLACK, MOOV_READ_LIMIT
+
+def mp4_boxes(file_path):
+    '''Returns the (type, offset, size) tuples of the top level boxes of an
+       mp4 file, reading nothing but their headers. Raises ValueError if
+       the boxes don't add up to the file, as happens when it's truncated.'''
+    file_size = getsize(file_path)
+    boxes = []
+    offset = 0
+    with open(file_path, 'rb') as mp4_file:
+        while offset < file_size:
+            mp4_file.seek(offset)
+            header = mp4_file.read(8)
+            if len(header) < 8:
+                raise ValueError('truncated box header at {}'.format(offset))
+            size, box_type = struct.unpack('>I4s', header)
+            if size == 1:
+                size = struct.unpack('>Q', mp4_file.read(8))[0]
+            elif size == 0:
+                size = file_size - offset
+            if size < 8 or offset + size > file_size:
+                raise ValueError('truncated {} box'.format(box_type.decode('latin-1')))
+            boxes.append((box_type.decode('latin-1'), offset, size))
+            offset += size
+    return boxes
+
+def track_handlers(file_path, moov):
+    '''Returns the handler types ('vide', 'soun', ...) of the tracks in the
+       moov box at the given (type, offset, size)'''
+    _, offset, size = moov
+    if size > MOOV_READ_LIMIT:
+        return None
+    with open(file_path, 'rb') as mp4_file:
+        mp4_file.seek(offset)
+        data = mp4_file.read(size)
+    handlers = []
+    index = data.find(b'hdlr')
+    while index >= 0:
+        # the handler type follows the version, flags and pre_defined fields
+        handlers.append(data[index + 12:index + 16].decode('latin-1'))
+        index = data.find(b'hdlr', index + 4)
+    return handlers
+
+def decodes_cleanly(file_path, threads=None):
+    '''Decodes a whole file to nowhere, returns why it failed or None'''
+    cmd = ['ffmpeg', '-nostats', '-v', 'error']
+    if threads:
+        cmd.extend(['-threads', str(threads)])
+    try:
+        process = run(cmd + ['-i', file_path, '-f', 'null', '-'], stdin=DEVNULL,
+                      stdout=DEVNULL, stderr=PIPE, universal_newlines=True)
+    except OSError as error:
+        return "{} could not be decoded: {}".format(file_path, error)
+    errors = process.stderr.strip()
+    if process.returncode or errors:
+        return "{} does not decode cleanly: {}".format(file_path,
+                                                       errors.splitlines()[-1] if errors else
+                                                       'exit status {}'.format(process.returncode))
+    return None
+
+class Verifier(object):
+    '''Verifies the outputs of a conversion. Every output has to be a
+       complete mp4 with a video track, and an audio track if the source
+       has one. The duration and frame count that ffmpeg reported for the
+       main output have to match the source's within VERIFY_TOLERANCE.
+       With deep set every output is also decoded in full, all of them
+       at once, which catches corrupt streams at the price of a decode.'''
+    def __init__(self, deep=False, threads=None):
+        self.deep = deep
+        self.threads = threads
+
+    @staticmethod
+    def check_file(file_path, audio=True):
+        '''Checks the container and tracks of an output, returns why it's
+           unusable or None if it looks fine'''
+        try:
+            if getsize(file_path) < MIN_OUTPUT_SIZE:
+                return "{} is too small...".format(file_path)
+            boxes = mp4_boxes(file_path)
+        except (OSError, ValueError) as error:
+            return "{} is not a complete mp4: {}".format(file_path, error)
+        types = [box[0] for box in boxes]
+        if not types or types[0] != 'ftyp' or 'moov' not in types or 'mdat' not in types:
+            return "{} is missing mp4 boxes, it has {}".format(file_path, ', '.join(types))
+        try:
+            handlers = track_handlers(file_path, boxes[types.index('moov')])
+        except OSError as error:
+            return "{} could not be read: {}".format(file_path, error)
+        if handlers is not None:
+            if 'vide' not in handlers:
+                return "{} has no video track".format(file_path)
+            if audio and 'soun' not in handlers:
+                return "{} has no audio track".format(file_path)
+        return None
+
+    @staticmethod
+    def check_progress(conversion):
+        '''Compares what ffmpeg reported writing with the source, returns
+           why the output falls short or None if it matches'''
+        duration = conversion.duration
+        stats = conversion.stats()
+        if duration:
+            slack = max(VERIFY_MIN_SLACK, duration * VERIFY_TOLERANCE)
+            if abs(stats.out_time - duration) > slack:
+                return "{} is {:0.1f}s long but its source is {:0.1f}s".format(
+                    conversion.dst, stats.out_time, duration)
+        video = conversion.info.result.video[0] if conversion.info.result.video else None
+        frames = video.frame_count if video else None
+        if conversion.counts_frames and frames and stats.frame:
+            if abs(stats.frame - frames) > max(1, frames * VERIFY_TOLERANCE):
+                return "{} has {} frames but its source has {}".format(conversion.dst,
+                                                                      stats.frame, frames)
+        return None
+
+    def check(self, conversion, dst_file_paths):
+        '''Verifies the outputs of a finished Conversion, the main output
+           first, returns why they're unusable or None if they look fine'''
+        audio = bool(conversion.info.result.audio)
+        for dst_file_path in dst_file_paths:
+            failure = self.check_file(dst_file_path, audio)
+            if failure:
+                return failure
+        failure = self.check_progress(conversion)
+        if failure or not self.deep:
+            return failure
+        with ThreadPoolExecutor(max_workers=len(dst_file_paths)) as executor:
+            failures = list(executor.map(lambda file_path: decodes_cleanly(file_path,
+                                                                           self.threads),
+                                         dst_file_paths))
+        return next((failure for failure in failures if failure), None)
@@ -0,0 +1,186 @@
+'''A small ctypes binding to Linux inotify used to react to new files'''
+import ctypes
+from ctypes.util import find_library
+from errno import EAGAIN
+from os import read, close, scandir, stat, fsencode, fsdecode
+from os.path import join
+from select import select
+from struct import calcsize, unpack_from
+from time import monotonic
+
+from constants import WATCH_DEBOUNCE
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = 'iIII'
+_EVENT_SIZE = calcsize(_EVENT)
+_libc = None
+
+def _inotify():
+    '''Loads libc and declares the inotify functions'''
+    global _libc # pylint: disable=global-statement
+    if _libc is None:
+        libc = ctypes.CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+class DirectoryWatcher(object):
+    '''Recursively watches a directory tree and reports files once they have
+       been closed after writing (or moved in) and have stayed unchanged for
+       the debounce period. Raises OSError if inotify is unavailable.'''
+    def __init__(self, root, accept=None, debounce=WATCH_DEBOUNCE):
+        self.root = root
+        self.accept = accept or (lambda path: True)
+        self.debounce = debounce
+        self.needs_rescan = False
+        self._pending = {}
+        self._sizes = {}
+        self._watches = {}
+        try:
+            libc = _inotify()
+            self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as error:
+            raise OSError('inotify is not available: {}'.format(error))
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._add_tree(root, False)
+
+    def fileno(self):
+        '''Returns the inotify file descriptor'''
+        return self._fd
+
+    def close(self):
+        '''Closes the inotify file descriptor, removing all watches'''
+        close(self._fd)
+        self._watches.clear()
+
+    def _add_watch(self, dir_path):
+        wd = _libc.inotify_add_watch(self._fd, fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            print("Unable to watch {}".format(dir_path))
+            self.needs_rescan = True
+        else:
+            self._watches[wd] = dir_path
+
+    def _add_tree(self, dir_path, enqueue):
+        '''Watches a directory and all of its subdirectories, enqueueing any
+           files already in them if enqueue is set'''
+        stack = [dir_path]
+        while stack:
+            current = stack.pop()
+            self._add_watch(current)
+            try:
+                entries = list(scandir(current))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif enqueue:
+                    self._enqueue(entry.path)
+
+    def _enqueue(self, file_path):
+        if self.accept(file_path):
+            self._pending[file_path] = monotonic() + self.debounce
+            try:
+                self._sizes[file_path] = stat(file_path).st_size
+            except OSError:
+                self._sizes.pop(file_path, None)
+
+    def _read_events(self):
+        try:
+            data = read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError as error:
+            if error.errno == EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = unpack_from(_EVENT, data, offset)
+            name = data[offset + _EVENT_SIZE:offset + _EVENT_SIZE + length].rstrip(b'\0')
+            offset += _EVENT_SIZE + length
+            self._handle(wd, mask, fsdecode(name))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.needs_rescan = True
+            return
+        dir_path = self._watches.get(wd)
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+        if dir_path is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if dir_path == self.root:
+                self.needs_rescan = True
+            return
+        path = join(dir_path, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path, True)
+            elif mask & IN_MOVED_FROM:
+                # watches below a moved directory keep their old paths
+                self.needs_rescan = True
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+            self._enqueue(path)
+
+    def wait_time(self, timeout=None):
+        '''Shortens timeout to when the next pending file is due to settle'''
+        if self._pending:
+            wait = max(0, min(self._pending.values()) - monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+        return timeout
+
+    def poll(self, timeout=None):
+        '''Waits up to timeout seconds for events and returns the list of
+           files that have settled since the last call'''
+        readable, _, _ = select([self._fd], [], [], self.wait_time(timeout))
+        if readable:
+            self._read_events()
+        now = monotonic()
+        ready = [path for path, deadline in self._pending.items() if deadline <= now]
+        settled = []
+        for path in ready:
+            del self._pending[path]
+            try:
+                size = stat(path).st_size
+            except OSError:
+                self._sizes.pop(path, None)
+                settled.append(path)
+                continue
+            if self._sizes.get(path, size) != size:
+                # the file is still growing, give it another debounce period
+                self._sizes[path] = size
+                self._pending[path] = now + self.debounce
+            else:
+                self._sizes.pop(path, None)
+                settled.append(path)
+        return settled
+
+def poll_watchers(watchers, timeout=None):
+    '''Waits up to timeout seconds for events on any of a dict of watchers
+       and returns a dict mapping the same keys to their settled files'''
+    for watcher in watchers.values():
+        timeout = watcher.wait_time(timeout)
+    select(list(watchers.values()), [], [], timeout)
+    return {key: watcher.poll(0) for key, watcher in watchers.items()}
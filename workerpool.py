@@ -0,0 +1,324 @@
+'''A pool of worker threads that each drive one conversion at a time'''
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count, makedirs
+from os.path import isfile, dirname, getsize
+from shutil import move
+from queue import Queue, Empty
+from threading import Thread, Event
+from time import time
+
+from arrow import utcnow as now
+from constants import RETRY_LIMIT, SPACE_RECHECK, VERIFY_WORKERS
+from converter import ConversionStatus, ConversionSkipped, ConversionCancelled, OutOfSpaceError
+from converter import conversion_paths
+from metrics import METRICS
+
+def pool_size(workers=None, threads=None):
+    '''Returns the number of concurrent conversions to run, either the fixed
+       number of workers or as many ffmpeg processes of the given thread
+       count as fit on this machine's cores'''
+    if workers:
+        return workers
+    if threads:
+        return max(1, (cpu_count() or 1) // threads)
+    return 1
+
+class Worker(object):
+    '''A single worker slot along with its current job'''
+    def __init__(self, index, converter):
+        self.index = index
+        self.converter = converter
+        self.job = None
+        self.started = None
+        self.predicted = None
+        self.completed = 0
+        self.failed = 0
+        self.thread = None
+
+    def status(self):
+        '''Returns a one-line description of what the worker is doing'''
+        if self.job is None:
+            return "Worker {}: idle ({} done, {} failed)".format(self.index, self.completed,
+                                                                 self.failed)
+        conversion = self.converter.conversion
+        if conversion is None:
+            # the source is still being staged or searched for its settings
+            return "Worker {}: {} [{}] staging/searching".format(self.index, self.job,
+                                                                 now() - self.started)
+        try:
+            progress = '{:0.2f}%'.format(conversion.progress() * 100.0)
+        except Exception: # pylint: disable=broad-except
+            progress = 'starting'
+        try:
+            eta = conversion.eta()
+            if eta == float('inf') and self.predicted is not None:
+                # ffmpeg hasn't reported any progress yet, go by the cost model
+                eta = timedelta(seconds=max(0.0, self.predicted -
+                                            conversion.elapsed().total_seconds()))
+        except Exception: # pylint: disable=broad-except
+            eta = float('inf')
+        if conversion.status == ConversionStatus.PAUSED:
+            progress += ' (paused)'
+        return "Worker {}: {} [{}] {} ETA: {}".format(self.index, self.job,
+                                                      now() - self.started, progress, eta)
+
+class Encode(object):
+    '''A job whose encode has finished, along with what its outcome is
+       recorded with once its outputs have been verified'''
+    __slots__ = ('job', 'library', 'conversion', 'source', 'predicted', 'seconds')
+    def __init__(self, job, library, conversion, source=None, predicted=None):
+        self.job = job
+        self.library = library
+        self.conversion = conversion
+        self.source = source
+        self.predicted = predicted
+        try:
+            self.seconds = conversion.elapsed().total_seconds()
+        except Exception: # pylint: disable=broad-except
+            self.seconds = None
+
+def move_to_error_directory(file_path, library):
+    '''Moves a source that has failed too often into its library's error directory'''
+    error_path = library.error_path(file_path) if library else None
+    if error_path and isfile(file_path):
+        print("Giving up on {}, moving it to {}".format(file_path, error_path))
+        makedirs(dirname(error_path), exist_ok=True)
+        move(file_path, error_path)
+
+def output_size(file_path, library):
+    '''Returns the size of the final output of a source, or None if there isn't one'''
+    try:
+        return getsize(conversion_paths(file_path, library)[1])
+    except OSError:
+        return None
+
+class WorkerPool(object):
+    '''Runs up to size conversions at once, taking the next job from the
+       JobQueue as soon as a worker frees up. make_converter is called once
+       per worker to create its Converter and libraries maps library names
+       to the Library each job is converted for. If a ScratchStage is given
+       the next queued sources are staged while the current ones encode.
+       If an AdmissionControl is given, jobs are held in the queue while
+       their destination is short on space. If a CostModel is given, the
+       time each successful conversion took is fed back into it. If a
+       Deduplicator is given, copies of a source are only converted once.
+       Outputs are verified and moved into place on a separate pool of
+       verifiers threads so that a worker starts its next encode right away.'''
+    def __init__(self, size, make_converter, queue, libraries=None, stage=None,
+                 admission=None, costs=None, dedup=None, verifiers=VERIFY_WORKERS):
+        self.workers = [Worker(i, make_converter()) for i in range(size)]
+        self.queue = queue
+        self.libraries = libraries or {}
+        self.stage = stage
+        self.admission = admission
+        self.costs = costs
+        self.dedup = dedup
+        self._cancelled = set()
+        self._verifiers = ThreadPoolExecutor(max_workers=verifiers,
+                                             thread_name_prefix='verifier')
+        self._done = Queue()
+        self._unpaused = Event()
+        self._unpaused.set()
+        for worker in self.workers:
+            worker.thread = Thread(target=self._run, args=(worker,), daemon=True,
+                                   name='conversion-worker-{}'.format(worker.index))
+            worker.thread.start()
+
+    def _run(self, worker):
+        while True:
+            self._unpaused.wait()
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.stage:
+                self.stage.prefetch(self.queue.peek(len(self.workers)))
+            error = None
+            library = self.libraries.get(job.library)
+            METRICS.observe('queue_wait', max(0.0, time() - job.queued))
+            if isfile(job.path):
+                if self.dedup and self._deduplicate(job, library):
+                    continue
+                held = self.admission.admit(job, library) if self.admission else None
+                if held:
+                    self._settle(job, library, False)
+                    self._hold(job, held)
+                    continue
+                source = self.costs.features(job.path, library) if self.costs else None
+                worker.predicted = self.costs.predict(source, job.library) if source else None
+                # a cancel that came in after the last job ended was meant for it
+                worker.converter.cancelled.clear()
+                worker.job, worker.started = job.path, now()
+                METRICS.set('active_workers', self.active())
+                finish, skipped = None, None
+                try:
+                    finish = worker.converter.start_conversion(job.path, library)
+                except OutOfSpaceError as exception:
+                    held = str(exception)
+                except ConversionSkipped as exception:
+                    skipped = str(exception)
+                except ConversionCancelled as exception:
+                    print(exception)
+                except Exception as exception: # pylint: disable=broad-except
+                    error = str(exception)
+                    print("Worker {} failed on {}: {}".format(worker.index, job.path, error))
+                encode = Encode(job, library, worker.converter.conversion, source, worker.predicted)
+                worker.job = None
+                METRICS.set('active_workers', self.active())
+                if finish is not None:
+                    # the next job can start encoding while this one is verified
+                    self._verifiers.submit(self._verify, worker, encode, finish)
+                else:
+                    self._complete(worker, encode, False, error, held, skipped)
+            else:
+                self.queue.finish(job, ConversionStatus.STOPPED, 'Source no longer exists')
+                self._done.put((job, False))
+
+    def _verify(self, worker, encode, finish):
+        '''Verifies the outputs of an encode and moves them into place, on the
+           verification pool'''
+        result, error, held = False, None, None
+        try:
+            result = finish()
+        except OutOfSpaceError as exception:
+            held = str(exception)
+        except Exception as exception: # pylint: disable=broad-except
+            error = str(exception)
+            print("Worker {} failed on {}: {}".format(worker.index, encode.job.path, error))
+        self._complete(worker, encode, result, error, held)
+
+    def _complete(self, worker, encode, result, error=None, held=None, skipped=None):
+        '''Records the outcome of a job'''
+        job, library = encode.job, encode.library
+        size = output_size(job.path, library) if result else None
+        if self.admission:
+            self._release_admission(job, library, encode.conversion, size)
+        self._settle(job, library, result)
+        if held:
+            self._hold(job, held)
+            return
+        cancelled = job.path in self._cancelled
+        self._cancelled.discard(job.path)
+        if cancelled and not result:
+            # not reported as done, so that it isn't queued again right away
+            self.queue.finish(job, ConversionStatus.STOPPED, 'Cancelled')
+            return
+        if skipped:
+            print(skipped)
+            METRICS.inc('skipped')
+            self.queue.finish(job, ConversionStatus.STOPPED, skipped)
+            return
+        if result:
+            worker.completed += 1
+            METRICS.inc('converted')
+            if encode.source:
+                self._record_cost(encode)
+        else:
+            worker.failed += 1
+            METRICS.inc('failed')
+        self.queue.finish(job, ConversionStatus.DONE if result else ConversionStatus.ERROR, error,
+                          size)
+        if not result and self.queue.attempts(job.path) > RETRY_LIMIT:
+            move_to_error_directory(job.path, library)
+        elif not result:
+            METRICS.inc('retried')
+        self._done.put((job, result))
+
+    def _deduplicate(self, job, library):
+        '''Reuses the output of an identical source for a job or parks the job
+           behind the running conversion of one, returns False if the job
+           has to be converted'''
+        action, output = self.dedup.claim(job, library)
+        if action == self.dedup.REUSE:
+            self._done.put((job, self.dedup.reuse(job, library, output, self.queue)))
+        return action != self.dedup.CONVERT
+
+    def _settle(self, job, library, result):
+        '''Hands the output of a conversion to the twins that waited on it,
+           or puts them back in the queue if it failed'''
+        if not self.dedup:
+            return
+        output = conversion_paths(job.path, library)[1] if result else None
+        for twin, twin_library in self.dedup.settle(job, output):
+            if output:
+                self._done.put((twin, self.dedup.reuse(twin, twin_library, output, self.queue)))
+            else:
+                self.queue.release(twin)
+
+    def _hold(self, job, reason):
+        '''Puts a job back without counting an attempt against it, for jobs
+           that can't run for lack of disk space, where it's left alone for
+           SPACE_RECHECK seconds while the workers take on other jobs'''
+        print("Holding {}: {}".format(job.path, reason))
+        self.queue.release(job, SPACE_RECHECK)
+
+    def _release_admission(self, job, library, conversion, size):
+        '''Returns a job's admitted space and teaches the size model what it
+           produced, given the size of its output if it succeeded'''
+        if conversion is None:
+            self.admission.release(job, library, None, None)
+        else:
+            self.admission.release(job, library, conversion.duration if size is not None else None,
+                                   size)
+
+    def _record_cost(self, encode):
+        '''Teaches the cost model how long an encode took, not counting the
+           time it spent paused'''
+        if encode.seconds is not None:
+            self.costs.record(encode.job.path, encode.job.library, encode.source,
+                              encode.seconds, encode.predicted)
+
+    def completed(self):
+        '''Returns a list of (job, succeeded) tuples for jobs that finished
+           since the last call'''
+        results = []
+        while True:
+            try:
+                results.append(self._done.get_nowait())
+            except Empty:
+                return results
+
+    def cancel(self, file_path):
+        '''Stops the running encode of a file without counting it as a
+           failed attempt, returns True if there was one. Encodes that are
+           still being staged or searched stop before their conversion.'''
+        for worker in self.workers:
+            if worker.job == file_path:
+                self._cancelled.add(file_path)
+                worker.converter.cancel()
+                return True
+        return False
+
+    def active(self):
+        '''Returns the number of workers that are currently converting'''
+        return sum(1 for worker in self.workers if worker.job is not None)
+
+    def encode_speed(self):
+        '''Returns the combined speed of the running conversions as a
+           multiple of realtime'''
+        speed = 0.0
+        for worker in self.workers:
+            conversion = worker.converter.conversion
+            if worker.job is not None and conversion is not None:
+                speed += conversion.stats().speed or 0.0
+        return speed
+
+    def pause(self):
+        '''Pauses every running conversion and holds off on starting new ones'''
+        self._unpaused.clear()
+        for worker in self.workers:
+            worker.converter.pause()
+
+    def resume(self):
+        '''Resumes paused conversions and allows new ones to start'''
+        self._unpaused.set()
+        for worker in self.workers:
+            worker.converter.resume()
+
+    def status(self):
+        '''Returns a list of status lines, one per worker'''
+        return [worker.status() for worker in self.workers]
+
+    def stop(self):
+        '''Stops the workers once they finish their current job'''
+        self.queue.close()